@@ -1,33 +1,203 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from pymongo import MongoClient
+from flask import (Flask, Blueprint, render_template, request, redirect, url_for, session, jsonify,
+                   Response, stream_with_context)
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv, find_dotenv
 from flask_bcrypt import Bcrypt
 from openai import OpenAI
+import httpx
 import os
 import json
+import copy
+import hashlib
+import logging
+import threading
+import time
 from datetime import datetime, timedelta
+import metrics
+from cache import TTLCache
+from jobs import CoalescingJobQueue, PeriodicJob, BoundedExecutor, QueueFullError
+from limits import TurnGate, TurnBusyError, TokenBucket
+from changefeed import change_feed
+from context import (
+    context_rows, context_ref, encode_full, encode_delta, encode_unchanged, has_base, is_context_message,
+    DEFAULT_CONTEXT_HORIZON_DAYS,
+)
+from intents import route_message, normalize, DAILY_CHECKIN
+from importer import (parse_import, detect_format, item_key, KIND_FIELDS, FORMATS, ImportFileError)
+from feed import render_calendar
+from planner import (
+    build_plan, diff_plan, changes_need_replan, priority_list, parse_day_constraints, free_today,
+    reschedule_today, first_affected_date, replan_from, weekday_index, DEFAULT_HORIZON_DAYS,
+)
 
 # Load .env file
 load_dotenv(find_dotenv(), override=True)
 
-app = Flask(__name__)
+# The storage layer reads MONGO_URI, so it is imported after .env is loaded.
+from storage import (
+    users_collection, plans_collection, user_cache, ensure_indexes, get_user, get_user_data, invalidate_user, get_plan,
+    write_plan_dates, replace_plan, get_chat_state, append_chat_messages, save_chat_summary,
+    clear_chat_history, migrate_legacy_user, new_item_id, UnitOfWork, unit_of_work, AUTH_FIELDS,
+    VERSION_FIELDS, get_user_changes, get_plan_changes, get_feed_owner, get_feed_token, get_data_version,
+    get_data_versions, get_fresh_user_data, first_plan_date, create_chat_result, finish_chat_result,
+    get_chat_result,
+)
+
+# All routes live on this blueprint; create_app() builds the Flask app around it.
+bp = Blueprint("main", __name__)
 
 # Load environment variables
-MONGO_URI = os.getenv("MONGO_URI")
 SECRET_KEY = os.getenv("SECRET_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+PLANNER_HORIZON_DAYS = int(os.getenv("PLANNER_HORIZON_DAYS", DEFAULT_HORIZON_DAYS))
+PLANNER_DEBOUNCE_SECONDS = float(os.getenv("PLANNER_DEBOUNCE_SECONDS", "0.3"))
+PLANNER_WORKERS = int(os.getenv("PLANNER_WORKERS", "4"))
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "60"))
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "6000"))
+# Rolling summary: older turns are folded into a short summary in the background,
+# keeping the newest CHAT_SUMMARY_KEEP_TURNS verbatim.
+CHAT_SUMMARY_ENABLED = os.getenv("CHAT_SUMMARY_ENABLED", "1") == "1"
+CHAT_SUMMARY_KEEP_TURNS = int(os.getenv("CHAT_SUMMARY_KEEP_TURNS", "6"))
+CHAT_SUMMARY_BATCH_TURNS = int(os.getenv("CHAT_SUMMARY_BATCH_TURNS", "4"))  # summarize once this many more pile up
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+OPENAI_SUMMARY_MODEL = os.getenv("OPENAI_SUMMARY_MODEL") or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+CONTEXT_HORIZON_DAYS = int(os.getenv("CONTEXT_HORIZON_DAYS", DEFAULT_CONTEXT_HORIZON_DAYS))
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+# Threads each worker serves requests with (gunicorn.conf.py reads the same variable).
+WORKER_THREADS = int(os.getenv("GUNICORN_THREADS", "8"))
+# Request threads that synchronous chats (/chat, /chat_stream) may never take,
+# so /get_schedule and the auth routes always get one.
+LLM_RESERVED_THREADS = int(os.getenv("LLM_RESERVED_THREADS", "2"))
+CHAT_REQUEST_THREADS = max(1, WORKER_THREADS - LLM_RESERVED_THREADS)
+# Chats sent with `Prefer: respond-async` run on this many chat worker threads
+# (not request threads), with up to CHAT_QUEUE_MAX more waiting for one.
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "16"))
+CHAT_QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", "256"))
+# OpenAI calls in flight per process, from chat workers and request threads together.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", str(CHAT_WORKERS + CHAT_REQUEST_THREADS)))
+# How long a call waits for one of those slots before giving up as busy.
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "5"))
+# Token bucket for calls to OpenAI, per process; 0 turns it off.
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "10"))
+LLM_BURST = int(os.getenv("LLM_BURST", "20"))
+# Chat turns per user that may be running or waiting at once, and how long one waits for its turn.
+CHAT_TURNS_PER_USER = int(os.getenv("CHAT_TURNS_PER_USER", "2"))
+CHAT_TURN_WAIT_SECONDS = float(os.getenv("CHAT_TURN_WAIT_SECONDS", "60"))
+CLEANUP_SWEEP_INTERVAL_SECONDS = float(os.getenv("CLEANUP_SWEEP_INTERVAL_SECONDS", "300"))
+CLEANUP_BATCH_SIZE = int(os.getenv("CLEANUP_BATCH_SIZE", "500"))
+LOCAL_INTENTS_ENABLED = os.getenv("LOCAL_INTENTS_ENABLED", "1") == "1"
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "600"))
+LLM_CACHE_HISTORY_MESSAGES = int(os.getenv("LLM_CACHE_HISTORY_MESSAGES", "2"))
+IMPORT_MAX_ITEMS = int(os.getenv("IMPORT_MAX_ITEMS", "2000"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(5 * 1024 * 1024)))
+IMPORT_MAX_ERRORS = 50  # how many rejected records are listed back to the user
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "1024"))
+FEED_CACHE_TTL_SECONDS = float(os.getenv("FEED_CACHE_TTL_SECONDS", "3600"))
+# How long a cached feed is served before checking (with one small read) that its data version is current.
+FEED_CHECK_SECONDS = float(os.getenv("FEED_CHECK_SECONDS", "60"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))  # 0 turns the slow-request log off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+INDEX_CHECK_INTERVAL_SECONDS = float(os.getenv("INDEX_CHECK_INTERVAL_SECONDS", "86400"))
+# /events is served by its own gevent process (events_wsgi.py), where an open
+# stream costs a greenlet. EVENTS_INLINE=1 serves it from this app instead, where
+# each open stream holds one of the request threads, so far fewer fit.
+EVENTS_INLINE = os.getenv("EVENTS_INLINE", "0") == "1"
+LIVE_UPDATES = os.getenv("LIVE_UPDATES", "1") == "1"  # 0 if nothing serves /events; the page then re-fetches
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", "4" if EVENTS_INLINE else "2000"))
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "2"))  # how soon other processes' writes are noticed
+EVENTS_PING_SECONDS = float(os.getenv("EVENTS_PING_SECONDS", "15"))
+EVENTS_STREAM_SECONDS = float(os.getenv("EVENTS_STREAM_SECONDS", "300"))  # then the browser reconnects
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("smart_scheduler")
+
+# Initialize extensions (bound to the app in create_app())
+bcrypt = Bcrypt()
+
+# The OpenAI client (and its pooled, keep-alive HTTP client) is created on
+# first use in each process, like the MongoClient in storage.py, so nothing
+# connects at import and forked workers never share connections.
+_openai_client = None
+_openai_lock = threading.Lock()
+
+
+def _forget_openai_client():
+    global _openai_client, _openai_lock
+    _openai_client, _openai_lock = None, threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_openai_client)
+
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _openai_lock:
+            if _openai_client is None:
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY,
+                                        max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                                        keepalive_expiry=60),
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0),
+                )
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client,
+                                        timeout=OPENAI_TIMEOUT_SECONDS, max_retries=OPENAI_MAX_RETRIES)
+    return _openai_client
+
+# At most LLM_MAX_CONCURRENCY calls wait on OpenAI at once.
+llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+
+# A synchronous chat holds its request thread for the whole request: while
+# the model answers, while it waits for the user's earlier turn and while it
+# waits on an identical message in flight. So at most CHAT_REQUEST_THREADS of
+# them are in flight at once, running or waiting, always LLM_RESERVED_THREADS
+# below the worker's thread count. One that finds them all taken is turned
+# away at once, so chat traffic can never starve /get_schedule or the auth
+# routes. Offloaded chats (`Prefer: respond-async`) run on `chat_workers`
+# instead and only hold a request thread to be queued.
+chat_request_threads = threading.BoundedSemaphore(CHAT_REQUEST_THREADS)
+chat_workers = BoundedExecutor(CHAT_WORKERS, CHAT_QUEUE_MAX, name="chat")
+
+
+class LLMBusyError(Exception):
+    """Raised when every upstream LLM slot is busy."""
+
+
+class LLMRateLimitedError(LLMBusyError):
+    """Raised right away when the LLM token bucket is empty."""
+
+    def __init__(self, retry_after):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+llm_bucket = TokenBucket(LLM_RATE_PER_SECOND, LLM_BURST) if LLM_RATE_PER_SECOND > 0 else None
+
+# One chat turn per user at a time; identical messages in flight share one turn.
+chat_turns = TurnGate(max_queued=CHAT_TURNS_PER_USER, wait_seconds=CHAT_TURN_WAIT_SECONDS)
+
+
+def take_llm_token():
+    """Sheds the call (LLMRateLimitedError) if the token bucket for OpenAI calls is empty."""
+    if llm_bucket is not None and not llm_bucket.try_acquire():
+        llm_requests.inc(outcome="shed")
+        raise LLMRateLimitedError(llm_bucket.retry_after())
+
+
+# Model answers to repeated questions, keyed on what the model would have seen.
+llm_cache = TTLCache(max_entries=LLM_CACHE_SIZE, ttl_seconds=LLM_CACHE_TTL_SECONDS, name="llm")
+
+# Rendered calendar feeds by feed token, one per data version.
+feed_cache = TTLCache(max_entries=FEED_CACHE_SIZE, ttl_seconds=FEED_CACHE_TTL_SECONDS, name="feeds")
 
-# Initialize extensions
-bcrypt = Bcrypt(app)
-app.secret_key = SECRET_KEY
-
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
-db = client["SmartSchedule"]
-users_collection = db["users"]
-
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Tool calls that only read data can be replayed from the cache; replaying a
+# write (reschedule_day) or a replan (run_planner_engine) would run it again.
+REPLAYABLE_TOOLS = {"get_daily_plan", "get_priority_list"}
 
 # === START OF CHANGE: UPDATED SYSTEM PROMPT ===
 SYSTEM_PROMPT = """
@@ -270,67 +440,70 @@ tools = [
     }
 ]
 
+# The tools the model is offered; anything else it names is reported as "unknown".
+available_functions = {tool["function"]["name"] for tool in tools}
+
 
 # ---------- AUTH ROUTES ----------
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        if users_collection.find_one({"username": username}):
+        if users_collection.find_one({"username": username}, {"_id": 1}):
             return "Username already exists!"
         hashed_pw = bcrypt.generate_password_hash(password).decode("utf-8")
 
-        users_collection.insert_one({
-            "username": username, "password": hashed_pw,
-            "schedule": [], "tasks": [], "tests": [],
-            "preferences": {"awake_time": "07:00", "sleep_time": "23:00"},  # Default values
-            "chat_history": [],
-            "study_windows": [],
-            "generated_plan": []
-        })
+        try:
+            users_collection.insert_one({
+                "username": username, "password": hashed_pw,
+                "schedule": [], "tasks": [], "tests": [],
+                "preferences": {"awake_time": "07:00", "sleep_time": "23:00"},  # Default values
+                "study_windows": [], "data_version": 0
+            })
+        except DuplicateKeyError:
+            return "Username already exists!"
 
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     return render_template("signup.html")
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        user = users_collection.find_one({"username": username})
+        user = get_user(username, AUTH_FIELDS)
         if user and bcrypt.check_password_hash(user["password"], password):
             session["username"] = username
-            users_collection.update_one(
-                {"username": username},
-                {"$set": {"chat_history": []}}
-            )
-            return redirect(url_for("index"))
+            if migrate_legacy_user(username):
+                request_replan(username, [{"op": "full"}])
+            clear_chat_history(username)
+            return redirect(url_for("main.index"))
         return "Invalid credentials!"
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     if "username" in session:
-        users_collection.update_one(
-            {"username": session["username"]},
-            {"$set": {"chat_history": []}}
-        )
+        clear_chat_history(session["username"])
     session.pop("username", None)
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
 
 
 # ---------- MAIN APP ROUTES (Chat and Schedule) ----------
-@app.route("/")
+@bp.route("/")
 def index():
     if "username" not in session:
-        return redirect(url_for("login"))
-    return render_template("index.html", username=session["username"])
+        return redirect(url_for("main.login"))
+    # Sessions that predate the current storage layout get migrated on their next page load.
+    if migrate_legacy_user(session["username"]):
+        request_replan(session["username"], [{"op": "full"}])
+    return render_template("index.html", username=session["username"], live_updates=LIVE_UPDATES)
 
 
-@app.route("/save_personalization", methods=["POST"])
+@bp.route("/save_personalization", methods=["POST"])
 def save_personalization():
     if "username" not in session:
         return jsonify({"error": "Not logged in"}), 401
@@ -339,202 +512,418 @@ def save_personalization():
     data = request.json
 
     try:
-        # 1. Save Preferences
+        # 1 & 2. Save Preferences and Study Windows in a single write
+        uow = UnitOfWork(username)
         preferences = data.get("preferences", {})
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"preferences": preferences}}
-        )
-
-        # 2. Save Study Windows
+        uow.update_user({"$set": {"preferences": preferences}})
         windows = data.get("study_windows", [])
-        save_study_windows_db(username, {"windows": windows})  # Use existing function
+        save_study_windows_db(username, {"windows": windows}, uow)  # Use existing function
+        uow.commit()
 
-        # 3. Re-run the planner engine
-        planner_response = run_planner_engine_db(username, {})
+        # 3. Re-run the planner engine in the background
+        planner_status = request_replan(username, [{"op": "full"}])
 
-        return jsonify({"reply": f"Settings saved! {planner_response}"})
+        return jsonify({"reply": "Settings saved! I'm updating your study plan.",
+                        "planner": planner_status})
 
     except Exception as e:
-        print(f"Error in /save_personalization: {e}")
+        logger.exception("Error in /save_personalization")
         return jsonify({"reply": "Sorry, there was an error saving your settings."}), 500
 
 
+def peek_upload(stream, size=64):
+    """The first bytes of an upload, for format sniffing, if the stream can be rewound."""
+    try:
+        head = stream.read(size)
+        stream.seek(0)
+        return head
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+@bp.route("/import", methods=["POST"])
+def import_items():
+    """
+    Adds many classes, tasks and tests at once from an iCalendar, CSV or JSON
+    file (a multipart "file" upload, or the raw request body). The file is
+    parsed and validated in one pass, everything is written in a single
+    update, and the planner runs once afterwards. Items the user already has,
+    and ones that are already over, are skipped.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    username = session["username"]
+    if request.content_length and request.content_length > IMPORT_MAX_BYTES:
+        return jsonify({"error": f"The file is too large (limit {IMPORT_MAX_BYTES // 1024} KB)."}), 413
+
+    upload = request.files.get("file")
+    if upload is not None:
+        stream, filename, content_type = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, content_type = request.stream, None, request.mimetype
+    file_format = (request.args.get("format") or "").lower()
+    if not file_format:
+        head = peek_upload(stream) if upload is not None else None
+        file_format = detect_format(filename, content_type, head or b"")
+    if file_format not in FORMATS:
+        return jsonify({"error": f"Unsupported format; use one of {', '.join(FORMATS)}."}), 400
+
+    uow = UnitOfWork(username)
+    seen = {item_key(kind, item) for kind, field in KIND_FIELDS.items() for item in uow.user.get(field, [])}
+    new_items = {field: [] for field in KIND_FIELDS.values()}
+    skipped = {"duplicate": 0, "past": 0, "completed": 0}
+    errors = []
+    error_count = 0
+    total = 0
+    try:
+        with metrics.span("import.parse", format=file_format):
+            for number, kind, item, problem in parse_import(stream, file_format):
+                if kind is None:
+                    error_count += 1
+                    if len(errors) < IMPORT_MAX_ERRORS:
+                        errors.append({"line": number, "error": problem})
+                    continue
+                if problem:
+                    skipped[problem] += 1
+                    continue
+                key = item_key(kind, item)
+                if key in seen:
+                    skipped["duplicate"] += 1
+                    continue
+                seen.add(key)
+                total += 1
+                if total > IMPORT_MAX_ITEMS:
+                    return jsonify({"error": f"Too many items; import at most {IMPORT_MAX_ITEMS} at a time."}), 413
+                new_items[KIND_FIELDS[kind]].append({**item, "id": new_item_id()})
+    except ImportFileError as e:
+        return jsonify({"error": str(e)}), 400
+
+    imported = {"classes": len(new_items["schedule"]), "tasks": len(new_items["tasks"]),
+                "tests": len(new_items["tests"])}
+    result = {"imported": imported, "skipped": skipped, "errors": errors, "error_count": error_count}
+    if not total:
+        # Nothing new; only an error if nothing in the file was even readable.
+        return jsonify(result), 400 if error_count and not any(skipped.values()) else 200
+
+    # One $push per array, merged by the unit of work into a single update of the user document.
+    for field, items in new_items.items():
+        if items:
+            uow.update_user({"$push": {field: {"$each": items}}})
+    uow.commit()
+    result["planner"] = request_replan(username, [{"op": "full"}])
+    return jsonify(result)
+
+
+# (array field, name field) for each kind of item a user can refer to by name
+ITEM_FIELDS = (("tasks", "name"), ("tests", "name"), ("schedule", "subject"))
+
+
+def find_items(user, name, item_fields=ITEM_FIELDS):
+    """
+    Resolves a name from the user (or the model) to the items it refers to, as
+    a list of (field, item). Exact matches win; otherwise a case-insensitive
+    exact match is used. Never matches on substrings.
+    """
+    if not name:
+        return []
+    exact = []
+    folded = []
+    for field, name_field in item_fields:
+        for item in user.get(field, []):
+            item_name = item.get(name_field)
+            if item_name == name:
+                exact.append((field, item))
+            elif isinstance(item_name, str) and item_name.casefold() == name.casefold():
+                folded.append((field, item))
+    return exact or folded
+
+
+def item_filter(item, name_field):
+    """Matches `item` by its id (or by name, for items saved before items had ids)."""
+    if item.get("id"):
+        return {"id": item["id"]}
+    return {name_field: item.get(name_field)}
+
+
+def pull_condition(filters):
+    """Combines item_filter() results into one $pull condition."""
+    if len(filters) == 1:
+        return filters[0]
+    if all(list(f) == ["id"] for f in filters):
+        return {"id": {"$in": [f["id"] for f in filters]}}
+    return {"$or": filters}
+
+
 # --- This is our "ADD" function ---
-def update_user_data(username, data_type, data):
-    if data_type == "class":
-        users_collection.update_one({"username": username}, {"$push": {"schedule": data}})
-    elif data_type == "task":
-        users_collection.update_one({"username": username}, {"$push": {"tasks": data}})
-    elif data_type == "test":
-        users_collection.update_one({"username": username}, {"$push": {"tests": data}})
-    elif data_type == "preference":
-        users_collection.update_one({"username": username}, {"$set": {"preferences": data}})
-        return f"Got it! I've saved your awake time as {data['awake_time']} and sleep time as {data['sleep_time']}."
+def update_user_data(username, data_type, data, uow=None):
+    field = {"class": "schedule", "task": "tasks", "test": "tests"}.get(data_type)
+    with unit_of_work(username, uow) as uow:
+        if field:
+            data = {**data, "id": new_item_id()}
+            uow.update_user({"$push": {field: data}})
+            if uow.loaded_user is not None:
+                uow.loaded_user.setdefault(field, []).append(data)
+        elif data_type == "preference":
+            uow.update_user({"$set": {"preferences": data}})
+            if uow.loaded_user is not None:
+                uow.loaded_user["preferences"] = data
+            return f"Got it! I've saved your awake time as {data['awake_time']} and sleep time as {data['sleep_time']}."
 
     return f"OK, I've added the new {data_type} to your schedule."
 
 
-# === START OF FUNCTION CHANGE: Replaced 'update_task_deadline_db' ===
-def update_task_details_db(username, args):
+def update_task_details_db(username, args, uow=None):
     current_name = args.get("current_name")
     new_name = args.get("new_name")
     new_type = args.get("new_task_type")
     new_deadline = args.get("new_deadline")
 
-    # 1. Build the update dictionary dynamically
-    updates = {}
+    # 1. Build the changes dynamically
+    changes = {}
     if new_name:
-        updates["tasks.$.name"] = new_name
+        changes["name"] = new_name
     if new_type:
-        updates["tasks.$.task_type"] = new_type
+        changes["task_type"] = new_type
     if new_deadline:
-        updates["tasks.$.deadline"] = new_deadline
+        changes["deadline"] = new_deadline
 
-    if not updates:
+    if not changes:
         return "You didn't tell me what to update (name, type, or deadline)!"
 
-    # 2. Perform the main update on the 'tasks' array
-    result = users_collection.update_one(
-        {"username": username, "tasks.name": current_name},
-        {"$set": updates}
-    )
-
-    if result.modified_count == 0:
-        return f"Sorry, I couldn't find a task named '{current_name}' to update."
-
-    # 3. CASCADING RENAME: If the name changed, update the generated_plan too.
-    # We use arrayFilters to find ALL plan items that matched the old name.
-    if new_name:
-        # This complex query updates any plan item where 'task' contains the old name
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"generated_plan.$[elem].task": f"Work on {new_name}"}},
-            array_filters=[{"elem.task": {"$regex": current_name, "$options": "i"}}]
+    with unit_of_work(username, uow) as uow:
+        matches = find_items(uow.user, current_name, [("tasks", "name")])
+        if not matches:
+            return f"Sorry, I couldn't find a task named '{current_name}' to update."
+        task = matches[0][1]
+
+        # 2. Update that entry in the 'tasks' array
+        elem = uow.array_filter_name()
+        uow.update_user(
+            {"$set": {f"tasks.$[{elem}].{key}": value for key, value in changes.items()}},
+            array_filters=[{f"{elem}.{key}": value for key, value in item_filter(task, "name").items()}]
         )
+        task.update(changes)
+
+        # 3. CASCADING RENAME: If the name changed, retitle the task's plan blocks too.
+        if new_name and task.get("id"):
+            uow.update_plans(
+                {"username": username, "blocks.item_id": task["id"]},
+                {"$set": {"blocks.$[block].task": f"Work on {new_name}"}},
+                array_filters=[{"block.item_id": task["id"]}]
+            )
 
     return f"OK, I've updated the details for '{new_name or current_name}'."
 
 
-# === END OF FUNCTION CHANGE ===
-
-
 # --- This is our "UPDATE CLASS" function ---
-def update_class_schedule_db(username, args):
+def update_class_schedule_db(username, args, uow=None):
     subject = args.get("subject")
-    updates_to_make = {}
+    changes = {}
     if "new_day" in args:
-        updates_to_make["schedule.$.day"] = args["new_day"]
+        changes["day"] = args["new_day"]
     if "new_start_time" in args:
-        updates_to_make["schedule.$.start_time"] = args["new_start_time"]
+        changes["start_time"] = args["new_start_time"]
     if "new_end_time" in args:
-        updates_to_make["schedule.$.end_time"] = args["new_end_time"]
-    if not updates_to_make:
+        changes["end_time"] = args["new_end_time"]
+    if not changes:
         return "Sorry, you need to provide what you want to change (the day, start time, or end time)."
-    result = users_collection.update_one(
-        {"username": username, "schedule.subject": subject},
-        {"$set": updates_to_make}
-    )
-    if result.modified_count > 0:
-        return f"OK, I've updated your '{subject}' class."
-    else:
-        return f"Sorry, I couldn't find a class with the subject '{subject}' to update."
+
+    with unit_of_work(username, uow) as uow:
+        matches = find_items(uow.user, subject, [("schedule", "subject")])
+        if not matches:
+            return f"Sorry, I couldn't find a class with the subject '{subject}' to update."
+        item = matches[0][1]
+        elem = uow.array_filter_name()
+        uow.update_user(
+            {"$set": {f"schedule.$[{elem}].{key}": value for key, value in changes.items()}},
+            array_filters=[{f"{elem}.{key}": value for key, value in item_filter(item, "subject").items()}]
+        )
+        item.update(changes)
+    return f"OK, I've updated your '{subject}' class."
 
 
 # --- This is your NEW function ---
-def delete_schedule_item_db(username, args):
+def delete_schedule_item_db(username, args, uow=None):
     item_name = args.get("item_name")
 
-    # 1. Delete from 'schedule' (Classes)
-    result_class = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"schedule": {"subject": item_name}}}
-    )
-    # 2. Delete from 'tasks'
-    result_task = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"tasks": {"name": item_name}}}
-    )
-    # 3. Delete from 'tests'
-    result_test = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"tests": {"name": item_name}}}
-    )
-
-    # 4. NEW: Delete from 'generated_plan' (Cascading Delete)
-    # We use $regex to find any plan item where the 'task' field *contains*
-    # the item_name. '$options: "i"' makes it case-insensitive.
-    result_plan = users_collection.update_one(
-        {"username": username},
-        {"$pull": {"generated_plan": {"task": {"$regex": item_name, "$options": "i"}}}}
-    )
+    with unit_of_work(username, uow) as uow:
+        user = uow.user
+        matches = find_items(user, item_name)
+        if not matches:
+            return f"Sorry, I couldn't find an item named '{item_name}' to delete."
+
+        # 1-3. Delete the matching classes, tasks and tests in one update
+        name_fields = dict(ITEM_FIELDS)
+        pulls = {}
+        for field, item in matches:
+            pulls.setdefault(field, []).append(item_filter(item, name_fields[field]))
+        uow.update_user({"$pull": {field: pull_condition(filters) for field, filters in pulls.items()}})
+        deleted = {id(item) for _, item in matches}
+        for field in pulls:
+            user[field] = [item for item in user.get(field, []) if id(item) not in deleted]
+
+        # 4. Delete their blocks from 'generated_plan' (Cascading Delete)
+        item_ids = [item["id"] for _, item in matches if item.get("id")]
+        if item_ids:
+            uow.update_plans(
+                {"username": username, "blocks.item_id": {"$in": item_ids}},
+                {"$pull": {"blocks": {"item_id": {"$in": item_ids}}}}
+            )
 
-    # 5. NEW: Update the 'if' check to include result_plan
-    if (result_class.modified_count > 0 or
-            result_task.modified_count > 0 or
-            result_test.modified_count > 0 or
-            result_plan.modified_count > 0):
-        return f"OK, I've deleted '{item_name}' and any related schedule blocks."
-    else:
-        return f"Sorry, I couldn't find an item named '{item_name}' to delete."
+    return f"OK, I've deleted '{item_name}' and any related schedule blocks."
 
 
 # --- NEW PLANNING FUNCTIONS ---
 
 # === START OF NEW AUTO-CLEANUP FUNCTION ===
+def past_items_pull(now):
+    """The $pull that removes tasks and tests that are in the past."""
+    return {
+        "tasks": {"deadline": {"$lt": now.isoformat()}},
+        "tests": {"date": {"$lt": now.strftime("%Y-%m-%d")}}
+    }
+
+
+def needs_cleanup(now):
+    """Users not cleaned up yet today, or with tasks/tests that have become past since."""
+    today_date_str = now.strftime("%Y-%m-%d")
+    return {"$or": [{"cleaned_through": {"$lt": today_date_str}},
+                    {"cleaned_through": {"$exists": False}},
+                    {"tasks.deadline": {"$lt": now.isoformat()}},
+                    {"tests.date": {"$lt": today_date_str}}]}
+
+
+@metrics.timed("cleanup.user")
 def auto_cleanup_past_items(username):
     """
-    Finds and removes tasks, tests, and plan items that are in the past.
-    This is an efficient "housekeeping" function.
+    Finds and removes tasks, tests, and plan items that are in the past, and
+    records today as the user's `cleaned_through` watermark. Normally the
+    background sweeper does this for everyone; reads only call it for users
+    the sweeper hasn't reached yet today.
     """
     try:
-        now_iso = datetime.now().isoformat()
-        today_date_str = datetime.now().strftime("%Y-%m-%d")
+        now = datetime.now()
+        today_date_str = now.strftime("%Y-%m-%d")
 
-        # Use a single $pull operation to remove items from three different arrays
+        # Use a single $pull operation to remove items from both arrays
         # where their respective date/deadline is "less than" ($lt) the current time.
+        # Plan days go first so the version bump below covers them too.
+        result_plan = plans_collection.delete_many(
+            {"username": username, "date": {"$lt": today_date_str}}
+        )
         result = users_collection.update_one(
             {"username": username},
-            {
-                "$pull": {
-                    "tasks": {"deadline": {"$lt": now_iso}},
-                    "tests": {"date": {"$lt": today_date_str}},
-                    "generated_plan": {"date": {"$lt": today_date_str}}
-                }
-            }
+            {"$pull": past_items_pull(now), "$set": {"cleaned_through": today_date_str},
+             "$inc": {"data_version": 1}}
         )
+        invalidate_user(username)
 
-        modified_count = result.modified_count
-        # We can also check result.raw_result['nModified'] or result.matched_count
-        # For MongoDB, modified_count is the standard.
+        if result_plan.deleted_count > 0:
+            logger.info("Auto-cleanup ran for %s, removed old items.", username)
 
-        if modified_count > 0:
-            print(f"Auto-cleanup ran for {username}, removed old items.")
-        else:
-            print(f"Auto-cleanup ran for {username}, no old items to remove.")
+    except Exception:
+        logger.exception("Error during auto-cleanup for %s", username)
 
-    except Exception as e:
-        print(f"Error during auto-cleanup for {username}: {e}")
+
+@metrics.timed("cleanup.sweep")
+def sweep_past_items(batch_size=None):
+    """
+    Cleans up past items for every user not yet cleaned today or with a task
+    or test that has become past since, in batches of `batch_size` users with
+    one update_many / delete_many per batch. It runs every
+    CLEANUP_SWEEP_INTERVAL_SECONDS, so a deadline that passes during the day
+    disappears within minutes (and bumps the user's version, so open pages
+    and /events streams pick it up).
+    """
+    batch_size = batch_size or CLEANUP_BATCH_SIZE
+    now = datetime.now()
+    today_date_str = now.strftime("%Y-%m-%d")
+    stale = needs_cleanup(now)
+    swept = 0
+    while True:
+        usernames = [user["username"] for user in
+                     users_collection.find(stale, {"username": 1, "_id": 0}).limit(batch_size)]
+        if not usernames:
+            break
+        plans_collection.delete_many({"username": {"$in": usernames}, "date": {"$lt": today_date_str}})
+        users_collection.update_many(
+            {"username": {"$in": usernames}},
+            {"$pull": past_items_pull(now), "$set": {"cleaned_through": today_date_str},
+             "$inc": {"data_version": 1}}
+        )
+        for username in usernames:
+            invalidate_user(username)
+        swept += len(usernames)
+    if swept:
+        logger.info("Cleanup sweeper cleaned past items for %d users.", swept)
+    return swept
 
 
+cleanup_sweeper = PeriodicJob(sweep_past_items, CLEANUP_SWEEP_INTERVAL_SECONDS, name="cleanup-sweeper")
 # === END OF NEW AUTO-CLEANUP FUNCTION ===
 
 
-def save_study_windows_db(username, args):
+# --- Background jobs ---
+
+def create_indexes():
+    # Creates the indexes the storage layer relies on (no-op if they already exist).
+    try:
+        ensure_indexes()
+    except Exception as e:
+        logger.warning("Could not create MongoDB indexes: %s", e)
+
+
+# Off the request path, once per process and then daily, so startup never waits on MongoDB.
+index_setup = PeriodicJob(create_indexes, INDEX_CHECK_INTERVAL_SECONDS, name="index-setup")
+
+
+@bp.before_app_request
+def start_background_jobs():
+    index_setup.ensure_started()
+    cleanup_sweeper.ensure_started()
+
+
+# --- Request metrics ---
+
+http_seconds = metrics.histogram("smartscheduler_http_request_seconds", "Time to handle an HTTP request.")
+
+
+@bp.before_app_request
+def start_request_timer():
+    request.environ["smartscheduler.started"] = time.perf_counter()
+    request.environ["smartscheduler.spans"] = metrics.start_request_spans()
+
+
+@bp.after_app_request
+def record_request_time(response):
+    started = request.environ.get("smartscheduler.started")
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    spans = metrics.end_request_spans(request.environ.pop("smartscheduler.spans"))
+    # Streamed bodies are still being produced here; this times the handler, not the whole stream.
+    http_seconds.observe(seconds, endpoint=request.endpoint or "unknown", method=request.method,
+                         status=response.status_code)
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        breakdown = ", ".join(f"{name}={elapsed * 1000:.1f}ms" for name, elapsed in spans)
+        logger.warning("Slow request %s %s took %.1fms (%s)", request.method, request.path,
+                       seconds * 1000, breakdown or "no spans")
+    return response
+
+
+def save_study_windows_db(username, args, uow=None):
     windows = args.get("windows", [])
-    users_collection.update_one(
-        {"username": username},
-        {"$set": {"study_windows": windows}}
-    )
+    with unit_of_work(username, uow) as uow:
+        uow.update_user({"$set": {"study_windows": windows}})
+        if uow.loaded_user is not None:
+            uow.loaded_user["study_windows"] = windows
     # Don't return text, as this will be called by another function
     return "Study windows saved."
 
 
 def get_daily_plan_db(username, args):
-    user_data = users_collection.find_one({"username": username})
-    generated_plan = user_data.get("generated_plan", [])
     today_str = datetime.now().strftime("%Y-%m-%d")
-    todays_plan_items = [item for item in generated_plan if item['date'] == today_str]
+    todays_plan_items = get_plan(username, date=today_str)
 
     if not todays_plan_items:
         return "You have no study blocks scheduled for today. Enjoy the break or ask me to plan something!"
@@ -544,100 +933,592 @@ def get_daily_plan_db(username, args):
     return f"Your default plan for today is: {plan_summary}."
 
 
-def get_priority_list_db(username, args):
-    hours = args.get("hours", 0)
-    user_data = users_collection.find_one({"username": username})
-    tasks = user_data.get("tasks", [])
-
-    if not tasks:
-        return "You have no pending tasks!"
-
+def get_priority_list_db(username, args, uow=None):
     try:
-        tasks.sort(key=lambda x: x['deadline'])
-    except Exception as e:
-        print(f"Could not sort tasks: {e}")
+        hours = float(args.get("hours") or 0)
+    except (TypeError, ValueError):
+        hours = 0
+    if hours <= 0:
+        return "How much time do you have? Tell me the number of hours and I'll pick what to work on."
+    # Inside a chat turn, use the turn's data so tasks added earlier in the turn count.
+    user_data = uow.user if uow is not None else (get_user_data(username) or {})
+
+    picks = priority_list(user_data.get("tasks", []), user_data.get("tests", []), round(hours * 60))
+    if not picks:
+        return "You have no pending tasks!"
 
-        # This is still a stub. A real version would estimate time.
-    priority_list_str = "Here is your priority list: " + ", ".join([t['name'] for t in tasks[:2]])
-    return priority_list_str
+    entries = []
+    for pick in picks:
+        minutes = f"{pick['minutes']} min" + (" to start on it" if pick["partial"] else "")
+        entries.append(f"{pick['label']} ({minutes}, due {pick['due'].strftime('%b %d %H:%M')})")
+    hours_label = f"{hours:g} hour" + ("" if hours == 1 else "s")
+    return f"Here is your priority list for the next {hours_label}: " + "; ".join(
+        f"{number}. {entry}" for number, entry in enumerate(entries, 1)) + "."
 
 
-def reschedule_day_db(username, args):
-    constraints = args.get("new_constraints", "No constraints")
-    # This is a stub for a very complex function.
-    new_task = "History (Memorization)" if "history" in constraints.lower() else "Quick Task Review"
-    return (f"No problem. Based on '{constraints}', "
-            f"I recommend you focus on: **{new_task}**. "
-            "I've moved your other scheduled items to 'Flex Time'.")
+@metrics.timed("planner.reschedule_day")
+def reschedule_day_db(username, args, uow=None):
+    """
+    Re-plans only the rest of today for the constraints the user gave (e.g.
+    "only 1 hour at lunch, low-focus"), moving just the work that was already
+    planned for today. The rest of the plan is left alone and only today's
+    plan document is rewritten. The next full planner run goes back to the
+    usual study windows.
+    """
+    constraints_text = args.get("new_constraints", "")
+    with unit_of_work(username, uow) as uow:
+        user_data = uow.user
+        if not user_data:
+            return "Sorry, I couldn't find your data to reschedule today."
+
+        now = datetime.now()
+        today_str = now.strftime("%Y-%m-%d")
+        today_blocks = get_plan(username, date=today_str)
+        if not any(block["end_time"] > now.strftime("%H:%M") for block in today_blocks):
+            return "You don't have any study blocks left today, so there's nothing to move."
+
+        constraints = parse_day_constraints(constraints_text)
+        intervals = free_today(constraints, user_data.get("schedule", []), user_data.get("preferences", {}),
+                               user_data.get("study_windows", []), now)
+        blocks, unplaced = reschedule_today(today_blocks, user_data.get("tasks", []),
+                                            user_data.get("tests", []), intervals, now)
+        if blocks != today_blocks:
+            uow.write_plan_day(today_str, blocks)
+
+    upcoming = [block for block in blocks if block["end_time"] > now.strftime("%H:%M")]
+    if not upcoming:
+        reply = f"No problem. Based on '{constraints_text}', I've cleared the rest of today's study blocks."
+    else:
+        plan_summary = ", ".join(
+            f"{block['task']} from {block['start_time']} to {block['end_time']}" for block in upcoming)
+        reply = f"No problem. Based on '{constraints_text}', here is your new plan for today: {plan_summary}."
+    if unplaced:
+        names = ", ".join(sorted({item["name"] for item in unplaced}))
+        reply += f" Not everything fits today ({names}); ask me to update your plan to spread it over the next days."
+    return reply
 
 
+@metrics.timed("planner.full")
 def run_planner_engine_db(username, args):
-    # This is a stub for your *main planning logic*.
-    user_data = users_collection.find_one({"username": username})
-    tasks = user_data.get("tasks", [])
-    if not tasks:
+    user_data = get_fresh_user_data(username)
+    if not user_data:
+        return "Planner ran into an error: user not found."
+    if not user_data.get("tasks") and not user_data.get("tests"):
+        replace_plan(username, [])
         return "Planner ran, but you have no tasks to plan for."
     try:
-        tasks.sort(key=lambda x: x['deadline'])
-        soonest_task = tasks[0]
-        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-
-        new_plan = [
-            {
-                "date": tomorrow,
-                "start_time": "19:00",
-                "end_time": "20:00",
-                "task": f"Work on {soonest_task['name']}"
-            }
-        ]
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"generated_plan": new_plan}}
+        new_plan, unfinished = build_plan(
+            user_data.get("schedule", []),
+            user_data.get("tasks", []),
+            user_data.get("tests", []),
+            user_data.get("preferences", {}),
+            user_data.get("study_windows", []),
+            horizon_days=PLANNER_HORIZON_DAYS,
         )
-        return "I've regenerated your study plan."
+        # Days that come out the same keep their version, so clients don't refetch them.
+        removed, added = diff_plan(get_plan(username), new_plan)
+        write_plan_dates(username, new_plan, {block["date"] for block in removed + added})
+        reply = f"I've regenerated your study plan ({len(new_plan)} study blocks)."
+        if unfinished:
+            names = ", ".join(sorted({item["name"] for item in unfinished}))
+            reply += f" Heads up: there isn't enough free study time before the deadline for {names}."
+        return reply
 
     except Exception as e:
         return f"Planner ran into an error: {e}"
 
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    if "username" not in session:
-        return jsonify({"reply": "Error: Not logged in"}), 401
+def replan_start_date(changes, plan, tasks, tests, now):
+    """
+    The first plan date the changes can move (see first_affected_date()), or
+    None if they can't move any. A change that doesn't name the tasks/tests it
+    touched (e.g. a deleted class) re-plans from today.
+    """
+    changes = [change for change in changes if change.get("op") != "rename"]
+    if any(not change.get("item_ids") for change in changes):
+        return now.strftime("%Y-%m-%d")
+    dates = [change["from_date"] for change in changes if change.get("from_date")]
+    first = first_affected_date(plan, tasks, tests,
+                                {item_id for change in changes for item_id in change["item_ids"]}, now)
+    if first:
+        dates.append(first)
+    return min(dates) if dates else None
+
+
+@metrics.timed("planner.incremental")
+def replan_incremental_db(username, changes):
+    """
+    Re-plans after the given task/test changes. The days before the first one
+    the changes can move are kept as stored, the engine only runs from there,
+    and only the days whose blocks actually differ are rewritten. Each change
+    is a dict like {"kind": "task", "op": "add" | "update" | "rename" | "delete",
+    "name": ..., "item_ids": [...], "from_date": ...} (see _dispatch_tool_call()).
+    """
+    if not changes:
+        return "No changes to plan for."
+    if not changes_need_replan(changes):
+        return "Your study plan has been updated."
 
-    user_message = request.json.get("message")
-    selected_year = request.json.get("year", str(json.loads(os.getenv("CURRENT_DATE", '{"year": 2025}'))["year"]))
-    username = session["username"]
-    user_data = users_collection.find_one({"username": username})
+    user_data = get_fresh_user_data(username)
+    if not user_data:
+        return "Planner ran into an error: user not found."
+    try:
+        now = datetime.now()
+        old_plan = get_plan(username)
+        start_date = replan_start_date(changes, old_plan, user_data.get("tasks", []),
+                                       user_data.get("tests", []), now)
+        if start_date is None:
+            return "Your study plan didn't need to change."
+        new_plan, unfinished = replan_from(
+            user_data.get("schedule", []),
+            user_data.get("tasks", []),
+            user_data.get("tests", []),
+            user_data.get("preferences", {}),
+            user_data.get("study_windows", []),
+            old_plan,
+            start_date,
+            now=now,
+            horizon_days=PLANNER_HORIZON_DAYS,
+        )
+        removed, added = diff_plan(old_plan, new_plan)
+        changed_dates = sorted({block["date"] for block in removed + added})
+        # Only the days whose blocks changed are rewritten, in one round trip.
+        write_plan_dates(username, new_plan, changed_dates)
+
+        if not changed_dates:
+            reply = "Your study plan didn't need to change."
+        elif len(changed_dates) == 1:
+            reply = f"I've updated your study plan for {changed_dates[0]}."
+        else:
+            reply = f"I've updated your study plan ({len(changed_dates)} days changed, from {changed_dates[0]})."
+        if unfinished:
+            names = ", ".join(sorted({item["name"] for item in unfinished}))
+            reply += f" Heads up: there isn't enough free study time before the deadline for {names}."
+        return reply
+
+    except Exception as e:
+        return f"Planner ran into an error: {e}"
+
+
+def plan_change_for_tool(function_name, arguments):
+    """Describes how a data-entry tool call changes what the planner has to plan."""
+    if function_name == "save_task":
+        return {"kind": "task", "op": "add", "name": arguments.get("name")}
+    if function_name == "save_test":
+        return {"kind": "test", "op": "add", "name": arguments.get("name")}
+    if function_name == "update_task_details":
+        only_rename = arguments.get("new_name") and not (
+            arguments.get("new_task_type") or arguments.get("new_deadline"))
+        return {"kind": "task", "op": "rename" if only_rename else "update",
+                "name": arguments.get("new_name") or arguments.get("current_name"),
+                "old_name": arguments.get("current_name")}
+    if function_name == "delete_schedule_item":
+        return {"kind": "item", "op": "delete", "name": arguments.get("item_name")}
+    if function_name == "save_class":
+        return {"kind": "class", "op": "add", "name": arguments.get("subject")}
+    if function_name == "update_class_schedule":
+        return {"kind": "class", "op": "update", "name": arguments.get("subject")}
+    if function_name == "save_preference":
+        return {"kind": "preference", "op": "update"}
+    return None
+
+
+def planned_items(user):
+    """What the planner uses of each task and test, by id, to tell which ones a tool call changed."""
+    return {
+        item["id"]: (item.get("name"), item.get(type_field), item.get(date_field))
+        for field, type_field, date_field in (("tasks", "task_type", "deadline"), ("tests", "test_type", "date"))
+        for item in user.get(field, [])
+        if item.get("id")
+    }
+
+
+def planned_classes(user):
+    """The day and times of each class, by id, to tell which weekdays a tool call changed."""
+    return {
+        item["id"]: (item.get("day"), item.get("start_time"), item.get("end_time"))
+        for item in user.get("schedule", [])
+        if item.get("id")
+    }
+
+
+def first_class_date(days, now):
+    """
+    The first date from today that falls on one of these class days, or today
+    if any of them isn't a day the planner recognises.
+    """
+    weekdays = {weekday_index(day) for day in days}
+    if None in weekdays:
+        return now.strftime("%Y-%m-%d")
+    return min((now + timedelta(days=(weekday - now.weekday()) % 7)).strftime("%Y-%m-%d")
+               for weekday in weekdays)
+
+
+# --- BACKGROUND PLANNER QUEUE ---
+# Every trigger within a chat turn (or a short window) is merged into one
+# planner run per user, executed off the request thread. Progress is kept in
+# the user's `planner_status` so any request can tell when the plan is ready.
+
+def set_planner_status(username, state, message=None):
+    users_collection.update_one(
+        {"username": username},
+        {"$set": {"planner_status": {
+            "state": state,
+            "message": message,
+            "updated_at": datetime.now().isoformat(timespec="seconds")
+        }}}
+    )
+
+
+def run_planner_job(username, changes):
+    set_planner_status(username, "running")
+    if any(change.get("op") == "full" for change in changes):
+        reply = run_planner_engine_db(username, {})
+    else:
+        reply = replan_incremental_db(username, changes)
+
+    # Under the queue's lock for this user, so a replan requested meanwhile
+    # either shows up here as pending or writes its "queued" after us.
+    with planner_jobs.locked(username):
+        if planner_jobs.has_pending(username):
+            # Another run is already queued behind this one; the plan isn't final yet.
+            set_planner_status(username, "queued")
+        elif reply.startswith("Planner ran into an error"):
+            set_planner_status(username, "error", reply)
+        else:
+            set_planner_status(username, "ready", reply)
+
+
+planner_jobs = CoalescingJobQueue(
+    handler=run_planner_job,
+    merge=lambda pending, new: pending + new,
+    debounce_seconds=PLANNER_DEBOUNCE_SECONDS,
+    max_workers=PLANNER_WORKERS,
+    name="planner",
+)
+
+
+def request_replan(username, changes):
+    """Queues a (coalesced) planner run for the user and returns the status to show the client."""
+    with planner_jobs.locked(username):
+        planner_jobs.submit(username, list(changes))
+        set_planner_status(username, "queued")
+    return {"status": "queued"}
 
+
+@bp.route("/planner_status")
+def get_planner_status():
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    user_data = users_collection.find_one(
+        {"username": session["username"]},
+        {"planner_status": 1, "_id": 0}
+    )
     if not user_data:
-        session.pop("username", None)
-        return jsonify({"reply": "Error: Your user data was not found. Please log in again."}), 401
+        return jsonify({"error": "User not found"}), 404
 
-    # Get the *entire* chat history
-    old_full_history = user_data.get("chat_history", [])
+    status = user_data.get("planner_status") or {"state": "ready"}
+    return jsonify({"status": status.get("state"), "message": status.get("message"),
+                    "updated_at": status.get("updated_at")})
 
-    # === START OF RESTRUCTURED MESSAGE LOGIC ===
 
-    # 1. Get today's date
-    today_string = datetime.now().strftime("%A, %B %d, %Y")
+def cache_metrics():
+    caches = (user_cache, llm_cache, feed_cache)
+    stats = {cache.name: cache.stats() for cache in caches}
+    lines = metrics.gauge_lines("smartscheduler_cache_entries", "Entries currently cached.",
+                                {(("cache", name),): values["entries"] for name, values in stats.items()})
+    for stat, help_text in (("hits", "Cache hits."), ("misses", "Cache misses."),
+                            ("evictions", "Entries evicted for space."),
+                            ("invalidations", "Entries dropped after a write.")):
+        lines.extend(metrics.gauge_lines(
+            f"smartscheduler_cache_{stat}_total", help_text,
+            {(("cache", name),): values[stat] for name, values in stats.items()}, kind="counter"))
+    return lines
+
+
+metrics.register_collector(cache_metrics)
+
+
+def metrics_authorized():
+    return not METRICS_TOKEN or request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+
+
+@bp.route("/metrics")
+def get_metrics():
+    """Prometheus text exposition of this process's metrics."""
+    if not metrics_authorized():
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
-    # 2. Get the user's FRESH data
-    fresh_context_data = {
+@bp.route("/cache_stats")
+def get_cache_stats():
+    """Hit/miss counters of this process's caches. Same METRICS_TOKEN check as /metrics."""
+    if not metrics_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"users": user_cache.stats(), "llm": llm_cache.stats(), "feeds": feed_cache.stats()})
+
+
+def estimate_tokens(message):
+    """Cheap token estimate (~4 characters per token) for budgeting prompt size."""
+    size = len(message.get("content") or "")
+    if message.get("tool_calls"):
+        size += len(json.dumps(message["tool_calls"]))
+    return size // 4 + 4
+
+
+def bound_history(history, max_tokens):
+    """
+    Keeps the newest messages that fit in `max_tokens`, always starting at a
+    user message so assistant tool calls are never separated from their results.
+    """
+    total = 0
+    start = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        total += estimate_tokens(history[index])
+        if total > max_tokens:
+            break
+        start = index
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+    return history[start:]
+
+
+def report_context_tokens(username, user_data, context_message):
+    """Logs how many prompt tokens the compact context saved compared to sending the raw JSON."""
+    raw_context = {
         "schedule": user_data.get("schedule", []),
         "tasks": user_data.get("tasks", []),
         "tests": user_data.get("tests", []),
         "preferences": user_data.get("preferences", {}),
         "study_windows": user_data.get("study_windows", [])
     }
+    raw_tokens = estimate_tokens({"content": json.dumps(raw_context)})
+    sent_tokens = estimate_tokens(context_message)
+    saved = raw_tokens - sent_tokens
+    context_tokens.inc(sent_tokens, kind="sent")
+    context_tokens.inc(raw_tokens, kind="raw")
+    logger.debug("Context for %s: sent ~%d tokens instead of ~%d (saved ~%d).",
+                 username, sent_tokens, raw_tokens, saved)
+    return {"sent": sent_tokens, "raw": raw_tokens, "saved": saved}
+
+
+llm_requests = metrics.counter("smartscheduler_llm_requests_total", "Chat model calls by outcome.")
+llm_tokens = metrics.counter("smartscheduler_llm_tokens_total", "Tokens used by chat model calls.")
+context_tokens = metrics.counter("smartscheduler_context_tokens_total",
+                                 "Estimated context tokens sent to the model, and what the raw JSON would have been.")
+
+
+def record_llm_usage(usage):
+    if usage is None:
+        return
+    llm_tokens.inc(usage.prompt_tokens or 0, kind="prompt")
+    llm_tokens.inc(usage.completion_tokens or 0, kind="completion")
+
+
+def create_chat_completion(messages):
+    """Calls the chat model (non-streaming) inside the global rate and concurrency limits."""
+    take_llm_token()
+    if not llm_slots.acquire(timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+        llm_requests.inc(outcome="busy")
+        raise LLMBusyError()
+    try:
+        with metrics.span("openai.chat"):
+            response = get_openai_client().chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+        llm_requests.inc(outcome="ok")
+        record_llm_usage(response.usage)
+        return response
+    except Exception:
+        llm_requests.inc(outcome="error")
+        raise
+    finally:
+        llm_slots.release()
+
+
+def stream_chat_completion(messages):
+    """
+    Streams the chat model's response chunks. The concurrency slot is held
+    until the stream is fully read (or abandoned).
+    """
+    take_llm_token()
+    if not llm_slots.acquire(timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+        llm_requests.inc(outcome="busy")
+        raise LLMBusyError()
+    started = time.perf_counter()
+    first_chunk = True
+    outcome = "error"
+    try:
+        with get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            tools=tools,
+            tool_choice="auto",
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=OPENAI_TIMEOUT_SECONDS
+        ) as stream:
+            for chunk in stream:
+                if first_chunk:
+                    metrics.record_span("openai.chat_stream.first_chunk", time.perf_counter() - started)
+                    first_chunk = False
+                if getattr(chunk, "usage", None):
+                    record_llm_usage(chunk.usage)
+                yield chunk
+        outcome = "ok"
+    finally:
+        metrics.record_span("openai.chat_stream", time.perf_counter() - started)
+        llm_requests.inc(outcome=outcome)
+        llm_slots.release()
+
+
+BUSY_REPLY = "I'm helping a lot of people right now. Please try again in a moment."
+TURN_BUSY_REPLY = "I'm still working on your earlier messages. Please wait for my reply and try again."
+
+
+# --- ROLLING CHAT SUMMARY ---
+# Once enough turns pile up, a background job asks the model to fold the older
+# ones (and the previous summary) into a new summary and drops them from the
+# stored conversation. Chat requests only ever read the stored summary.
+
+SUMMARY_PREFIX = "Summary of the earlier conversation (older messages are not shown):"
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a student and their study-scheduling "
+    "assistant. Update the summary with the new messages. Keep what the student asked for, what was "
+    "added, changed or deleted, their stated preferences and anything still open. The student's current "
+    "classes, tasks and tests are sent separately, so don't list them. Answer with the summary only, "
+    "in at most {words} words."
+)
+
+
+def count_user_turns(messages):
+    return sum(1 for message in messages if message.get("role") == "user" and not is_context_message(message))
+
+
+def summary_split(messages, keep_turns):
+    """
+    Index where the newest `keep_turns` turns start; everything before it gets
+    summarized. A turn starts at its context message, if it has one, so a
+    context message is never separated from the turn it belongs to.
+    """
+    starts = [index for index, message in enumerate(messages)
+              if message.get("role") == "user" and not is_context_message(message)]
+    if len(starts) <= keep_turns:
+        return 0
+    split = starts[-keep_turns] if keep_turns else len(messages)
+    while split > 0 and is_context_message(messages[split - 1]):
+        split -= 1
+    return split
+
+
+def transcript(messages):
+    """The messages as plain text for the summarizer (context messages left out)."""
+    lines = []
+    for message in messages:
+        if is_context_message(message):
+            continue
+        role = message.get("role")
+        if role == "tool":
+            lines.append(f"Result of {message.get('name', 'tool')}: {message.get('content')}")
+            continue
+        if message.get("content"):
+            lines.append(f"{'Student' if role == 'user' else 'Assistant'}: {message['content']}")
+        for call in message.get("tool_calls") or []:
+            lines.append(f"Assistant called {call['function']['name']}({call['function']['arguments']})")
+    return "\n".join(lines)
+
+
+def summarize_messages(previous_summary, messages):
+    """Asks the model for the new rolling summary. Returns None if it can't right now."""
+    text = transcript(messages)
+    if not text:
+        return previous_summary
+    prompt = [
+        {"role": "system", "content": SUMMARY_PROMPT.format(words=CHAT_SUMMARY_MAX_TOKENS * 3 // 4)},
+        {"role": "user", "content": f"Summary so far: {previous_summary or '(none)'}\n\nNew messages:\n{text}"},
+    ]
+    # Background work doesn't hold a request thread, so it may wait a little for a slot, but gives up rather than queueing forever.
+    try:
+        take_llm_token()
+    except LLMRateLimitedError:
+        return None
+    if not llm_slots.acquire(timeout=LLM_QUEUE_TIMEOUT_SECONDS):
+        llm_requests.inc(outcome="busy")
+        return None
+    try:
+        with metrics.span("openai.summary"):
+            response = get_openai_client().chat.completions.create(
+                model=OPENAI_SUMMARY_MODEL,
+                messages=prompt,
+                max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+                timeout=OPENAI_TIMEOUT_SECONDS
+            )
+        llm_requests.inc(outcome="ok")
+        record_llm_usage(response.usage)
+    except Exception:
+        llm_requests.inc(outcome="error")
+        raise
+    finally:
+        llm_slots.release()
+    return (response.choices[0].message.content or "").strip() or previous_summary
+
+
+def summarize_chat_job(username, _):
+    state = get_chat_state(username)
+    messages = state.get("messages", [])
+    split = summary_split(messages, CHAT_SUMMARY_KEEP_TURNS)
+    if not split:
+        return
+    summary = summarize_messages(state.get("summary"), messages[:split])
+    if summary is None:
+        return
+    # If a turn was saved in the meantime this doesn't apply; that turn queued another run.
+    # Dropping a prefix never leaves a context delta without its base: when the
+    # full context goes, the next turn simply sends a full one again.
+    if save_chat_summary(username, state.get("revision"), summary, messages[split:]):
+        summaries_saved.inc()
+
+
+summaries_saved = metrics.counter("smartscheduler_chat_summaries_total", "Rolling chat summaries saved.")
+
+summary_jobs = CoalescingJobQueue(
+    handler=summarize_chat_job,
+    merge=lambda pending, new: new,
+    debounce_seconds=1.0,
+    max_workers=2,
+    name="chat-summary",
+)
+
+
+def build_chat_turn(username, user_data, user_message, selected_year):
+    """
+    Builds the messages to send to the model for one chat turn. Returns a dict
+    with the `messages`, where this turn's new messages start (`turn_start`)
+    and what has to be saved once the turn succeeds.
+    """
+    # Get the *entire* chat history and the context the model last saw
+    chat_state = get_chat_state(username)
+    old_full_history = chat_state.get("messages", [])
+
+    # 1. Get today's date
+    now = datetime.now()
+    today_string = now.strftime("%A, %B %d, %Y")
+
+    # 2. Encode the user's FRESH data as compact rows
+    context_data, later_items = context_rows(user_data, now, CONTEXT_HORIZON_DAYS)
+    ref = context_ref(context_data, selected_year)
 
     # 3. Create the "header" that MUST be sent every time.
     messages_header = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "system",
-         "content": f"CRITICAL: Today's date is {today_string}. Use this as the anchor for all date math."},
-        {"role": "user",
-         "content": f"Here is my current data. Assume all new dates are for the year {selected_year}. Context: {json.dumps(fresh_context_data)}"}
+         "content": f"CRITICAL: Today's date is {today_string}. Use this as the anchor for all date math."}
     ]
 
     # 4. Filter the old history to get *only* conversational turns.
@@ -648,139 +1529,863 @@ def chat():
     ]
 
     # 5. Handle Daily Check-in: If it's a check-in, wipe the conversation.
-    if user_message == "trigger:daily_checkin":
+    starting_over = user_message == "trigger:daily_checkin"
+    if starting_over:
         conversational_history = []
+    conversational_history = bound_history(conversational_history, CHAT_HISTORY_MAX_TOKENS)
+    # Turns older than the kept ones live on only in the rolling summary.
+    summary = None if starting_over else chat_state.get("summary")
+    if summary:
+        messages_header.append({"role": "system", "content": f"{SUMMARY_PREFIX} {summary}"})
+
+    # 6. Work out how much context the model needs. If the full context it saw
+    # earlier is still in the history, send only what changed since then.
+    snapshot = chat_state.get("context") or {}
+    if (snapshot.get("year") == selected_year and
+            has_base(conversational_history, snapshot.get("base_ref"))):
+        if snapshot.get("ref") == ref:
+            context_message = {"role": "user", "content": encode_unchanged(ref)}
+            new_snapshot = None
+        else:
+            context_message = {"role": "user",
+                               "content": encode_delta(snapshot.get("rows", []), context_data, snapshot["ref"], ref)}
+            new_snapshot = {"ref": ref, "base_ref": snapshot["base_ref"], "year": selected_year,
+                            "rows": list(context_data)}
+    else:
+        context_message = {"role": "user",
+                           "content": encode_full(context_data, ref, selected_year,
+                                                  CONTEXT_HORIZON_DAYS, later_items)}
+        new_snapshot = {"ref": ref, "base_ref": ref, "year": selected_year, "rows": list(context_data)}
+
+    context_tokens = report_context_tokens(username, user_data, context_message)
 
-    # 6. Build the *new* messages list to be used for this turn.
+    # 7. Build the *new* messages list to be used for this turn.
+    # Everything from `turn_start` on is new this turn and is all that gets saved.
+    # Full/delta context is saved so later turns can build on it; the
+    # "unchanged" reference is not.
     messages = messages_header + conversational_history
+    if new_snapshot is None:
+        messages.append(context_message)
+    turn_start = len(messages)
+    if new_snapshot is not None:
+        messages.append(context_message)
     messages.append({"role": "user", "content": user_message})
 
-    # === END OF RESTRUCTURED MESSAGE LOGIC ===
+    return {
+        "messages": messages,
+        "turn_start": turn_start,
+        "starting_over": starting_over,
+        "new_snapshot": new_snapshot,
+        "context_tokens": context_tokens,
+        "plan_changes": [],
+        "user_message": user_message,
+        "after_checkin": follows_checkin(conversational_history),
+        "stored_turns": 1 + (0 if starting_over else count_user_turns(old_full_history)),
+        "cache_key": llm_cache_key(username, user_message, ref, selected_year, today_string,
+                                   conversational_history) if LLM_CACHE_SIZE > 0 else None,
+        # Every write the turn's tool calls make, sent to MongoDB together at the end
+        "uow": UnitOfWork(username, user_data),
+    }
 
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,  # We send the newly constructed list
-            tools=tools,
-            tool_choice="auto"
-        )
-        response_message = response.choices[0].message
 
-        if response_message.tool_calls:
-            # Append the assistant's request to call tools
-            messages.append(response_message.model_dump(exclude={'function_call'}))
+def follows_checkin(history):
+    """True if the user's last message before this turn was the daily check-in trigger."""
+    for message in reversed(history):
+        if message.get("role") == "user" and not is_context_message(message):
+            return message.get("content") == DAILY_CHECKIN
+    return False
+
+
+def llm_cache_key(username, user_message, ref, year, today, history):
+    """
+    Hash of everything that decides the model's answer: the normalized
+    message, the user's data (its context ref), the year, today's date and
+    the last few conversational messages.
+    """
+    recent = [message for message in history if not is_context_message(message)]
+    recent = recent[-LLM_CACHE_HISTORY_MESSAGES:] if LLM_CACHE_HISTORY_MESSAGES else []
+    digest = hashlib.sha1()
+    for part in (OPENAI_MODEL, username, normalize(user_message), ref, str(year), today,
+                 json.dumps([[m.get("role"), m.get("name"), m.get("content")] for m in recent])):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def cached_assistant_message(turn):
+    """The cached assistant message for this turn (tool calls get fresh ids), or None."""
+    if not turn["cache_key"]:
+        return None
+    message = llm_cache.get(turn["cache_key"])
+    if message is None:
+        return None
+    message = copy.deepcopy(message)
+    for tool_call in message.get("tool_calls") or []:
+        tool_call["id"] = f"call_cached_{new_item_id()}"
+    return message
+
+
+def remember_assistant_message(turn, message):
+    """Caches the model's answer if it is plain text or only uses replayable tools."""
+    tool_calls = message.get("tool_calls") or []
+    if not turn["cache_key"] or not (tool_calls or message.get("content")):
+        return
+    if all(call["function"]["name"] in REPLAYABLE_TOOLS for call in tool_calls):
+        llm_cache.set(turn["cache_key"], {
+            "role": "assistant",
+            "content": message.get("content"),
+            **({"tool_calls": copy.deepcopy(tool_calls)} if tool_calls else {}),
+        })
+
+
+def local_assistant_message(turn):
+    """
+    The assistant message (in the OpenAI format) for a chat message the local
+    intent router can answer without the model, or None.
+    """
+    if not LOCAL_INTENTS_ENABLED:
+        return None
+    intent = route_message(turn["user_message"], turn["uow"].user, after_checkin=turn["after_checkin"])
+    if intent is None:
+        return None
+    message = {"role": "assistant", "content": intent["content"]}
+    if intent["tool_calls"]:
+        message["tool_calls"] = [
+            {"id": f"call_local_{new_item_id()}", "type": "function",
+             "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])}}
+            for call in intent["tool_calls"]
+        ]
+    return message
+
+
+def dispatch_tool_call(username, function_name, arguments, plan_changes, uow):
+    """
+    Runs one tool the model asked for and returns the message for the user.
+    Writes are queued on `uow` and committed once for the whole turn.
+    """
+    # Model output picks the name; keep the metric's label set bounded.
+    with metrics.span("tool", tool=function_name if function_name in available_functions else "unknown"):
+        return _dispatch_tool_call(username, function_name, arguments, plan_changes, uow)
+
+
+def _dispatch_tool_call(username, function_name, arguments, plan_changes, uow):
+    plan_change = plan_change_for_tool(function_name, arguments)
+    items_before = planned_items(uow.user) if plan_change else None
+    classes_before = planned_classes(uow.user) if plan_change else None
+    writes = uow.writes
+
+    if function_name == "save_preference":
+        response_msg_for_user = update_user_data(username, "preference", arguments, uow)
+    elif function_name == "save_class":
+        response_msg_for_user = update_user_data(username, "class", arguments, uow)
+    elif function_name == "save_task":
+        response_msg_for_user = update_user_data(username, "task", arguments, uow)
+    elif function_name == "save_test":
+        response_msg_for_user = update_user_data(username, "test", arguments, uow)
+    elif function_name == "update_task_details":
+        response_msg_for_user = update_task_details_db(username, arguments, uow)
+    elif function_name == "update_class_schedule":
+        response_msg_for_user = update_class_schedule_db(username, arguments, uow)
+    elif function_name == "delete_schedule_item":
+        response_msg_for_user = delete_schedule_item_db(username, arguments, uow)
+    elif function_name == "save_study_windows":
+        response_msg_for_user = save_study_windows_db(username, arguments, uow)
+        if uow.writes > writes:
+            plan_changes.append({"op": "full"})  # Also run planner
+    elif function_name == "get_daily_plan":
+        response_msg_for_user = get_daily_plan_db(username, arguments)
+    elif function_name == "get_priority_list":
+        response_msg_for_user = get_priority_list_db(username, arguments, uow)
+    elif function_name == "reschedule_day":
+        response_msg_for_user = reschedule_day_db(username, arguments, uow)
+    elif function_name == "run_planner_engine":
+        plan_changes.append({"op": "full"})
+        response_msg_for_user = "I'm regenerating your study plan now. It will show up on your calendar in a moment."
+    else:
+        response_msg_for_user = "Error: AI tried to call an unknown function."
+
+    # Only calls that actually wrote something (not e.g. "task not found") change the plan.
+    if plan_change and uow.writes > writes:
+        items_after = planned_items(uow.user)
+        changed = items_before.keys() | items_after.keys()
+        plan_change["item_ids"] = sorted(item_id for item_id in changed
+                                         if items_before.get(item_id) != items_after.get(item_id))
+        from_dates = []
+        deleted = items_before.keys() - items_after.keys()
+        if deleted:
+            # Their blocks are gone once the turn commits; remember where they started.
+            from_dates.append(first_plan_date(username, deleted, since=datetime.now().strftime("%Y-%m-%d")))
+        # A class only frees or takes time on its weekday (both days, if it moved).
+        classes_after = planned_classes(uow.user)
+        changed_days = [times[0]
+                        for class_id in classes_before.keys() | classes_after.keys()
+                        if classes_before.get(class_id) != classes_after.get(class_id)
+                        for times in (classes_before.get(class_id), classes_after.get(class_id)) if times]
+        if changed_days:
+            from_dates.append(first_class_date(changed_days, datetime.now()))
+        from_dates = [date for date in from_dates if date]
+        if from_dates:
+            plan_change["from_date"] = min(from_dates)
+        plan_changes.append(plan_change)
+    return response_msg_for_user
+
+
+def run_tool_calls(username, turn, tool_calls):
+    """
+    Runs the tool calls (dicts in the OpenAI message format) for this turn,
+    appending each result to the turn's messages. Yields (name, result) as each
+    one finishes.
+    """
+    for tool_call in tool_calls:
+        function_name = tool_call["function"]["name"]
+        try:
+            arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        except json.JSONDecodeError:
+            arguments = None
+        if arguments is None:
+            response_msg_for_user = "Error: AI sent invalid arguments for this tool."
         else:
-            # Append the assistant's simple text response
-            messages.append({
-                "role": response_message.role,
-                "content": response_message.content
-            })
+            response_msg_for_user = dispatch_tool_call(username, function_name, arguments,
+                                                       turn["plan_changes"], turn["uow"])
+
+        # Append the *result* of the tool call
+        turn["messages"].append({
+            "role": "tool",
+            "tool_call_id": tool_call["id"],
+            "name": function_name,
+            "content": response_msg_for_user
+        })
+        yield function_name, response_msg_for_user
+
+
+def finish_chat_turn(username, turn, reply_to_send):
+    """Commits the turn's writes, queues the planner if needed, saves the turn and returns the response payload."""
+    turn["uow"].commit()
+
+    # After all tools are run, queue one planner run for whatever they changed
+    planner_status = None
+    if turn["plan_changes"]:
+        planner_status = request_replan(username, turn["plan_changes"])
+        reply_to_send += " (Note: I'm updating your study plan in the background.)"
+        # We do NOT append this to history as a tool call
+
+    # Append only this turn's messages (never the header) to the saved history
+    append_chat_messages(username, turn["messages"][turn["turn_start"]:], CHAT_HISTORY_MAX_MESSAGES,
+                         reset=turn["starting_over"], context=turn["new_snapshot"])
+    if CHAT_SUMMARY_ENABLED and turn["stored_turns"] >= CHAT_SUMMARY_KEEP_TURNS + CHAT_SUMMARY_BATCH_TURNS:
+        summary_jobs.submit(username, None)
+
+    return {"reply": reply_to_send, "planner": planner_status,
+            "context_tokens": turn["context_tokens"]}
+
+
+def start_chat_request():
+    """
+    Reads the /chat request. Returns (username, user_message, selected_year, None)
+    or (None, None, None, error_response).
+    """
+    if "username" not in session:
+        return None, None, None, (jsonify({"reply": "Error: Not logged in"}), 401)
+
+    user_message = request.json.get("message")
+    selected_year = request.json.get("year", str(json.loads(os.getenv("CURRENT_DATE", '{"year": 2025}'))["year"]))
+    username = session["username"]
+
+    if not get_user_data(username):
+        session.pop("username", None)
+        return None, None, None, (jsonify({"reply": "Error: Your user data was not found. Please log in again."}), 401)
+
+    return username, user_message, selected_year, None
+
+
+def chat_turn_key(user_message, selected_year):
+    """
+    Requests with the same key while one is in flight (a double submit) share
+    its turn, whichever of /chat and /chat_stream they came to: both keep the
+    turn's result as (payload, status, headers).
+    """
+    return f"{selected_year}\0{normalize(user_message)}"
+
+
+def begin_chat_turn(username, user_message, selected_year):
+    # Built once this user's earlier turns have finished, so it sees their history and writes.
+    return build_chat_turn(username, get_fresh_user_data(username) or {}, user_message, selected_year)
+
 
-        reply_to_send = ""
-        run_planner = False
-
-        if response_message.tool_calls:
-            # This block only runs if the AI requested a tool.
-            for tool_call in response_message.tool_calls:
-                function_name = tool_call.function.name
-                arguments = json.loads(tool_call.function.arguments)
-
-                if function_name == "save_preference":
-                    response_msg_for_user = update_user_data(username, "preference", arguments)
-                elif function_name == "save_class":
-                    response_msg_for_user = update_user_data(username, "class", arguments)
-                elif function_name == "save_task":
-                    response_msg_for_user = update_user_data(username, "task", arguments)
-                    run_planner = True
-                elif function_name == "save_test":
-                    response_msg_for_user = update_user_data(username, "test", arguments)
-                    run_planner = True
-                # === START OF CHAT ROUTE CHANGE ===
-                elif function_name == "update_task_details":
-                    response_msg_for_user = update_task_details_db(username, arguments)
-                    run_planner = True
-                # === END OF CHAT ROUTE CHANGE ===
-                elif function_name == "update_class_schedule":
-                    response_msg_for_user = update_class_schedule_db(username, arguments)
-                elif function_name == "delete_schedule_item":
-                    response_msg_for_user = delete_schedule_item_db(username, arguments)
-                    run_planner = True
-                # --- NEW TOOL ROUTES ---
-                elif function_name == "save_study_windows":
-                    response_msg_for_user = save_study_windows_db(username, arguments)
-                    run_planner_engine_db(username, {})  # Also run planner
-                elif function_name == "get_daily_plan":
-                    response_msg_for_user = get_daily_plan_db(username, arguments)
-                elif function_name == "get_priority_list":
-                    response_msg_for_user = get_priority_list_db(username, arguments)
-                elif function_name == "reschedule_day":
-                    response_msg_for_user = reschedule_day_db(username, arguments)
-                elif function_name == "run_planner_engine":
-                    response_msg_for_user = run_planner_engine_db(username, arguments)
-                else:
-                    response_msg_for_user = "Error: AI tried to call an unknown function."
-
-                # Append the *result* of the tool call
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "name": function_name,
-                    "content": response_msg_for_user
-                })
+def busy_response(error):
+    """The (payload, status, headers) for a turn the server is too busy to run."""
+    if isinstance(error, LLMRateLimitedError):
+        return {"reply": BUSY_REPLY}, 429, {"Retry-After": str(max(1, round(error.retry_after)))}
+    if isinstance(error, TurnBusyError):
+        return {"reply": TURN_BUSY_REPLY}, 429, {"Retry-After": "5"}
+    return {"reply": BUSY_REPLY}, 503, {"Retry-After": "5"}
 
+
+chat_turn_outcomes = metrics.counter("smartscheduler_chat_turns_total",
+                                     "Chat turns run, shared with an identical request in flight, or rejected.")
+metrics.register_collector(lambda: metrics.gauge_lines(
+    "smartscheduler_chat_workers_in_flight", "Offloaded chat turns running or waiting for a chat worker.",
+    {None: chat_workers.in_flight()}))
+
+
+def run_chat_turn(username, user_message, selected_year):
+    """Runs one /chat turn. Returns (payload, status, headers)."""
+    turn = begin_chat_turn(username, user_message, selected_year)
+    messages = turn["messages"]
+
+    try:
+        # Messages with a fixed meaning are answered without the model.
+        # Repeated questions reuse the model's earlier answer.
+        assistant_message = local_assistant_message(turn) or cached_assistant_message(turn)
+        if assistant_message is None:
+            response = create_chat_completion(messages)  # We send the newly constructed list
+            response_message = response.choices[0].message
+            if response_message.tool_calls:
+                assistant_message = response_message.model_dump(exclude={'function_call'})
+            else:
+                assistant_message = {"role": response_message.role, "content": response_message.content}
+            remember_assistant_message(turn, assistant_message)
+
+        messages.append(assistant_message)
+        if assistant_message.get("tool_calls"):
+            # The assistant asked for tools; run them.
+            reply_to_send = ""
+            for _, response_msg_for_user in run_tool_calls(username, turn, assistant_message["tool_calls"]):
                 reply_to_send = response_msg_for_user
         else:
-            # This block runs if the AI did *not* request a tool.
-            reply_to_send = response_message.content
+            # The assistant's simple text response
+            reply_to_send = assistant_message["content"]
 
-        # After all tools are run, check if we need to run the planner
-        if run_planner:
-            planner_response = run_planner_engine_db(username, {})
-            reply_to_send += f" (Note: {planner_response})"
-            # We do NOT append this to history as a tool call
+        return finish_chat_turn(username, turn, reply_to_send), 200, {}
 
-        # Save the complete history (including the new header and conversation)
-        users_collection.update_one(
-            {"username": username},
-            {"$set": {"chat_history": messages}}
-        )
+    except LLMBusyError as e:
+        return busy_response(e)
+    except Exception as e:
+        logger.exception("Error in /chat route")
+        return {"reply": "Sorry, I ran into an error. Please try that again."}, 500, {}
 
-        return jsonify({"reply": reply_to_send})
 
-    except Exception as e:
-        print(f"Error in /chat route: {e}")
-        return jsonify({"reply": "Sorry, I ran into an error. Please try that again."}), 500
+def run_offloaded_chat_turn(username, user_message, selected_year, key, turn):
+    """Runs a `Prefer: respond-async` turn on a chat worker; its result goes to every request sharing it."""
+    try:
+        # Waiting for the user's earlier turns takes this worker, not a request thread.
+        chat_turns.acquire(username, key, turn)
+    except TurnBusyError:
+        return  # acquire() cancelled the turn, which hands the error to everyone sharing it
+    result = None
+    try:
+        result = run_chat_turn(username, user_message, selected_year)
+    finally:
+        chat_turns.leave(username, key, turn, result=result)
 
 
-@app.route("/get_schedule")
-def get_schedule():
+def offload_chat_turn(username, user_message, selected_year, key):
+    """
+    Queues the turn on the chat workers, or shares an identical one already in
+    flight. Returns (turn_id, leader); the result is stored under `turn_id`
+    once the turn finishes. Raises TurnBusyError or LLMBusyError if it can't
+    be queued.
+    """
+    turn_id = new_item_id()
+    create_chat_result(turn_id, username)
+    turn, leader = chat_turns.enter(username, key)
+
+    def store(result, error):
+        if error is not None:
+            result = busy_response(error)
+        elif result is None:
+            result = {"reply": "Sorry, I ran into an error. Please try that again."}, 500, {}
+        try:
+            finish_chat_result(turn_id, *result)
+        except Exception:
+            logger.exception("Could not store the result of chat turn %s", turn_id)
+
+    turn.add_done_callback(store)
+    if leader:
+        try:
+            chat_workers.submit(run_offloaded_chat_turn, username, user_message, selected_year, key, turn)
+        except QueueFullError:
+            chat_turns.cancel(username, key, turn)
+            llm_requests.inc(outcome="busy")
+            raise LLMBusyError()
+    return turn_id, leader
+
+
+@bp.route("/chat", methods=["POST"])
+def chat():
+    """
+    Answers a chat message. With `Prefer: respond-async` the turn runs on a
+    chat worker instead of this request thread: the answer is a 202 with the
+    turn's id (also in Location), and GET /chat_result/<turn_id> returns what
+    /chat would have once it is done.
+    """
+    username, user_message, selected_year, error = start_chat_request()
+    if error:
+        return error
+    key = chat_turn_key(user_message, selected_year)
+    if "respond-async" in request.headers.get("Prefer", ""):
+        try:
+            turn_id, leader = offload_chat_turn(username, user_message, selected_year, key)
+        except (TurnBusyError, LLMBusyError) as e:
+            chat_turn_outcomes.inc(outcome="rejected")
+            payload, status, headers = busy_response(e)
+            return jsonify(payload), status, headers
+        chat_turn_outcomes.inc(outcome="run" if leader else "shared")
+        return jsonify({"turn_id": turn_id, "status": "queued"}), 202, {
+            "Location": url_for("main.chat_turn_result", turn_id=turn_id),
+            "Preference-Applied": "respond-async",
+        }
+
+    # Running, waiting for the user's earlier turn or waiting on an identical
+    # one, this request holds its thread throughout, so it needs a slot first.
+    if not chat_request_threads.acquire(blocking=False):
+        chat_turn_outcomes.inc(outcome="rejected")
+        payload, status, headers = busy_response(LLMBusyError())
+        return jsonify(payload), status, headers
+    try:
+        turn, leader = chat_turns.enter(username, key)
+        if leader:
+            chat_turn_outcomes.inc(outcome="run")
+            chat_turns.acquire(username, key, turn)
+            result = None
+            try:
+                result = run_chat_turn(username, user_message, selected_year)
+            finally:
+                chat_turns.leave(username, key, turn, result=result)
+        else:
+            chat_turn_outcomes.inc(outcome="shared")
+            result = turn.wait(CHAT_TURN_WAIT_SECONDS * CHAT_TURNS_PER_USER)
+    except TurnBusyError as e:
+        chat_turn_outcomes.inc(outcome="rejected")
+        result = busy_response(e)
+    finally:
+        chat_request_threads.release()
+    if result is None:
+        result = {"reply": "Sorry, I ran into an error. Please try that again."}, 500, {}
+    payload, status, headers = result
+    return jsonify(payload), status, headers
+
+
+@bp.route("/chat_result/<turn_id>")
+def chat_turn_result(turn_id):
+    """The result of a `Prefer: respond-async` /chat turn: 202 while it runs, then what /chat would have sent."""
     if "username" not in session:
-        return jsonify({"error": "Not logged in"}), 401
+        return jsonify({"reply": "Error: Not logged in"}), 401
+    result = get_chat_result(turn_id, session["username"])
+    if result is None:
+        return jsonify({"error": "Unknown chat turn"}), 404
+    if result["state"] != "done":
+        return jsonify({"status": result["state"]}), 202, {"Retry-After": "1"}
+    return jsonify(result["payload"]), result["status"], result.get("headers") or {}
 
-    username = session["username"]
 
-    # === START OF ADDED CODE: TRIGGER AUTO-CLEANUP ===
-    # Run the cleanup function *before* fetching the data.
-    # This ensures the data we send to the frontend is already clean.
-    auto_cleanup_past_items(username)
-    # === END OF ADDED CODE ===
+def sse_event(event, data, event_id=None):
+    id_line = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{id_line}event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    user_data = users_collection.find_one({"username": username})
 
-    if not user_data:
-        return jsonify({"error": "User not found"}), 404
+def final_event(result):
+    """The closing /chat_stream event for a turn's (payload, status, headers)."""
+    payload, status, _ = result
+    return ("done" if status == 200 else "error"), payload
+
+
+def stream_chat_turn(username, user_message, selected_year, final):
+    """
+    Runs one /chat_stream turn, yielding its events. Its result is also kept
+    in final["result"], in the same (payload, status, headers) shape /chat
+    uses, so an identical request waiting on this turn gets the same outcome.
+    """
+    turn = begin_chat_turn(username, user_message, selected_year)
+    messages = turn["messages"]
+    try:
+        # Messages with a fixed meaning, and repeated questions, skip the model.
+        known_message = local_assistant_message(turn) or cached_assistant_message(turn)
+        if known_message is not None:
+            content = known_message["content"] or ""
+            calls = known_message.get("tool_calls") or []
+            if content:
+                yield sse_event("token", {"text": content})
+        else:
+            content_parts = []
+            tool_calls = {}
+            for chunk in stream_chat_completion(messages):
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content_parts.append(delta.content)
+                    yield sse_event("token", {"text": delta.content})
+                # Tool calls arrive in fragments; stitch them together by index.
+                for fragment in delta.tool_calls or []:
+                    call = tool_calls.setdefault(fragment.index, {
+                        "id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                    if fragment.id:
+                        call["id"] = fragment.id
+                    if fragment.function and fragment.function.name:
+                        call["function"]["name"] += fragment.function.name
+                    if fragment.function and fragment.function.arguments:
+                        call["function"]["arguments"] += fragment.function.arguments
+            content = "".join(content_parts)
+            calls = [tool_calls[index] for index in sorted(tool_calls)]
+            remember_assistant_message(turn, {"content": content, "tool_calls": calls})
+
+        if calls:
+            messages.append({"role": "assistant", "content": content or None, "tool_calls": calls})
+            reply_to_send = ""
+            for call in calls:
+                yield sse_event("tool", {"name": call["function"]["name"], "status": "running"})
+                for function_name, response_msg_for_user in run_tool_calls(username, turn, [call]):
+                    reply_to_send = response_msg_for_user
+                    yield sse_event("tool", {"name": function_name, "status": "done",
+                                             "result": response_msg_for_user})
+        else:
+            messages.append({"role": "assistant", "content": content})
+            reply_to_send = content
+
+        final["result"] = finish_chat_turn(username, turn, reply_to_send), 200, {}
+
+    except LLMBusyError as e:
+        final["result"] = busy_response(e)
+    except Exception as e:
+        logger.exception("Error in /chat_stream route")
+        final["result"] = {"reply": "Sorry, I ran into an error. Please try that again."}, 500, {}
+    yield sse_event(*final_event(final["result"]))
+
 
-    schedule_data = {
+@bp.route("/chat_stream", methods=["POST"])
+def chat_stream():
+    """
+    Streaming version of /chat. Sends Server-Sent Events: `token` for each
+    piece of the model's text as it arrives, `tool` before and after each tool
+    runs, then `done` with the same payload /chat returns (or `error`).
+    A repeat of a message that is still being answered gets that answer.
+    """
+    username, user_message, selected_year, error = start_chat_request()
+    if error:
+        return error
+    key = chat_turn_key(user_message, selected_year)
+    # Held until the stream closes, whether this request runs, waits or shares a turn.
+    if not chat_request_threads.acquire(blocking=False):
+        chat_turn_outcomes.inc(outcome="rejected")
+        payload, status, headers = busy_response(LLMBusyError())
+        return jsonify(payload), status, headers
+    try:
+        turn, leader = chat_turns.enter(username, key)
+    except TurnBusyError as e:
+        chat_request_threads.release()
+        chat_turn_outcomes.inc(outcome="rejected")
+        payload, status, headers = busy_response(e)
+        return jsonify(payload), status, headers
+    chat_turn_outcomes.inc(outcome="run" if leader else "shared")
+
+    final = {"result": ({"reply": "Sorry, I ran into an error. Please try that again."}, 500, {})}
+    state = {"acquired": False, "ended": not leader}
+
+    def end_turn():
+        # Exactly once per leader: from the generator, or from call_on_close
+        # if the client left before the stream started.
+        if state["ended"]:
+            return
+        state["ended"] = True
+        if state["acquired"]:
+            chat_turns.leave(username, key, turn, result=final["result"])
+        else:
+            chat_turns.cancel(username, key, turn)
+
+    def generate():
+        if not leader:
+            try:
+                result = turn.wait(CHAT_TURN_WAIT_SECONDS * CHAT_TURNS_PER_USER)
+            except TurnBusyError as e:
+                result = busy_response(e)
+            event, payload = final_event(result)
+            if event == "done" and payload.get("reply"):
+                yield sse_event("token", {"text": payload["reply"]})
+            yield sse_event(event, payload)
+            return
+
+        # The user's earlier turn may still be streaming; this one waits for it.
+        try:
+            chat_turns.acquire(username, key, turn)
+        except TurnBusyError as e:
+            state["ended"] = True  # acquire() already cancelled the turn
+            yield sse_event("error", busy_response(e)[0])
+            return
+        state["acquired"] = True
+        try:
+            yield from stream_chat_turn(username, user_message, selected_year, final)
+        finally:
+            # Also runs if the client goes away mid-stream, so the user's next turn isn't stuck.
+            end_turn()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(end_turn)
+    response.call_on_close(chat_request_threads.release)
+    return response
+
+
+def schedule_changes(username, since):
+    """
+    The classes, tasks, tests and plan days changed after version `since`,
+    plus the ids/dates of everything that still exists so the client can
+    drop what was deleted. Sent by /get_schedule?since= and /events.
+    """
+    user_data = get_user_changes(username, since)
+    plan_dates, plan_changes = get_plan_changes(username, since)
+    return {
+        "version": user_data.get("data_version", 0),
+        "since": since,
         "schedule": user_data.get("schedule", []),
         "tasks": user_data.get("tasks", []),
         "tests": user_data.get("tests", []),
-        "generated_plan": user_data.get("generated_plan", []),
+        "ids": {field: user_data.get(f"{field}_ids", []) for field in ("schedule", "tasks", "tests")},
+        "generated_plan": plan_changes,
+        "plan_dates": plan_dates,
         "preferences": user_data.get("preferences", {}),
         "study_windows": user_data.get("study_windows", [])
     }
-    return jsonify(schedule_data)
+
+
+@bp.route("/get_schedule")
+def get_schedule():
+    """
+    The user's schedule data, tagged with their data version (also sent as the
+    ETag). Answers 304 if the client's If-None-Match or `since` is already the
+    current version. With `since=<version>`, only the classes, tasks, tests and
+    plan days changed after that version are sent, plus the ids/dates of
+    everything that still exists so the client can drop what was deleted.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+
+    username = session["username"]
+
+    meta = get_user(username, VERSION_FIELDS)
+
+    if not meta:
+        return jsonify({"error": "User not found"}), 404
+
+    # The background sweeper normally cleans past items; only fall back to
+    # cleaning here if it hasn't reached this user yet today.
+    if meta.get("cleaned_through", "") < datetime.now().strftime("%Y-%m-%d"):
+        auto_cleanup_past_items(username)
+        meta = get_user(username, VERSION_FIELDS)
+
+    version = meta.get("data_version", 0)
+    since = request.args.get("since", type=int)
+    if since == version or request.if_none_match.contains(f"v{version}"):
+        response = Response(status=304)
+    elif since is not None and since < version:
+        response = jsonify(schedule_changes(username, since))
+    else:
+        user_data = get_user_data(username, min_version=version) or {}
+        response = jsonify({
+            "version": user_data.get("data_version", 0),
+            "schedule": user_data.get("schedule", []),
+            "tasks": user_data.get("tasks", []),
+            "tests": user_data.get("tests", []),
+            "generated_plan": get_plan(username),
+            "preferences": user_data.get("preferences", {}),
+            "study_windows": user_data.get("study_windows", [])
+        })
+    # Plan days are written before the version that announces them, so the
+    # plan read after the user document is at least as new as its version.
+    if response.status_code == 200:
+        version = response.get_json()["version"]
+    response.set_etag(f"v{version}")
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# --- LIVE UPDATES ---
+# /events lives on its own blueprint so it can be served apart from the
+# request-thread app: see events_wsgi.py and create_events_app().
+
+events_bp = Blueprint("events", __name__)
+
+event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+event_stream_outcomes = metrics.counter("smartscheduler_event_streams_total",
+                                        "/events streams opened, or rejected because every slot was taken.")
+schedule_events = metrics.counter("smartscheduler_schedule_events_total", "Schedule changes pushed over /events.")
+metrics.register_collector(lambda: metrics.gauge_lines(
+    "smartscheduler_event_streams_open", "/events streams currently open.", {None: change_feed.listener_count()}))
+
+# The data version each watched user had at the last poll (only the poller touches it).
+polled_versions = {}
+
+
+def poll_event_versions():
+    """
+    Wakes the /events streams of users whose data version moved since the
+    last poll, with one query for every user with a stream open in this
+    process. Writes made in this process wake their streams right away; this
+    is how writes from the app's other processes reach them.
+    """
+    usernames = change_feed.usernames()
+    versions = get_data_versions(usernames) if usernames else {}
+    for username in usernames:
+        # A user seen for the first time is woken too: a spurious wake-up costs one small read.
+        if username not in polled_versions or versions.get(username) != polled_versions[username]:
+            change_feed.notify(username)
+    polled_versions.clear()
+    polled_versions.update({username: versions.get(username) for username in usernames})
+
+
+event_version_poller = PeriodicJob(poll_event_versions, EVENTS_POLL_SECONDS, name="events-poller")
+
+
+@events_bp.route("/events")
+def schedule_events_stream():
+    """
+    Pushes the user's schedule changes as Server-Sent Events, so the page
+    doesn't have to re-fetch after every change. Each `schedule` event is
+    what /get_schedule?since=<previous version> would return, and its id is
+    the new version: a reconnecting EventSource sends it back as
+    Last-Event-ID and resumes from there. Idle streams get a comment every
+    EVENTS_PING_SECONDS and end after EVENTS_STREAM_SECONDS (the browser
+    reconnects). 503 when this process already holds EVENTS_MAX_STREAMS.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    username = session["username"]
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None:
+        since = request.args.get("since", type=int)
+
+    if not event_streams.acquire(blocking=False):
+        event_stream_outcomes.inc(outcome="rejected")
+        return jsonify({"error": "Too many open event streams"}), 503, {"Retry-After": "60"}
+    event_stream_outcomes.inc(outcome="opened")
+    event_version_poller.ensure_started()
+
+    def generate():
+        # Listen before reading the version, so a write in between still wakes us.
+        with change_feed.listen(username) as listener:
+            seen = since
+            closes_at = time.monotonic() + EVENTS_STREAM_SECONDS
+            yield f"retry: {int(EVENTS_PING_SECONDS * 1000)}\n\n"
+            changed = True
+            while True:
+                if changed:
+                    version = get_data_version(username)
+                    if version is None:
+                        return
+                    if seen is None or seen > version:
+                        seen = version
+                    elif version > seen:
+                        changes = schedule_changes(username, seen)
+                        seen = changes["version"]
+                        schedule_events.inc()
+                        yield sse_event("schedule", changes, event_id=seen)
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                changed = listener.wait(min(EVENTS_PING_SECONDS, remaining))
+                if not changed:
+                    yield ": ping\n\n"
+
+    response = Response(generate(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Runs even if the client leaves before the stream starts.
+    response.call_on_close(event_streams.release)
+    return response
+
+
+@bp.route("/calendar_feed", methods=["GET", "POST"])
+def calendar_feed_url():
+    """The user's private calendar subscription URL. POST replaces it with a new one."""
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    username = session["username"]
+    rotate = request.method == "POST"
+    if rotate:
+        old = get_user(username, {"feed_token": 1, "_id": 0}) or {}
+        feed_cache.invalidate(old.get("feed_token"))
+    token = get_feed_token(username, rotate=rotate)
+    if token is None:
+        return jsonify({"error": "User not found"}), 404
+    return jsonify({"url": url_for("main.calendar_feed", token=token, _external=True)})
+
+
+def cached_feed(token):
+    """
+    The cached feed for `token`, re-rendered only when the user's data version
+    has moved on. A cached feed is trusted for FEED_CHECK_SECONDS (or until
+    this process sees a newer version of the user); after that one small read
+    of the version decides whether it is still current.
+    """
+    entry = feed_cache.get(token)
+    if entry is not None:
+        local = user_cache.peek(entry["username"])
+        newer_here = local is not None and local.get("data_version", 0) > entry["version"]
+        if not newer_here and time.monotonic() - entry["checked_at"] < FEED_CHECK_SECONDS:
+            return entry
+
+    owner = get_feed_owner(token)
+    if owner is None:
+        feed_cache.invalidate(token)
+        return None
+    username, version = owner["username"], owner.get("data_version", 0)
+    if entry is not None and entry["username"] == username and entry["version"] == version:
+        entry = {**entry, "checked_at": time.monotonic()}
+    else:
+        with metrics.span("feed.render"):
+            user_data = get_user_data(username, min_version=version) or {}
+            # The plan is read after the user data, so it is at least as new as that version.
+            body = render_calendar(user_data, get_plan(username), name=f"{username}'s study plan")
+        entry = {"username": username, "version": user_data.get("data_version", version), "body": body,
+                 "etag": hashlib.sha1(body.encode("utf-8")).hexdigest()[:20], "checked_at": time.monotonic()}
+    feed_cache.set(token, entry)
+    return entry
+
+
+@bp.route("/feed/<token>.ics")
+def calendar_feed(token):
+    """
+    The user's classes, tasks, tests and study plan as an iCalendar feed for
+    calendar apps to subscribe to. Authenticated by the token in the URL.
+    Supports If-None-Match, so a poll for an unchanged feed gets a 304.
+    """
+    entry = cached_feed(token)
+    if entry is None:
+        return Response("Not found\n", status=404, mimetype="text/plain")
+    response = Response(entry["body"], mimetype="text/calendar")
+    response.set_etag(entry["etag"])
+    response.headers["Cache-Control"] = f"private, max-age={int(FEED_CHECK_SECONDS)}"
+    return response.make_conditional(request)
+
+
+def create_app(events_inline=EVENTS_INLINE):
+    """
+    Builds the Flask app. Nothing here touches the network: MongoDB and OpenAI
+    clients are created per process on first use, so the app can be created
+    once and forked into workers (see gunicorn.conf.py and wsgi.py). /events
+    is only served here with `events_inline`; see create_events_app().
+    """
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    bcrypt.init_app(app)
+    app.register_blueprint(bp)
+    if events_inline:
+        app.register_blueprint(events_bp)
+    return app
+
+
+def create_events_app():
+    """
+    Builds the app that serves only /events (and its /metrics), for a gevent
+    worker (see events.conf.py and events_wsgi.py). It shares the session
+    secret, so the proxy can route /events to it under the same host.
+    """
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    app.register_blueprint(events_bp)
+    app.add_url_rule("/metrics", view_func=get_metrics)
+    return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app(events_inline=True).run(debug=True)
 
@@ -0,0 +1 @@
+"""Benchmarks and load tests; see bench/run.py."""
@@ -0,0 +1,81 @@
+"""
+Synthetic users for the benchmarks.
+
+Each profile sets how much data a user has: classes, pending tasks and tests
+(with deadlines spread over the next weeks), plus a stored chat history. The
+plan is generated with the real planner so the plan collection has the
+shape and size it would have in production. Everything is seeded from the
+user's name, so the same profile always produces the same data.
+"""
+import random
+from datetime import datetime, timedelta
+
+from planner import DAY_NAMES, build_plan
+
+PROFILES = {
+    "small": {"classes": 6, "tasks": 10, "tests": 4, "chat_messages": 10},
+    "medium": {"classes": 15, "tasks": 120, "tests": 30, "chat_messages": 40},
+    "large": {"classes": 25, "tasks": 1500, "tests": 300, "chat_messages": 60},
+}
+
+PASSWORD = "bench-password"
+
+STUDY_WINDOWS = [
+    {"day": day, "start_time": "18:00", "end_time": "21:00", "focus_level": focus}
+    for day, focus in zip(DAY_NAMES, ["high", "medium", "high", "medium", "low", "high", "medium"])
+]
+PREFERENCES = {"awake_time": "07:00", "sleep_time": "23:00"}
+
+
+def user_data(username, profile, now=None):
+    """The scheduling data (schedule, tasks, tests, windows) of one synthetic user."""
+    now = now or datetime.now()
+    sizes = PROFILES[profile]
+    rng = random.Random(username)
+    schedule = []
+    for index in range(sizes["classes"]):
+        start = rng.choice(range(7 * 60, 16 * 60, 30))
+        schedule.append({
+            "id": f"{username}-c{index}", "subject": f"Subject {index}", "day": rng.choice(DAY_NAMES),
+            "start_time": f"{start // 60:02d}:{start % 60:02d}",
+            "end_time": f"{(start + 90) // 60:02d}:{(start + 90) % 60:02d}",
+        })
+    tasks = [{
+        "id": f"{username}-t{index}", "name": f"Task {index}",
+        "task_type": rng.choice(["assignment", "project", "seatwork"]),
+        "deadline": (now + timedelta(hours=rng.randint(6, 24 * 45))).strftime("%Y-%m-%dT%H:%M:00"),
+    } for index in range(sizes["tasks"])]
+    tests = [{
+        "id": f"{username}-x{index}", "name": f"Test {index}", "test_type": rng.choice(["quiz", "exam"]),
+        "date": (now + timedelta(days=rng.randint(1, 45))).strftime("%Y-%m-%d"),
+    } for index in range(sizes["tests"])]
+    return {"schedule": schedule, "tasks": tasks, "tests": tests,
+            "preferences": dict(PREFERENCES), "study_windows": [dict(window) for window in STUDY_WINDOWS]}
+
+
+def chat_history(profile):
+    messages = []
+    for index in range(PROFILES[profile]["chat_messages"] // 2):
+        messages.append({"role": "user", "content": f"Can you remind me what is due this week? ({index})"})
+        messages.append({"role": "assistant", "content": "You have a few tasks due this week; "
+                                                         "start with the one due soonest."})
+    return messages
+
+
+def seed_user(username, profile, password_hash, now=None):
+    """Writes one synthetic user (account, data, plan and chat history) through the storage layer."""
+    import storage
+
+    now = now or datetime.now()
+    data = user_data(username, profile, now)
+    storage.users_collection.delete_one({"username": username})
+    storage.users_collection.insert_one({
+        "username": username, "password": password_hash, "data_version": 0,
+        "cleaned_through": now.strftime("%Y-%m-%d"), **data,
+    })
+    plan, _ = build_plan(data["schedule"], data["tasks"], data["tests"], data["preferences"],
+                         data["study_windows"], now=now)
+    storage.replace_plan(username, plan)
+    storage.save_chat_history(username, chat_history(profile))
+    storage.invalidate_user(username)
+    return data
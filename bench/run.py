@@ -0,0 +1,388 @@
+"""
+Benchmarks and a load test for Smart Scheduler.
+
+    python -m bench.run                        # run everything, compare with bench/baseline.json
+    python -m bench.run --update-baseline      # store this run as the new baseline
+    python -m bench.run --only routes --profiles large --requests 300 --concurrency 16 --llm-latency-ms 400
+
+Routes (/login, /get_schedule, /chat, /save_personalization) are driven
+through Flask's test client from `--concurrency` threads against synthetic
+users of each profile in bench/fixtures.py. The planner, cleanup, cascade
+and context helpers get microbenchmarks on the same data. Every benchmark
+reports throughput and p50/p95/p99.
+
+MongoDB: set BENCH_MONGO_URI to a disposable local mongod (for example
+`docker run --rm -p 27017:27017 mongo:7`); the benchmark writes bench users
+to its SmartSchedule database and removes them afterwards. Without it,
+mongomock is used if it is installed. That measures the app's own work
+only, so don't compare those numbers with a real-database baseline.
+
+OpenAI: a local fake server (bench/fake_openai.py) with `--llm-latency-ms`
+of latency is started and the app is pointed at it. The LLM response cache
+is off by default so /chat always measures a model round trip.
+
+Exits with status 1 if a benchmark's p95 (or throughput) regressed by more
+than `--tolerance` against the stored baseline.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+# --- Setup ---
+
+def load_app(args, fake_openai):
+    """Imports the app configured for the benchmark (local database and fake OpenAI)."""
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": fake_openai.base_url,
+        "OPENAI_MAX_RETRIES": "0",
+        "SECRET_KEY": "bench",
+        "LLM_CACHE_SIZE": str(args.llm_cache_size),
+        "LLM_MAX_CONCURRENCY": str(max(args.concurrency, 16)),
+        # The test client has no thread pool; size the slot budget as if for one this big.
+        "GUNICORN_THREADS": str(max(args.concurrency, 16) + 2),
+        # Measure the round trip, not the load shedding: no token bucket, and
+        # clients sharing a user queue for their turn instead of getting 429s.
+        "LLM_RATE_PER_SECOND": "0",
+        "CHAT_TURNS_PER_USER": str(max(args.concurrency, 2)),
+    })
+    # A developer's .env must not point the benchmark at a real database or OpenAI.
+    import dotenv
+    dotenv.load_dotenv = lambda *a, **k: False
+
+    if os.getenv("BENCH_MONGO_URI"):
+        os.environ["MONGO_URI"] = os.environ["BENCH_MONGO_URI"]
+        database = "mongodb"
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Set BENCH_MONGO_URI to a local MongoDB (or install mongomock) to run the benchmarks.")
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        database = "mongomock"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as app_module
+    return app_module, database
+
+
+_flask_app = None
+
+
+def test_client(app_module):
+    global _flask_app
+    if _flask_app is None:
+        _flask_app = app_module.create_app()
+    return _flask_app.test_client()
+
+
+def logged_in_client(app_module, username, password):
+    client = test_client(app_module)
+    response = client.post("/login", data={"username": username, "password": password})
+    if response.status_code != 302:
+        raise RuntimeError(f"Could not log in as {username}")
+    return client
+
+
+# --- Measuring ---
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(durations, wall_seconds):
+    values = sorted(duration * 1000 for duration in durations)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50), 3),
+        "p95_ms": round(percentile(values, 0.95), 3),
+        "p99_ms": round(percentile(values, 0.99), 3),
+        "mean_ms": round(statistics.fmean(values), 3) if values else 0.0,
+        "throughput_rps": round(len(values) / wall_seconds, 2) if wall_seconds else 0.0,
+    }
+
+
+def run_micro(fn, iterations, setup=None):
+    """Times `fn(i)` sequentially; `setup(i)`, if given, runs untimed before each call."""
+    durations = []
+    started = time.perf_counter()
+    untimed = 0.0
+    for i in range(iterations):
+        if setup:
+            setup_started = time.perf_counter()
+            setup(i)
+            untimed += time.perf_counter() - setup_started
+        call_started = time.perf_counter()
+        fn(i)
+        durations.append(time.perf_counter() - call_started)
+    return summarize(durations, time.perf_counter() - started - untimed)
+
+
+def run_load(make_worker_state, request, total, concurrency):
+    """
+    Sends `total` requests from `concurrency` threads. Each thread gets its
+    own state from `make_worker_state()` (e.g. a logged-in client), created
+    before timing starts. `request(state, i)` must return the response.
+    """
+    states = [make_worker_state() for _ in range(concurrency)]
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    durations = []
+    errors = []
+
+    def worker(state):
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            response = request(state, i)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+            durations.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, states))
+    summary = summarize(durations, time.perf_counter() - started)
+    summary["errors"] = len(errors)
+    return summary
+
+
+# --- Benchmarks ---
+
+def route_benchmarks(app_module, profile, users, args):
+    import storage
+    from bench.fixtures import PASSWORD, STUDY_WINDOWS, PREFERENCES
+
+    results = {}
+    usernames = itertools.cycle(users)
+
+    def client_state():
+        username = next(usernames)
+        client = logged_in_client(app_module, username, PASSWORD)
+        client.username = username
+        return client
+
+    results[f"route.login[{profile}]"] = run_load(
+        lambda: test_client(app_module),
+        lambda client, i: client.post("/login", data={"username": users[i % len(users)], "password": PASSWORD}),
+        args.login_requests, min(args.concurrency, args.login_requests))
+
+    results[f"route.get_schedule.full[{profile}]"] = run_load(
+        client_state, lambda client, i: client.get("/get_schedule"), args.requests, args.concurrency)
+
+    def client_with_version():
+        client = client_state()
+        client.version = storage.get_data_version(client.username) or 0
+        return client
+
+    results[f"route.get_schedule.304[{profile}]"] = run_load(
+        client_with_version, lambda client, i: client.get(f"/get_schedule?since={client.version}"),
+        args.requests, args.concurrency)
+
+    def feed_client():
+        client = test_client(app_module)
+        client.path = f"/feed/{storage.get_feed_token(next(usernames))}.ics"
+        return client
+
+    results[f"route.calendar_feed[{profile}]"] = run_load(
+        feed_client, lambda client, i: client.get(client.path), args.requests, args.concurrency)
+
+    results[f"route.chat[{profile}]"] = run_load(
+        client_state,
+        lambda client, i: client.post("/chat", json={
+            "message": f"What should I focus on this week? (question {i})", "year": str(datetime.now().year)}),
+        args.requests, args.concurrency)
+
+    results[f"route.save_personalization[{profile}]"] = run_load(
+        client_state,
+        lambda client, i: client.post("/save_personalization", json={
+            "preferences": dict(PREFERENCES), "study_windows": STUDY_WINDOWS[: 1 + i % len(STUDY_WINDOWS)]}),
+        args.requests, args.concurrency)
+    return results
+
+
+def micro_benchmarks(app_module, profile, users, args):
+    import storage
+    from bench.fixtures import user_data
+    from context import context_rows, context_ref, encode_full
+    from planner import build_plan, diff_plan, priority_list, parse_day_constraints, free_today, reschedule_today
+
+    now = datetime.now()
+    data = user_data(users[0], profile, now)
+    plan, _ = build_plan(data["schedule"], data["tasks"], data["tests"], data["preferences"],
+                         data["study_windows"], now=now)
+    smaller, _ = build_plan(data["schedule"], data["tasks"][1:], data["tests"], data["preferences"],
+                            data["study_windows"], now=now)
+    today = now.strftime("%Y-%m-%d")
+    today_blocks = [block for block in plan if block["date"] == today]
+    iterations = args.iterations
+    results = {}
+
+    results[f"planner.build_plan[{profile}]"] = run_micro(
+        lambda i: build_plan(data["schedule"], data["tasks"], data["tests"], data["preferences"],
+                             data["study_windows"], now=now), iterations)
+    results[f"planner.diff_plan[{profile}]"] = run_micro(lambda i: diff_plan(plan, smaller), iterations)
+    results[f"planner.priority_list[{profile}]"] = run_micro(
+        lambda i: priority_list(data["tasks"], data["tests"], 120, now), iterations)
+
+    def reschedule(i):
+        constraints = parse_day_constraints("only 1 hour at lunch, low-focus")
+        intervals = free_today(constraints, data["schedule"], data["preferences"], data["study_windows"], now)
+        reschedule_today(today_blocks, data["tasks"], data["tests"], intervals, now)
+    results[f"planner.reschedule_today[{profile}]"] = run_micro(reschedule, iterations)
+
+    def encode_context(i):
+        rows, later = context_rows(data, now)
+        encode_full(rows, context_ref(rows, now.year), now.year, 21, later)
+    results[f"context.encode_full[{profile}]"] = run_micro(encode_context, iterations)
+
+    # Database-backed helpers run against the seeded users.
+    username = users[0]
+
+    def make_stale(i):
+        storage.users_collection.update_one({"username": username}, {"$set": {"cleaned_through": ""}})
+    results[f"cleanup.auto_cleanup_past_items[{profile}]"] = run_micro(
+        lambda i: app_module.auto_cleanup_past_items(username), min(iterations, 50), setup=make_stale)
+
+    def make_all_stale(i):
+        storage.users_collection.update_many({"username": {"$in": users}}, {"$set": {"cleaned_through": ""}})
+    results[f"cleanup.sweep_past_items[{profile}]"] = run_micro(
+        lambda i: app_module.sweep_past_items(), min(iterations, 20), setup=make_all_stale)
+
+    deletable = [task["name"] for task in data["tasks"]]
+    results[f"cascade.delete_schedule_item[{profile}]"] = run_micro(
+        lambda i: app_module.delete_schedule_item_db(username, {"item_name": deletable[i % len(deletable)]}),
+        min(iterations, len(deletable)))
+
+    results[f"storage.get_user_data.miss[{profile}]"] = run_micro(
+        lambda i: storage.get_user_data(username), iterations, setup=lambda i: storage.invalidate_user(username))
+    results[f"storage.get_plan[{profile}]"] = run_micro(lambda i: storage.get_plan(username), iterations)
+    return results
+
+
+# --- Baselines ---
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Returns a list of human-readable regressions of `results` against `baseline`."""
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        allowed_ms = previous["p95_ms"] * (1 + tolerance)
+        if current["p95_ms"] > allowed_ms and current["p95_ms"] - previous["p95_ms"] > min_delta_ms:
+            regressions.append(f"{name}: p95 {current['p95_ms']:.2f} ms > baseline "
+                               f"{previous['p95_ms']:.2f} ms (+{tolerance:.0%} allowed)")
+        if previous.get("throughput_rps") and name.startswith("route."):
+            if current["throughput_rps"] < previous["throughput_rps"] / (1 + tolerance):
+                regressions.append(f"{name}: throughput {current['throughput_rps']:.1f}/s < baseline "
+                                   f"{previous['throughput_rps']:.1f}/s")
+    return regressions
+
+
+def print_table(results):
+    header = f"{'benchmark':<48} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'rps':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, summary in sorted(results.items()):
+        errors = f"  ({summary['errors']} errors)" if summary.get("errors") else ""
+        print(f"{name:<48} {summary['count']:>6} {summary['p50_ms']:>9.2f} {summary['p95_ms']:>9.2f} "
+              f"{summary['p99_ms']:>9.2f} {summary['throughput_rps']:>9.1f}{errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Scheduler benchmarks and load test.")
+    parser.add_argument("--only", choices=["routes", "micro"], help="run only one group")
+    parser.add_argument("--profiles", default="small,medium,large",
+                        help="comma-separated user profiles from bench/fixtures.py")
+    parser.add_argument("--users", type=int, default=4, help="synthetic users per profile")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route benchmark")
+    parser.add_argument("--login-requests", type=int, default=20, help="requests for /login (bcrypt is slow)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=200, help="iterations per microbenchmark")
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--llm-cache-size", type=int, default=0, help="LLM_CACHE_SIZE for the app")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, e.g. 0.25 = 25%%")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="ignore p95 changes smaller than this many ms")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    from bench.fake_openai import FakeOpenAIServer
+    fake_openai = FakeOpenAIServer(latency_ms=args.llm_latency_ms).start()
+    app_module, database = load_app(args, fake_openai)
+    from bench.fixtures import PASSWORD, seed_user
+    import storage
+
+    password_hash = app_module.bcrypt.generate_password_hash(PASSWORD).decode("utf-8")
+    results = {}
+    all_users = []
+    try:
+        for profile in [name.strip() for name in args.profiles.split(",") if name.strip()]:
+            users = [f"bench-{profile}-{index}" for index in range(args.users)]
+            all_users += users
+            for username in users:
+                seed_user(username, profile, password_hash)
+            if args.only in (None, "micro"):
+                results.update(micro_benchmarks(app_module, profile, users, args))
+            if args.only in (None, "routes"):
+                results.update(route_benchmarks(app_module, profile, users, args))
+    finally:
+        storage.users_collection.delete_many({"username": {"$in": all_users}})
+        storage.plans_collection.delete_many({"username": {"$in": all_users}})
+        storage.chat_collection.delete_many({"username": {"$in": all_users}})
+
+    print(f"database={database} llm_latency_ms={args.llm_latency_ms:g} concurrency={args.concurrency} "
+          f"fake_llm_requests={fake_openai.requests}")
+    print_table(results)
+    environment = {"database": database, "python": platform.python_version(), "machine": platform.machine(),
+                   "llm_latency_ms": args.llm_latency_ms, "concurrency": args.concurrency,
+                   "recorded_at": datetime.now().isoformat(timespec="seconds")}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"environment": environment, "metrics": results}, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment, "metrics": results}, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one.")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("environment", {}).get("database") != database:
+        print(f"Warning: the baseline was recorded with {baseline.get('environment', {}).get('database')}, "
+              f"this run uses {database}.")
+    regressions = compare(results, baseline.get("metrics", {}), args.tolerance, args.min_delta_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        return 1
+    print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
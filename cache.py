@@ -0,0 +1,108 @@
+"""
+A small thread-safe in-process LRU cache with a per-entry time to live.
+
+Entries are evicted least-recently-used first once `max_entries` is reached,
+and are treated as missing once they are older than `ttl_seconds`. Hit, miss,
+eviction and invalidation counts are kept so they can be reported.
+
+A value read from the database can be older than an invalidation that ran
+while it was being read. Take `token(key)` before the read and pass it (and
+the value's version, if it has one) to `set()`, which then drops the value
+instead of caching it over a newer one. Tokens are per key, so invalidating
+one key doesn't discard fills of the others that are in flight.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_entries=1024, ttl_seconds=30.0, name="cache"):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value, version)
+        self._generations = OrderedDict()  # key -> generation of its last invalidate()
+        self._generation = 0               # last generation handed out
+        self._floor = 0                    # generation of every key not in _generations
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING or entry[0] <= time.monotonic():
+                if entry is not _MISSING:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def peek(self, key):
+        """The live value for `key` without counting a lookup or refreshing its LRU position."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] > time.monotonic() else None
+
+    def token(self, key):
+        """Pass to set() to skip it if `key` was invalidated since."""
+        with self._lock:
+            return self._generations.get(key, self._floor)
+
+    def set(self, key, value, token=None, version=None):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if token is not None and token != self._generations.get(key, self._floor):
+                return
+            current = self._entries.get(key)
+            if (version is not None and current is not None and current[2] is not None
+                    and current[2] > version and current[0] > time.monotonic()):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._generations[key] = self._generation
+            self._generations.move_to_end(key)
+            # Forgetting a key raises the floor past its generation, so tokens
+            # taken before its invalidation still don't match.
+            while len(self._generations) > max(self.max_entries, 1):
+                self._floor = self._generations.popitem(last=False)[1]
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._generations.clear()
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,75 @@
+"""
+Wakes a user's open /events streams when their schedule data changes.
+
+storage.py calls `change_feed.notify(username)` after every write that moves
+a user's data version. A notification is only a hint: the stream reads the
+version itself once woken, so a spurious wake-up costs one small read. Like
+the caches it is per process; writes made by other processes are picked up
+by app.poll_event_versions(), which reads the versions of every user in
+usernames() in one query every few seconds.
+"""
+import threading
+from contextlib import contextmanager
+
+
+class _Channel:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.listeners = 0
+
+
+class Listener:
+    def __init__(self, channel):
+        self._channel = channel
+        self._seen = channel.generation
+
+    def wait(self, timeout):
+        """True once the user's data may have changed since the last wait(), False on timeout."""
+        with self._channel.condition:
+            changed = self._channel.condition.wait_for(
+                lambda: self._channel.generation != self._seen, timeout)
+            self._seen = self._channel.generation
+        return changed
+
+
+class ChangeFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}   # username -> _Channel, only while someone listens
+
+    def notify(self, username):
+        with self._lock:
+            channel = self._channels.get(username)
+        if channel is None:
+            return
+        with channel.condition:
+            channel.generation += 1
+            channel.condition.notify_all()
+
+    @contextmanager
+    def listen(self, username):
+        """Yields a Listener for the user's changes. Register before reading, so nothing is missed."""
+        with self._lock:
+            channel = self._channels.setdefault(username, _Channel())
+            channel.listeners += 1
+            listener = Listener(channel)
+        try:
+            yield listener
+        finally:
+            with self._lock:
+                channel.listeners -= 1
+                if not channel.listeners:
+                    del self._channels[username]
+
+    def usernames(self):
+        """The users someone is listening for."""
+        with self._lock:
+            return list(self._channels)
+
+    def listener_count(self):
+        with self._lock:
+            return sum(channel.listeners for channel in self._channels.values())
+
+
+change_feed = ChangeFeed()
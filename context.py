@@ -0,0 +1,125 @@
+"""
+Compact context encoding for the chat model.
+
+Instead of sending `json.dumps` of all of the user's data every turn, the data
+is flattened into short pipe-separated rows (one per class, upcoming task,
+upcoming test, preference and study window). The first turn of a conversation
+gets every row; later turns only get the rows that were added or removed
+since the last context the model saw, or a one-line reference when nothing
+changed.
+"""
+import hashlib
+from datetime import timedelta
+
+from planner import DAY_NAMES, parse_deadline
+
+DEFAULT_CONTEXT_HORIZON_DAYS = 21
+
+FULL_PREFIX = "Context ref"
+DELTA_PREFIX = "Context update"
+
+LEGEND = ("Rows: C=class(subject|day|start-end) T=task(name|type|due) X=test(name|type|date) "
+          "P=preferences(awake|sleep) W=study window(day|start-end|focus). "
+          "Only items due within the next {days} days are listed{later}.")
+
+
+def _clean(value):
+    return str(value if value is not None else "").replace("|", "/").replace("\n", " ")
+
+
+def _day(value):
+    value = _clean(value)
+    for name in DAY_NAMES:
+        if name.lower().startswith(value.lower()[:3]) and value:
+            return name[:3]
+    return value
+
+
+def context_rows(data, now, horizon_days=DEFAULT_CONTEXT_HORIZON_DAYS):
+    """
+    Flattens the user's data into {row_key: row} plus the number of tasks and
+    tests left out because they are due after the horizon.
+    """
+    rows = {}
+    horizon_end = now + timedelta(days=horizon_days)
+    later = 0
+
+    for item in data.get("schedule", []):
+        row = (f"C|{_clean(item.get('subject'))}|{_day(item.get('day'))}|"
+               f"{_clean(item.get('start_time'))}-{_clean(item.get('end_time'))}")
+        rows[row] = row
+
+    for item in data.get("tasks", []):
+        due = parse_deadline(item.get("deadline"))
+        if due is not None and due < now:
+            continue
+        if due is not None and due > horizon_end:
+            later += 1
+            continue
+        row = f"T|{_clean(item.get('name'))}|{_clean(item.get('task_type'))}|{_clean(item.get('deadline'))}"
+        rows[row] = row
+
+    for item in data.get("tests", []):
+        due = parse_deadline(item.get("date"))
+        if due is not None and due.date() < now.date():
+            continue
+        if due is not None and due > horizon_end:
+            later += 1
+            continue
+        row = f"X|{_clean(item.get('name'))}|{_clean(item.get('test_type'))}|{_clean(item.get('date'))}"
+        rows[row] = row
+
+    preferences = data.get("preferences") or {}
+    if preferences:
+        row = f"P|{_clean(preferences.get('awake_time'))}|{_clean(preferences.get('sleep_time'))}"
+        rows[row] = row
+
+    for item in data.get("study_windows", []):
+        row = (f"W|{_day(item.get('day'))}|{_clean(item.get('start_time'))}-"
+               f"{_clean(item.get('end_time'))}|{_clean(item.get('focus_level'))}")
+        rows[row] = row
+
+    return rows, later
+
+
+def context_ref(rows, year):
+    digest = hashlib.sha1("\n".join(sorted(rows)).encode("utf-8"))
+    digest.update(str(year).encode("utf-8"))
+    return digest.hexdigest()[:10]
+
+
+def encode_full(rows, ref, year, horizon_days, later):
+    later_note = f" ({later} later items omitted)" if later else ""
+    lines = [
+        f"{FULL_PREFIX} {ref}. Here is my current data. Assume all new dates are for the year {year}.",
+        LEGEND.format(days=horizon_days, later=later_note),
+    ]
+    lines.extend(sorted(rows))
+    return "\n".join(lines)
+
+
+def encode_delta(old_rows, rows, old_ref, ref):
+    added = sorted(set(rows) - set(old_rows))
+    removed = sorted(set(old_rows) - set(rows))
+    lines = [f"{DELTA_PREFIX} {old_ref}->{ref}. My data changed since the last context (+ added, - removed):"]
+    lines.extend(f"+{row}" for row in added)
+    lines.extend(f"-{row}" for row in removed)
+    return "\n".join(lines)
+
+
+def encode_unchanged(ref):
+    return f"{FULL_PREFIX} {ref} still applies; my data hasn't changed."
+
+
+def is_context_message(message):
+    """True for the full/delta/unchanged context messages (as opposed to what the user typed)."""
+    return message.get("role") == "user" and (message.get("content") or "").startswith((FULL_PREFIX, DELTA_PREFIX))
+
+
+def has_base(history, base_ref):
+    """True if the full context message `base_ref` is still part of `history`."""
+    marker = f"{FULL_PREFIX} {base_ref}."
+    return any(
+        message.get("role") == "user" and (message.get("content") or "").startswith(marker)
+        for message in history
+    )
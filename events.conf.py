@@ -0,0 +1,31 @@
+"""
+Gunicorn settings for the /events server, next to the main app:
+
+    gunicorn -c events.conf.py events_wsgi:app
+
+gevent workers (`pip install gevent`) keep thousands of mostly idle
+Server-Sent Events streams open each. Every worker reads the data versions
+of the users it streams to in one query every EVENTS_POLL_SECONDS, so writes
+made by the main app's workers reach the page within that time.
+Everything can be tuned through the environment.
+"""
+import os
+
+bind = os.getenv("EVENTS_BIND", f"0.0.0.0:{os.getenv('EVENTS_PORT', '8001')}")
+workers = int(os.getenv("EVENTS_WORKERS", "1"))
+worker_class = "gevent"
+# Also caps the streams per worker, along with EVENTS_MAX_STREAMS.
+worker_connections = int(os.getenv("EVENTS_WORKER_CONNECTIONS", "2000"))
+
+# Import the app in each worker, after gevent has patched the standard library
+# (threading, sockets), so the MongoDB client and the stream waits cooperate.
+preload_app = False
+
+# Streams end on their own after EVENTS_STREAM_SECONDS; this only catches stuck workers.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
@@ -0,0 +1,11 @@
+"""
+Live-updates entry point: `gunicorn -c events.conf.py events_wsgi:app`.
+
+Serves only /events (and /metrics) from gevent workers, where an open stream
+costs a greenlet instead of one of the main app's request threads. Route
+/events to it from the proxy in front of the app, on the same host, so the
+session cookie comes along.
+"""
+from app import create_events_app
+
+app = create_events_app()
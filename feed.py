@@ -0,0 +1,123 @@
+"""
+iCalendar rendering of a user's schedule, for calendar subscriptions.
+
+`render_calendar()` turns the same plain dicts the planner works on into one
+VCALENDAR: `schedule` classes as weekly recurring events, tasks as a short
+event at their deadline, tests as all-day events and every `generated_plan`
+block as a study event. Times are written as floating local times, the same
+wall-clock times the app shows, so they land where the user expects in their
+own calendar's time zone.
+"""
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+from planner import parse_deadline, weekday_index
+
+PRODID = "-//Smart Scheduler//Study Plan//EN"
+UID_DOMAIN = "smart-scheduler"
+ICS_DAY_CODES = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+DEADLINE_MINUTES = 15  # tasks show up as a short event ending at their deadline
+REFRESH_INTERVAL = "PT1H"
+
+
+def _escape(text):
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def _fold(line):
+    """Folds a content line to at most 75 octets per line, as RFC 5545 asks."""
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line
+    parts = []
+    while data:
+        size = 75 if not parts else 74
+        cut = min(size, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1  # don't split a UTF-8 character
+        parts.append(data[:cut].decode("utf-8"))
+        data = data[cut:]
+    return "\r\n ".join(parts)
+
+
+def _uid(kind, item, *extra):
+    key = item.get("id") or hashlib.sha1(repr(sorted(item.items())).encode("utf-8")).hexdigest()[:16]
+    return "-".join((kind, key, *extra)) + f"@{UID_DOMAIN}"
+
+
+def _local(moment):
+    return moment.strftime("%Y%m%dT%H%M%S")
+
+
+def _event(uid, stamp, summary, start, end=None, all_day=False, rule=None, category=None):
+    lines = ["BEGIN:VEVENT", f"UID:{uid}", f"DTSTAMP:{stamp}"]
+    if all_day:
+        lines += [f"DTSTART;VALUE=DATE:{start:%Y%m%d}", f"DTEND;VALUE=DATE:{end:%Y%m%d}"]
+    else:
+        lines += [f"DTSTART:{_local(start)}", f"DTEND:{_local(end)}"]
+    if rule:
+        lines.append(f"RRULE:{rule}")
+    lines.append(f"SUMMARY:{_escape(summary)}")
+    if category:
+        lines.append(f"CATEGORIES:{category}")
+    lines += ["TRANSP:OPAQUE" if category in ("Class", "Study") else "TRANSP:TRANSPARENT", "END:VEVENT"]
+    return lines
+
+
+def _at(date_value, hhmm):
+    return datetime.strptime(f"{date_value:%Y-%m-%d} {hhmm}", "%Y-%m-%d %H:%M")
+
+
+def render_calendar(user_data, plan, now=None, name="Study plan"):
+    """Returns the user's classes, tasks, tests and plan as an iCalendar document (str)."""
+    now = now or datetime.now()
+    stamp = now.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{PRODID}", "CALSCALE:GREGORIAN", "METHOD:PUBLISH",
+             f"X-WR-CALNAME:{_escape(name)}", f"REFRESH-INTERVAL;VALUE=DURATION:{REFRESH_INTERVAL}",
+             f"X-PUBLISHED-TTL:{REFRESH_INTERVAL}"]
+
+    # Weekly classes start in the current week and repeat from there.
+    week_start = now.date() - timedelta(days=now.weekday())
+    for item in user_data.get("schedule", []):
+        day = weekday_index(item.get("day"))
+        if day is None:
+            continue
+        try:
+            date_value = week_start + timedelta(days=day)
+            start, end = _at(date_value, item["start_time"]), _at(date_value, item["end_time"])
+        except (KeyError, ValueError, TypeError):
+            continue
+        lines += _event(_uid("class", item), stamp, item.get("subject") or "Class", start, end,
+                        rule=f"FREQ=WEEKLY;BYDAY={ICS_DAY_CODES[day]}", category="Class")
+
+    for item in user_data.get("tasks", []):
+        # Parsed the way the planner reads it, so a date-only deadline is due at 23:59.
+        deadline = parse_deadline(item.get("deadline"))
+        if deadline is None:
+            continue
+        task_type = item.get("task_type")
+        summary = f"Due: {item.get('name', 'Task')}" + (f" ({task_type})" if task_type else "")
+        lines += _event(_uid("task", item), stamp, summary, deadline - timedelta(minutes=DEADLINE_MINUTES),
+                        deadline, category="Task")
+
+    for item in user_data.get("tests", []):
+        try:
+            date_value = datetime.strptime(item["date"], "%Y-%m-%d").date()
+        except (KeyError, ValueError, TypeError):
+            continue
+        label = (item.get("test_type") or "test").capitalize()
+        lines += _event(_uid("test", item), stamp, f"{label}: {item.get('name', '')}", date_value,
+                        date_value + timedelta(days=1), all_day=True, category="Test")
+
+    for block in plan:
+        try:
+            date_value = datetime.strptime(block["date"], "%Y-%m-%d").date()
+            start, end = _at(date_value, block["start_time"]), _at(date_value, block["end_time"])
+        except (KeyError, ValueError, TypeError):
+            continue
+        uid = f"plan-{block['date']}-{block['start_time'].replace(':', '')}@{UID_DOMAIN}"
+        lines += _event(uid, stamp, f"Study: {block.get('task', '')}", start, end, category="Study")
+
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_fold(line) for line in lines) + "\r\n"
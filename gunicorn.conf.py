@@ -0,0 +1,42 @@
+"""
+Gunicorn settings for running Smart Scheduler on every core:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker is a separate process with its own MongoDB and OpenAI clients,
+caches and background jobs. Threads per worker serve requests; offloaded chat
+turns (`Prefer: respond-async`) wait on OpenAI on the app's own chat workers
+(CHAT_WORKERS), while synchronous /chat and /chat_stream hold a thread.
+/events is served by its own gevent server (events.conf.py), not by these
+threads. Everything can be tuned through the environment.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Importing the app is cheap and never touches the network, so do it once in
+# the master and let the workers share its memory copy-on-write.
+preload_app = True
+
+# Chat turns can take a while (the OpenAI timeout is 30s by default, plus tools).
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# Recycle workers now and then so slow leaks can't build up.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def post_fork(server, worker):
+    # storage.py and app.py drop any client inherited from the master (os.register_at_fork);
+    # this just makes the per-worker start visible in the logs.
+    server.log.info("Worker %s started; MongoDB and OpenAI clients will connect on first use.", worker.pid)
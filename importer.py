@@ -0,0 +1,396 @@
+"""
+Bulk import of classes, tasks and tests from iCalendar, CSV or JSON.
+
+Like the planner, everything in here works on plain dicts and never touches
+the database: `parse_import()` reads an uploaded file in a single pass and
+yields each record as a validated item, ready to be pushed to the user's
+`schedule`, `tasks` or `tests`. The /import route writes them all at once.
+
+How records map to items:
+-   iCalendar: a weekly (or daily) recurring VEVENT is a class, one per day it
+    repeats on. A VTODO is a task due at its DUE time. A one-off VEVENT is a
+    test if its summary or categories mention a quiz or exam, otherwise a task
+    due when it starts.
+-   CSV / JSON: each row (or object) has a `type` (class, task, test, or a task
+    or test type such as "assignment" or "quiz") and the same fields as the
+    save_class / save_task / save_test tools. Without a `type`, a row with a
+    `day` is a class, one with a `deadline` a task and one with a `date` a test.
+    JSON may also be an object with "classes", "tasks" and "tests" lists.
+"""
+import csv
+import io
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+from planner import DAY_NAMES
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9: TZID times are read as local times
+    ZoneInfo = None
+
+FORMATS = ("ics", "csv", "json")
+
+TASK_TYPES = ("assignment", "project", "seatwork")
+TEST_TYPES = ("quiz", "exam")
+KIND_FIELDS = {"class": "schedule", "task": "tasks", "test": "tests"}
+JSON_SECTIONS = {"classes": "class", "schedule": "class", "tasks": "task", "tests": "test"}
+
+ICS_DAYS = {"MO": 0, "TU": 1, "WE": 2, "TH": 3, "FR": 4, "SA": 5, "SU": 6}
+
+_TEST_WORDS = re.compile(r"\b(quiz|quizzes|exams?|midterms?|finals?|tests?)\b", re.IGNORECASE)
+_TIME = re.compile(r"^(\d{1,2}):(\d{2})(?::\d{2})?$")
+_ICS_DATE = re.compile(r"^(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})(\d{2})?(Z)?)?$")
+_ICS_DURATION = re.compile(r"^P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+class ImportFileError(ValueError):
+    """The upload as a whole can't be read (e.g. malformed JSON)."""
+
+
+class InvalidRecord(ValueError):
+    """One record can't be turned into a class, task or test."""
+
+
+def detect_format(filename=None, content_type=None, head=b""):
+    """Guesses the format from the file name, then the content type, then the first bytes."""
+    extension = filename.rsplit(".", 1)[-1].lower() if filename and "." in filename else ""
+    if extension in ("ics", "ical"):
+        return "ics"
+    if extension in ("csv", "json"):
+        return extension
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type == "text/calendar":
+        return "ics"
+    if content_type in ("text/csv", "application/csv"):
+        return "csv"
+    if content_type == "application/json":
+        return "json"
+    start = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    if start.upper().startswith(b"BEGIN:VCALENDAR"):
+        return "ics"
+    if start[:1] in (b"[", b"{"):
+        return "json"
+    return "csv"
+
+
+def item_key(kind, item):
+    """What makes two items the same, so importing a file twice doesn't add everything twice."""
+    if kind == "class":
+        return kind, item["subject"].casefold(), item["day"], item["start_time"], item["end_time"]
+    if kind == "task":
+        return kind, item["name"].casefold(), item["deadline"]
+    return kind, item["name"].casefold(), item["date"]
+
+
+def is_past(kind, item, now):
+    if kind == "task":
+        return item["deadline"] < now.strftime("%Y-%m-%dT%H:%M:%S")
+    if kind == "test":
+        return item["date"] < now.strftime("%Y-%m-%d")
+    return False
+
+
+# --- Field validation ---
+
+def _text(record, *names):
+    for name in names:
+        value = record.get(name)
+        if isinstance(value, str) and value.strip():
+            return value.strip()
+    return None
+
+
+def _time(value, field):
+    match = _TIME.match(str(value or "").strip())
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise InvalidRecord(f"{field} must be a time in HH:MM format")
+    return f"{int(match.group(1)):02d}:{match.group(2)}"
+
+
+def _day(value):
+    text = str(value or "").strip().casefold()
+    for name in DAY_NAMES:
+        if len(text) >= 3 and name.casefold().startswith(text):
+            return name
+    raise InvalidRecord(f"day must be a weekday name, not '{value}'")
+
+
+def _deadline(value):
+    text = str(value or "").strip().replace(" ", "T", 1)
+    try:
+        if len(text) == 10:
+            return datetime.fromisoformat(text).strftime("%Y-%m-%dT23:59:00")
+        return datetime.fromisoformat(text).strftime("%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        raise InvalidRecord("deadline must be a date (YYYY-MM-DD) or date and time (YYYY-MM-DDTHH:MM)")
+
+
+def _date(value):
+    try:
+        return datetime.fromisoformat(str(value or "").strip()[:10]).strftime("%Y-%m-%d")
+    except ValueError:
+        raise InvalidRecord("date must be in YYYY-MM-DD format")
+
+
+def class_item(subject, day, start_time, end_time):
+    if not subject:
+        raise InvalidRecord("a class needs a subject")
+    start_time, end_time = _time(start_time, "start_time"), _time(end_time, "end_time")
+    if end_time <= start_time:
+        raise InvalidRecord("a class must end after it starts")
+    return {"subject": subject, "day": _day(day), "start_time": start_time, "end_time": end_time}
+
+
+def task_item(name, task_type, deadline):
+    if not name:
+        raise InvalidRecord("a task needs a name")
+    task_type = (task_type or "assignment").strip().lower()
+    if task_type not in TASK_TYPES:
+        raise InvalidRecord(f"task_type must be one of {', '.join(TASK_TYPES)}")
+    return {"name": name, "task_type": task_type, "deadline": _deadline(deadline)}
+
+
+def test_item(name, test_type, date):
+    if not name:
+        raise InvalidRecord("a test needs a name")
+    test_type = (test_type or "exam").strip().lower()
+    if test_type not in TEST_TYPES:
+        raise InvalidRecord(f"test_type must be one of {', '.join(TEST_TYPES)}")
+    return {"name": name, "test_type": test_type, "date": _date(date)}
+
+
+def record_item(record, kind=None):
+    """Turns one CSV row or JSON object into (kind, item). Raises InvalidRecord."""
+    if not isinstance(record, dict):
+        raise InvalidRecord("each record must be an object")
+    record = {str(key).strip().lower(): value for key, value in record.items() if key is not None}
+    item_type = (_text(record, "type", "kind") or "").lower()
+    if item_type in TASK_TYPES:
+        kind = "task"
+        record["task_type"] = _text(record, "task_type") or item_type
+    elif item_type in TEST_TYPES:
+        kind = "test"
+        record["test_type"] = _text(record, "test_type") or item_type
+    elif item_type in KIND_FIELDS:
+        kind = item_type
+    elif item_type:
+        raise InvalidRecord(f"unknown type '{item_type}'")
+    elif kind is None:
+        kind = "class" if record.get("day") else "task" if record.get("deadline") else \
+            "test" if record.get("date") else None
+    if kind is None:
+        raise InvalidRecord("can't tell whether this is a class, task or test")
+
+    if kind == "class":
+        return kind, class_item(_text(record, "subject", "name"), record.get("day"),
+                                record.get("start_time"), record.get("end_time"))
+    if kind == "task":
+        return kind, task_item(_text(record, "name", "subject"), _text(record, "task_type"),
+                               record.get("deadline") or record.get("date"))
+    return kind, test_item(_text(record, "name", "subject"), _text(record, "test_type"),
+                           record.get("date") or record.get("deadline"))
+
+
+# --- CSV and JSON ---
+
+def _parse_csv(text):
+    reader = csv.DictReader(text)
+    for row in reader:
+        if not any((value or "").strip() for value in row.values() if isinstance(value, str)):
+            continue
+        try:
+            yield (reader.line_num, *record_item(row))
+        except InvalidRecord as e:
+            yield reader.line_num, None, str(e)
+
+
+def _parse_json(text):
+    try:
+        data = json.load(text)
+    except json.JSONDecodeError as e:
+        raise ImportFileError(f"The file is not valid JSON: {e}")
+    if isinstance(data, dict):
+        records = [(record, JSON_SECTIONS[section])
+                   for section in JSON_SECTIONS for record in data.get(section) or []]
+    elif isinstance(data, list):
+        records = [(record, None) for record in data]
+    else:
+        raise ImportFileError("A JSON import must be a list of items or an object of lists.")
+    for number, (record, kind) in enumerate(records, 1):
+        try:
+            yield (number, *record_item(record, kind))
+        except InvalidRecord as e:
+            yield number, None, str(e)
+
+
+# --- iCalendar ---
+
+def _unfolded_lines(text):
+    """Joins folded iCalendar lines, yielding (line number, line)."""
+    current, start = None, 0
+    for number, line in enumerate(text, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield start, current
+        current, start = line, number
+    if current is not None:
+        yield start, current
+
+
+def _property(line):
+    """Splits 'NAME;PARAM=VALUE:value' into (NAME, {PARAM: VALUE}, value)."""
+    head, _, value = line.partition(":")
+    name, *params = head.split(";")
+    parameters = {}
+    for param in params:
+        key, _, param_value = param.partition("=")
+        parameters[key.upper()] = param_value.strip('"')
+    return name.upper(), parameters, value
+
+
+def _ics_text(value):
+    return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value).strip()
+
+
+def _ics_datetime(value, parameters):
+    """Returns (naive local datetime, is_all_day) for a DATE or DATE-TIME value."""
+    match = _ICS_DATE.match(value.strip())
+    if not match:
+        raise InvalidRecord(f"can't read the date '{value}'")
+    year, month, day, hour, minute, second, utc = match.groups()
+    if hour is None:
+        return datetime(int(year), int(month), int(day)), True
+    moment = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0))
+    zone = timezone.utc if utc else None
+    if zone is None and parameters.get("TZID") and ZoneInfo is not None:
+        try:
+            zone = ZoneInfo(parameters["TZID"])
+        except Exception:
+            zone = None
+    if zone is not None:
+        # Stored times are the server's local wall-clock times, like everything else in the app.
+        moment = moment.replace(tzinfo=zone).astimezone().replace(tzinfo=None)
+    return moment, False
+
+
+def _ics_minutes(duration):
+    match = _ICS_DURATION.match(duration.strip().lstrip("+"))
+    if not match:
+        raise InvalidRecord(f"can't read the duration '{duration}'")
+    weeks, days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((weeks * 7 + days) * 24 + hours) * 60 + minutes + seconds // 60
+
+
+def _ics_component_items(kind, props, now):
+    """Turns one VEVENT/VTODO into [(kind, item)]; a class may come out once per weekday."""
+    summary = _ics_text(props.get("SUMMARY", ({}, ""))[1]) or None
+    categories = _ics_text(props.get("CATEGORIES", ({}, ""))[1]).lower()
+
+    if kind == "VTODO":
+        if props.get("STATUS", ({}, ""))[1].upper() == "COMPLETED":
+            return [("task", "completed")]
+        due = props.get("DUE") or props.get("DTSTART")
+        if due is None:
+            raise InvalidRecord("a to-do needs a DUE date")
+        moment, all_day = _ics_datetime(due[1], due[0])
+        task_type = next((word for word in TASK_TYPES if word in categories), None)
+        deadline = moment.strftime("%Y-%m-%dT23:59:00" if all_day else "%Y-%m-%dT%H:%M:%S")
+        return [("task", task_item(summary, task_type, deadline))]
+
+    if "DTSTART" not in props:
+        raise InvalidRecord("an event needs a DTSTART")
+    start, all_day = _ics_datetime(props["DTSTART"][1], props["DTSTART"][0])
+
+    rule = props.get("RRULE")
+    if rule is not None:
+        parts = dict(part.partition("=")[::2] for part in rule[1].upper().split(";") if part)
+        if parts.get("FREQ") not in ("WEEKLY", "DAILY"):
+            raise InvalidRecord("only weekly or daily repeating events can be imported as classes")
+        if all_day:
+            raise InvalidRecord("an all-day repeating event can't be a class")
+        if "UNTIL" in parts and _ics_datetime(parts["UNTIL"], {})[0].date() < now.date():
+            return [("class", "past")]
+        if "DTEND" in props:
+            end = _ics_datetime(props["DTEND"][1], props["DTEND"][0])[0]
+        elif "DURATION" in props:
+            end = start + timedelta(minutes=_ics_minutes(props["DURATION"][1]))
+        else:
+            raise InvalidRecord("a repeating event needs a DTEND or DURATION")
+        if parts.get("BYDAY"):
+            days = sorted({ICS_DAYS[code[-2:]] for code in parts["BYDAY"].split(",") if code[-2:] in ICS_DAYS})
+        elif parts["FREQ"] == "DAILY":
+            days = range(len(DAY_NAMES))
+        else:
+            days = [start.weekday()]
+        return [("class", class_item(summary, DAY_NAMES[day], start.strftime("%H:%M"), end.strftime("%H:%M")))
+                for day in days]
+
+    test_word = _TEST_WORDS.search(f"{summary or ''} {categories}")
+    if test_word:
+        test_type = "quiz" if test_word.group(1).lower().startswith("quiz") else "exam"
+        return [("test", test_item(summary, test_type, start.strftime("%Y-%m-%d")))]
+    task_type = next((word for word in TASK_TYPES if word in categories or word in (summary or "").lower()), None)
+    deadline = start.strftime("%Y-%m-%dT23:59:00" if all_day else "%Y-%m-%dT%H:%M:%S")
+    return [("task", task_item(summary, task_type, deadline))]
+
+
+def _parse_ics(text, now):
+    component, props, start_line, depth = None, None, 0, 0
+    saw_calendar = False
+    for number, line in _unfolded_lines(text):
+        if not line.strip():
+            continue
+        name, parameters, value = _property(line)
+        if name == "BEGIN":
+            value = value.upper()
+            saw_calendar = saw_calendar or value == "VCALENDAR"
+            if component is not None:
+                depth += 1  # e.g. a VALARM inside an event; its properties aren't the event's
+            elif value in ("VEVENT", "VTODO"):
+                component, props, start_line, depth = value, {}, number, 0
+        elif name == "END" and component is not None:
+            if depth:
+                depth -= 1
+                continue
+            try:
+                for kind, item in _ics_component_items(component, props, now):
+                    yield start_line, kind, item
+            except InvalidRecord as e:
+                yield start_line, None, str(e)
+            component = None
+        elif component is not None and not depth and name not in props:
+            props[name] = (parameters, value)
+    if not saw_calendar:
+        raise ImportFileError("The file is not an iCalendar file (no BEGIN:VCALENDAR).")
+
+
+def parse_import(stream, file_format, now=None):
+    """
+    Reads a binary file object in one pass and yields (number, kind, item,
+    problem) for every record, where number is the line (CSV, iCalendar) or
+    record (JSON) it came from. For a valid item, problem is None; items that
+    are already over come out with problem "past" (and "completed" for
+    finished to-dos). A record that can't be imported has kind and item None
+    and the reason in problem. Raises ImportFileError if the file as a whole
+    can't be read.
+    """
+    now = now or datetime.now()
+    if file_format not in FORMATS:
+        raise ImportFileError(f"Unsupported format '{file_format}'; use one of {', '.join(FORMATS)}.")
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    records = {"csv": _parse_csv, "json": _parse_json}.get(file_format)
+    records = records(text) if records else _parse_ics(text, now)
+    for number, kind, item in records:
+        if kind is None:
+            yield number, None, None, item
+        elif isinstance(item, str):
+            yield number, kind, None, item
+        elif is_past(kind, item, now):
+            yield number, kind, item, "past"
+        else:
+            yield number, kind, item, None
@@ -0,0 +1,142 @@
+"""
+Local intent router for chat messages with a fixed meaning.
+
+The daily check-in trigger, the scripted check-in replies from the system
+prompt ("Looks good!", "I have 2 hours") and a few well-formed commands
+("update my plan", "delete Math", "add exam Physics on 2030-01-09") always
+map to the same tool calls, so they are answered without a model round trip.
+
+route_message() only answers when the whole message matches one of the
+patterns below (and, for deletes, names an item the user actually has).
+Acknowledgements like "ok" only count as a check-in reply right after the
+check-in; anywhere else they may be answering the model's own question.
+Anything else returns None and goes to the model as before.
+"""
+import re
+from datetime import datetime
+
+DAILY_CHECKIN = "trigger:daily_checkin"
+
+PAST_DATE_REPLY = ("Sorry, I can't add items for dates that have already passed. "
+                   "Please provide a future date.")
+ENCOURAGEMENT_REPLY = "Great! Enjoy your study plan for today. You've got this!"
+
+ACKNOWLEDGEMENTS = {
+    "looks good", "looks good to me", "sounds good", "all good", "perfect", "great",
+    "ok", "okay", "thanks", "thank you", "good",
+}
+
+NUMBER_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6}
+
+TASK_TYPES = ("assignment", "project", "seatwork")
+TEST_TYPES = ("quiz", "exam")
+
+_AVAILABLE_TIME = re.compile(
+    r"^i (?:only |just )?have (?:about |around )?(?P<amount>\d+(?:\.\d+)?|an?|one|two|three|four|five|six)"
+    r"(?P<half> and a half)? (?P<unit>hours?|hrs?|minutes?|mins?)(?(half)|(?P<half_after> and a half)?)"
+    r"(?P<rest>.*)$")
+_FLOATING = re.compile(
+    r"^(?:,? ?(?:but |and )?(?:no |without (?:a |any )?)specific time(?: today)?| today| free(?: today)?)?$")
+_SPECIFIC = re.compile(
+    r"^,? ?(?:only )?(?:at|in the|during|before|after|from|between|around|this) ")
+_MAKE_PLAN = re.compile(
+    r"^(?:can you |could you |please )?(?:make|generate|create|update|regenerate|redo|rebuild) "
+    r"my (?:study )?plan(?: please)?$")
+_TODAYS_PLAN = re.compile(
+    r"^(?:what(?:'s| is) my plan (?:for )?today|show (?:me )?(?:my )?plan for today|today'?s plan|"
+    r"what do i have (?:to do )?today)$")
+_DELETE = re.compile(r"^(?:please )?(?:delete|remove) (?:my |the )?(?P<name>.+)$", re.IGNORECASE)
+_ITEM_WORD = re.compile(r" (?:class|task|test|quiz|exam)$", re.IGNORECASE)
+_ADD = re.compile(
+    r"^add (?:a |an |my )?(?P<type>assignment|project|seatwork|quiz|exam) (?:called |named )?"
+    r"(?P<name>.+?) (?:due|on) (?P<date>\d{4}-\d{2}-\d{2})(?:[ T](?P<time>\d{1,2}:\d{2}))?$",
+    re.IGNORECASE)
+
+
+def normalize(message):
+    """Lowercases, collapses whitespace and drops trailing punctuation."""
+    return re.sub(r"\s+", " ", (message or "").strip().lower()).rstrip("!.? ")
+
+
+def _call(tool, **arguments):
+    return {"tool_calls": [{"name": tool, "arguments": arguments}], "content": None}
+
+
+def _reply(content):
+    return {"tool_calls": [], "content": content}
+
+
+def _hours(match):
+    amount = match.group("amount")
+    value = float(NUMBER_WORDS.get(amount, amount))
+    if match.group("half") or match.group("half_after"):
+        value += 0.5
+    if match.group("unit").startswith("m"):
+        value /= 60
+    return int(value) if value == int(value) else round(value, 2)
+
+
+def _has_item(user_data, name):
+    wanted = name.casefold()
+    for field, name_field in (("tasks", "name"), ("tests", "name"), ("schedule", "subject")):
+        for item in user_data.get(field, []):
+            if str(item.get(name_field, "")).casefold() == wanted:
+                return True
+    return False
+
+
+def route_message(message, user_data, now=None, after_checkin=False):
+    """
+    Returns {"tool_calls": [{"name", "arguments"}], "content": str | None} for
+    a message with a fixed meaning, or None if the model should handle it.
+    `after_checkin` says the user's previous message was the daily check-in.
+    """
+    now = now or datetime.now()
+    text = normalize(message)
+    if not text:
+        return None
+
+    if text == DAILY_CHECKIN:
+        return _call("get_daily_plan")
+    if text in ACKNOWLEDGEMENTS:
+        return _reply(ENCOURAGEMENT_REPLY) if after_checkin else None
+    if _MAKE_PLAN.match(text):
+        return _call("run_planner_engine")
+    if _TODAYS_PLAN.match(text):
+        return _call("get_daily_plan")
+
+    available = _AVAILABLE_TIME.match(text)
+    if available:
+        rest = available.group("rest")
+        if _FLOATING.match(rest):
+            return _call("get_priority_list", hours=_hours(available))
+        if _SPECIFIC.match(rest):
+            return _call("reschedule_day", new_constraints=message.strip())
+        return None
+
+    original = re.sub(r"\s+", " ", message.strip()).rstrip("!. ")
+    added = _ADD.match(original)
+    if added:
+        kind = added.group("type").lower()
+        name = added.group("name").strip("'\" ")
+        hours, minutes = (added.group("time") or "23:59").split(":")
+        try:
+            due = datetime.fromisoformat(f"{added.group('date')}T{int(hours):02d}:{minutes}")
+        except ValueError:
+            return None
+        if not name:
+            return None
+        if due < now if kind in TASK_TYPES else due.date() < now.date():
+            return _reply(PAST_DATE_REPLY)
+        if kind in TASK_TYPES:
+            return _call("save_task", name=name, task_type=kind, deadline=due.strftime("%Y-%m-%dT%H:%M:%S"))
+        return _call("save_test", name=name, test_type=kind, date=due.strftime("%Y-%m-%d"))
+
+    deleted = _DELETE.match(original)
+    if deleted:
+        # "delete History test" may mean the test "History" or the item "History test".
+        name = deleted.group("name").strip("'\" ")
+        for candidate in (name, _ITEM_WORD.sub("", name)):
+            if candidate and _has_item(user_data, candidate):
+                return _call("delete_schedule_item", item_name=candidate)
+    return None
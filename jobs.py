@@ -0,0 +1,187 @@
+"""
+A small per-key debounced job queue backed by a thread pool, and a bounded
+pool for one-off calls.
+
+Work submitted for the same key (e.g. a username) within the debounce window
+is merged into a single run, and a key never runs twice at the same time:
+anything submitted while its job is running is merged and run once more when
+the current run finishes. Jobs run off the request thread, so callers return
+immediately.
+"""
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+KEY_LOCK_STRIPES = 64
+
+
+class CoalescingJobQueue:
+    def __init__(self, handler, merge, debounce_seconds=0.5, max_workers=4, name="jobs"):
+        """
+        `handler(key, payload)` does the work. `merge(old_payload, new_payload)`
+        combines two pending payloads for the same key into one.
+        """
+        self.handler = handler
+        self.merge = merge
+        self.debounce_seconds = debounce_seconds
+        self.max_workers = max_workers
+        self.name = name
+
+        self._lock = threading.Condition()
+        self._pending = {}      # key -> merged payload waiting to run
+        self._due = []          # heap of (due_time, key)
+        self._running = set()   # keys with a job currently executing
+        self._executor = None
+        self._dispatcher = None
+        # Per-key (striped) locks for locked(); submit() takes them too.
+        self._key_locks = [threading.RLock() for _ in range(KEY_LOCK_STRIPES)]
+
+    @contextmanager
+    def locked(self, key):
+        """
+        Holds off submit() for `key` while the block runs, so a caller can
+        check has_pending() and record the outcome (or submit and record that
+        it is queued) without another submit slipping in between.
+        """
+        with self._key_locks[hash(key) % KEY_LOCK_STRIPES]:
+            yield
+
+    def submit(self, key, payload):
+        """Queues `payload` for `key`, merging it with anything already waiting."""
+        with self.locked(key), self._lock:
+            self._ensure_started()
+            if key in self._pending:
+                self._pending[key] = self.merge(self._pending[key], payload)
+                return
+            self._pending[key] = payload
+            if key not in self._running:
+                heapq.heappush(self._due, (time.monotonic() + self.debounce_seconds, key))
+                self._lock.notify()
+
+    def has_pending(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def _ensure_started(self):
+        # Started lazily so that importing the app (or forking it) doesn't spawn threads.
+        if self._dispatcher is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix=self.name)
+            self._dispatcher = threading.Thread(target=self._dispatch_loop,
+                                                name=f"{self.name}-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    timeout = self._due[0][0] - time.monotonic() if self._due else None
+                    self._lock.wait(timeout)
+                _, key = heapq.heappop(self._due)
+                if key in self._running or key not in self._pending:
+                    continue
+                payload = self._pending.pop(key)
+                self._running.add(key)
+            self._executor.submit(self._run, key, payload)
+
+    def _run(self, key, payload):
+        try:
+            self.handler(key, payload)
+        except Exception:
+            logger.exception("Error in background %s job for %s", self.name, key)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+                if key in self._pending:
+                    # More work arrived while we were running; go again right away.
+                    heapq.heappush(self._due, (time.monotonic(), key))
+                    self._lock.notify()
+
+
+class QueueFullError(Exception):
+    """Raised by BoundedExecutor.submit() when every worker is busy and the queue is full."""
+
+
+class BoundedExecutor:
+    """
+    Runs submitted calls on `max_workers` threads, with at most `max_queued`
+    more waiting for one. submit() never blocks: past that it raises
+    QueueFullError, so a request can answer "busy" at once.
+    """
+
+    def __init__(self, max_workers, max_queued, name="workers"):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.name = name
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._executor = None
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError()
+        with self._lock:
+            if self._executor is None:
+                # Started lazily so that importing the app (or forking it) doesn't spawn threads.
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+            self._in_flight += 1
+        try:
+            self._executor.submit(self._run, fn, args)
+        except Exception:
+            self._done()
+            raise
+
+    def in_flight(self):
+        """Calls running or waiting for a worker."""
+        with self._lock:
+            return self._in_flight
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Error in background %s job", self.name)
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+
+class PeriodicJob:
+    """Runs `fn()` every `interval_seconds` on a daemon thread, started on first use."""
+
+    def __init__(self, fn, interval_seconds, name="periodic"):
+        self.fn = fn
+        self.interval_seconds = interval_seconds
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.fn()
+            except Exception:
+                logger.exception("Error in background %s job", self.name)
+            self._stop.wait(self.interval_seconds)
@@ -0,0 +1,143 @@
+"""
+Per-user chat turn serialization and a token bucket for upstream calls.
+
+`TurnGate` lets one chat turn per user run at a time (in this process), so
+two tabs or a double submit can't build their turns from the same history
+and race on saving it. A request that repeats a message already in flight
+for that user doesn't run again: it waits for the first one (or registers
+a callback for it) and gets the same result. Only a few turns may wait per user; beyond that, or after
+waiting too long, the caller gets TurnBusyError straight away.
+
+`TokenBucket` caps the rate of upstream calls. `try_acquire()` never blocks,
+so callers can shed load with a fast "try again" instead of queueing.
+"""
+import threading
+import time
+
+
+class TurnBusyError(Exception):
+    """The user already has as many chat turns running or waiting as allowed."""
+
+
+class InFlightTurn:
+    """One chat turn, shared by every identical request that arrives while it runs."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def finish(self, result=None, error=None):
+        with self._lock:
+            self.result, self.error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(result, error)
+
+    def add_done_callback(self, callback):
+        """Calls `callback(result, error)` once the turn finishes (right away if it has), without waiting."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self.result, self.error)
+
+    def wait(self, timeout):
+        """The turn's result, once the request running it has finished."""
+        if not self._done.wait(timeout):
+            raise TurnBusyError()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _UserTurns:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}   # key -> InFlightTurn
+        self.queued = 0     # turns running or waiting for the lock
+
+
+class TurnGate:
+    def __init__(self, max_queued=2, wait_seconds=60.0):
+        self.max_queued = max_queued
+        self.wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._users = {}
+
+    def enter(self, username, key):
+        """
+        Registers a turn. Returns (turn, leader): the leader must call
+        acquire(), run the turn and then leave(); anyone else just waits on
+        `turn`. Raises TurnBusyError if the user's queue is full.
+        """
+        with self._lock:
+            user = self._users.setdefault(username, _UserTurns())
+            turn = user.flights.get(key)
+            if turn is not None:
+                return turn, False
+            if user.queued >= self.max_queued:
+                raise TurnBusyError()
+            turn = user.flights[key] = InFlightTurn()
+            user.queued += 1
+            return turn, True
+
+    def acquire(self, username, key, turn):
+        """Waits for the user's earlier turns to finish. Raises TurnBusyError (and cancels) on timeout."""
+        user = self._users[username]
+        if not user.lock.acquire(timeout=self.wait_seconds):
+            self.cancel(username, key, turn)
+            raise TurnBusyError()
+
+    def leave(self, username, key, turn, result=None, error=None):
+        """Ends a turn that acquire()d the user's lock, handing `result` to anyone waiting on it."""
+        self._leave(username, key, turn, locked=True)
+        turn.finish(result, error)
+
+    def cancel(self, username, key, turn):
+        """Ends a turn that never acquired the lock; anyone waiting on it gets TurnBusyError."""
+        self._leave(username, key, turn, locked=False)
+        turn.finish(error=TurnBusyError())
+
+    def _leave(self, username, key, turn, locked):
+        with self._lock:
+            user = self._users[username]
+            if user.flights.get(key) is turn:
+                del user.flights[key]
+            user.queued -= 1
+            if locked:
+                user.lock.release()
+            if not user.queued and not user.flights:
+                del self._users[username]
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def retry_after(self, tokens=1):
+        """Seconds until `tokens` would be available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self._tokens) / self.rate) if self.rate > 0 else float("inf")
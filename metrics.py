@@ -0,0 +1,208 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and histograms are kept per process and rendered by `render()` for
+the /metrics route. `span(name)` times a block of code into the
+`smartscheduler_span_seconds` histogram and, inside a request, also adds it
+to that request's list of spans so a slow request can be logged with a
+breakdown of where its time went. `MongoCommandListener` does the same for
+every MongoDB command.
+"""
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._values = {}   # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_label_text(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(labels + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {series[-1]}")
+        return lines
+
+
+def counter(name, help_text):
+    with _lock:
+        return _metrics.setdefault(name, Counter(name, help_text))
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    with _lock:
+        return _metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+
+def register_collector(collect):
+    """`collect()` returns extra exposition lines (e.g. gauges read from elsewhere) on every scrape."""
+    _collectors.append(collect)
+
+
+def gauge_lines(name, help_text, values, kind="gauge"):
+    """
+    Exposition lines for a gauge from {labels_tuple_or_None: value}. Pass
+    kind="counter" for a value read from elsewhere that only ever goes up.
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in values.items():
+        lines.append(f"{name}{_label_text(labels or ())} {value if value is not None else 'NaN'}")
+    return lines
+
+
+def render():
+    lines = []
+    with _lock:
+        metrics = list(_metrics.values())
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            lines.extend(collect())
+        except Exception:
+            logger.exception("Metrics collector failed")
+    return "\n".join(lines) + "\n"
+
+
+# --- Spans ---
+
+span_seconds = histogram("smartscheduler_span_seconds", "Time spent in instrumented code paths.")
+
+
+def start_request_spans():
+    """Starts collecting spans for the current request; returns the token for end_request_spans()."""
+    return _request_spans.set([])
+
+
+def end_request_spans(token):
+    """Stops collecting and returns this request's [(name, seconds)]."""
+    spans = _request_spans.get() or []
+    _request_spans.reset(token)
+    return spans
+
+
+def record_span(name, seconds, **labels):
+    span_seconds.observe(seconds, span=name, **labels)
+    spans = _request_spans.get()
+    if spans is not None:
+        label = ",".join(f"{value}" for value in labels.values())
+        spans.append((f"{name}[{label}]" if label else name, seconds))
+
+
+@contextmanager
+def span(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- MongoDB ---
+
+mongo_seconds = histogram("smartscheduler_mongo_command_seconds", "MongoDB command round-trip time.")
+mongo_failures = counter("smartscheduler_mongo_command_failures_total", "MongoDB commands that failed.")
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every MongoDB command by command name and collection."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._pending[(event.connection_id, event.request_id)] = (
+            event.command_name, collection if isinstance(collection, str) else "")
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        command, collection = self._finish(event)
+        mongo_failures.inc(command=command, collection=collection)
+
+    def _finish(self, event):
+        command, collection = self._pending.pop((event.connection_id, event.request_id),
+                                                (event.command_name, ""))
+        seconds = event.duration_micros / 1e6
+        mongo_seconds.observe(seconds, command=command, collection=collection)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((f"mongo.{command}[{collection}]", seconds))
+        return command, collection
@@ -0,0 +1,676 @@
+"""
+The Smart Scheduler planning engine.
+
+Everything in here is pure Python working on plain dicts (the same shapes that
+are stored in MongoDB), so it can be called from the Flask routes, from the
+chat tool dispatcher, or from a script without touching the database.
+
+The engine works in three steps:
+1.  Build the free study intervals for each weekday once: the user's
+    `study_windows`, clipped to their awake/sleep `preferences`, minus their
+    recurring `schedule` classes.
+2.  Turn `tasks` and `tests` into work items with an estimated effort and a due
+    time.
+3.  Walk the free intervals day by day over the planning horizon and fill them
+    earliest-deadline-first from a heap, crediting work by the window's
+    `focus_level`.
+
+Since the weekly intervals are computed once and each work item enters and
+leaves the heap once, a plan costs O(days * windows + items * log(items)).
+
+`priority_list` answers the check-in's "I have N hours" with the most
+pressing work that fits in that time, and `reschedule_today` re-fills just
+today's remaining time when the user's availability for today changes.
+"""
+import heapq
+import re
+from datetime import datetime, timedelta
+
+DAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+DEFAULT_HORIZON_DAYS = 60
+DEFAULT_AWAKE_TIME = "07:00"
+DEFAULT_SLEEP_TIME = "23:00"
+
+# Used when the user hasn't set any study windows yet, so new tasks still land somewhere.
+DEFAULT_STUDY_WINDOW = {"start_time": "19:00", "end_time": "21:00", "focus_level": "medium"}
+
+# How much of a minute of work actually "counts" in a window of the given focus level.
+FOCUS_WEIGHTS = {"high": 1.0, "medium": 0.8, "low": 0.5}
+
+# Rough effort estimates (in focused minutes) per task/test type.
+EFFORT_MINUTES = {
+    "seatwork": 45,
+    "assignment": 120,
+    "project": 360,
+    "quiz": 120,
+    "exam": 300,
+}
+DEFAULT_EFFORT_MINUTES = 90
+
+MIN_BLOCK_MINUTES = 25
+MAX_BLOCK_MINUTES = 90
+BREAK_MINUTES = 10
+BLOCK_GRANULARITY = 5
+END_OF_DAY = 24 * 60 - 1  # blocks end by 23:59; "24:00" isn't a time of day
+
+
+# --- Time helpers ---
+
+def parse_hhmm(value):
+    """Parses 'HH:MM' (or 'HH:MM:SS') into minutes after midnight. Returns None if invalid."""
+    if not value or not isinstance(value, str):
+        return None
+    parts = value.strip().split(":")
+    try:
+        hours, minutes = int(parts[0]), int(parts[1]) if len(parts) > 1 else 0
+    except ValueError:
+        return None
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        return None
+    return min(hours * 60 + minutes, 24 * 60)
+
+
+def format_hhmm(minutes):
+    """Formats minutes after midnight as 'HH:MM'. The end of the day is '23:59'."""
+    minutes = min(minutes, END_OF_DAY)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def parse_deadline(value):
+    """
+    Parses a stored deadline ('YYYY-MM-DDTHH:MM:SS', 'YYYY-MM-DD HH:MM' or
+    'YYYY-MM-DD') into a naive datetime. Date-only deadlines mean end of day.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.replace(tzinfo=None)
+    if len(value) == 10:
+        parsed = parsed.replace(hour=23, minute=59)
+    return parsed
+
+
+def weekday_index(day_name):
+    """Maps 'Monday', 'mon', 'MONDAY' etc. to 0-6. Returns None if unknown."""
+    if not day_name or not isinstance(day_name, str):
+        return None
+    prefix = day_name.strip().lower()[:3]
+    for index, name in enumerate(DAY_NAMES):
+        if name.lower().startswith(prefix):
+            return index
+    return None
+
+
+# --- Interval helpers ---
+
+def merge_intervals(intervals):
+    """Sorts and merges overlapping (start, end) intervals."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(base, cuts):
+    """
+    Removes the merged, sorted `cuts` from the sorted `base` intervals with a
+    single sweep. `base` items may carry extra fields after (start, end).
+    """
+    result = []
+    j = 0
+    for item in base:
+        start, end, extra = item[0], item[1], item[2:]
+        while j < len(cuts) and cuts[j][1] <= start:
+            j += 1
+        k = j
+        while k < len(cuts) and cuts[k][0] < end:
+            cut_start, cut_end = cuts[k]
+            if cut_start > start:
+                result.append((start, cut_start) + extra)
+            start = max(start, cut_end)
+            k += 1
+        if start < end:
+            result.append((start, end) + extra)
+    return result
+
+
+def awake_intervals(preferences):
+    """The part of the day the user is awake, as a list of (start, end) minutes."""
+    preferences = preferences or {}
+    awake = parse_hhmm(preferences.get("awake_time"))
+    sleep = parse_hhmm(preferences.get("sleep_time"))
+    if awake is None:
+        awake = parse_hhmm(DEFAULT_AWAKE_TIME)
+    if sleep is None:
+        sleep = parse_hhmm(DEFAULT_SLEEP_TIME)
+    if awake < sleep:
+        return [(awake, sleep)]
+    # Sleeping after midnight (e.g. awake 08:00, sleep 01:00)
+    return [(0, sleep), (awake, 24 * 60)]
+
+
+def weekly_free_intervals(study_windows, schedule, preferences):
+    """
+    Returns a list of 7 lists (Monday..Sunday) of (start, end, focus_level)
+    free study intervals in minutes after midnight.
+    """
+    windows_by_day = [[] for _ in DAY_NAMES]
+    for window in study_windows or []:
+        day = weekday_index(window.get("day"))
+        start = parse_hhmm(window.get("start_time"))
+        end = parse_hhmm(window.get("end_time"))
+        if day is None or start is None or end is None or start >= end:
+            continue
+        focus = window.get("focus_level") if window.get("focus_level") in FOCUS_WEIGHTS else "medium"
+        windows_by_day[day].append((start, end, focus))
+
+    if not any(windows_by_day):
+        start = parse_hhmm(DEFAULT_STUDY_WINDOW["start_time"])
+        end = parse_hhmm(DEFAULT_STUDY_WINDOW["end_time"])
+        windows_by_day = [[(start, end, DEFAULT_STUDY_WINDOW["focus_level"])] for _ in DAY_NAMES]
+
+    classes_by_day = [[] for _ in DAY_NAMES]
+    for item in schedule or []:
+        day = weekday_index(item.get("day"))
+        start = parse_hhmm(item.get("start_time"))
+        end = parse_hhmm(item.get("end_time"))
+        if day is None or start is None or end is None or start >= end:
+            continue
+        classes_by_day[day].append((start, end))
+
+    awake = awake_intervals(preferences)
+    asleep = subtract_intervals([(0, 24 * 60)], awake)
+
+    free_by_day = []
+    for day in range(len(DAY_NAMES)):
+        # Overlapping windows keep the first (sorted) window's focus level.
+        windows = []
+        for start, end, focus in sorted(windows_by_day[day]):
+            if windows and start < windows[-1][1]:
+                start = windows[-1][1]
+            if start < end:
+                windows.append((start, end, focus))
+        blocked = merge_intervals(classes_by_day[day] + asleep)
+        free_by_day.append(subtract_intervals(windows, blocked))
+    return free_by_day
+
+
+# --- Work items ---
+
+def build_work_items(tasks, tests, now):
+    """Turns pending tasks and tests into work items sorted by due time."""
+    items = []
+    for task in tasks or []:
+        due = parse_deadline(task.get("deadline"))
+        if due is None or due <= now:
+            continue
+        items.append({
+            "id": task.get("id"),
+            "name": task.get("name", "Task"),
+            "label": f"Work on {task.get('name', 'Task')}",
+            "due": due,
+            "effort": EFFORT_MINUTES.get(task.get("task_type"), DEFAULT_EFFORT_MINUTES),
+        })
+    for test in tests or []:
+        due = parse_deadline(test.get("date"))
+        if due is None:
+            continue
+        # Studying has to happen before the day of the test.
+        due = due.replace(hour=0, minute=0)
+        if due <= now:
+            continue
+        items.append({
+            "id": test.get("id"),
+            "name": test.get("name", "Test"),
+            "label": f"Study for {test.get('name', 'Test')}",
+            "due": due,
+            "effort": EFFORT_MINUTES.get(test.get("test_type"), DEFAULT_EFFORT_MINUTES),
+        })
+    items.sort(key=lambda item: item["due"])
+    return items
+
+
+# --- The engine ---
+
+def fill_intervals(day, intervals, heap, plan, unfinished):
+    """
+    Fills one day's free (start, end, focus) intervals earliest-deadline-first
+    from `heap` (entries are [due, seq, item, remaining_effort]), appending
+    blocks to `plan`. Items whose deadline passes are moved to `unfinished`.
+    """
+    date_str = day.strftime("%Y-%m-%d")
+    for start, end, focus in intervals:
+        end = min(end, END_OF_DAY)
+        weight = FOCUS_WEIGHTS[focus]
+        cursor = start
+        while heap and end - cursor >= MIN_BLOCK_MINUTES:
+            slot_start = day + timedelta(minutes=cursor)
+            while heap and heap[0][0] <= slot_start:
+                unfinished.append(heapq.heappop(heap)[2])
+            if not heap:
+                break
+            entry = heap[0]
+            due_minutes = int((entry[0] - day).total_seconds() // 60)
+            limit = min(end, due_minutes, cursor + MAX_BLOCK_MINUTES)
+            if limit - cursor < MIN_BLOCK_MINUTES:
+                # Too close to this item's deadline for a useful block.
+                unfinished.append(heapq.heappop(heap)[2])
+                continue
+            # Wall-clock minutes still needed, rounded up to the block granularity.
+            needed = -(-entry[3] // (weight * BLOCK_GRANULARITY)) * BLOCK_GRANULARITY
+            length = int(min(limit - cursor, max(needed, MIN_BLOCK_MINUTES)))
+            block = {
+                "date": date_str,
+                "start_time": format_hhmm(cursor),
+                "end_time": format_hhmm(cursor + length),
+                "task": entry[2]["label"],
+            }
+            if entry[2]["id"]:
+                block["item_id"] = entry[2]["id"]
+            plan.append(block)
+            entry[3] -= length * weight
+            if entry[3] <= 0:
+                heapq.heappop(heap)
+            cursor += length + BREAK_MINUTES
+
+
+def build_plan(schedule, tasks, tests, preferences, study_windows, now=None,
+               horizon_days=DEFAULT_HORIZON_DAYS):
+    """
+    Builds the `generated_plan` for the next `horizon_days` days.
+
+    Returns (plan, unfinished) where `plan` is a list of
+    {"date", "start_time", "end_time", "task", "item_id"} blocks sorted by date
+    and time (`item_id` is the id of the task or test the block works on),
+    and `unfinished` lists the work items that could not be fully scheduled
+    before their deadline.
+    """
+    now = now or datetime.now()
+    free_by_day = weekly_free_intervals(study_windows, schedule, preferences)
+    items = build_work_items(tasks, tests, now)
+
+    heap = [[item["due"], seq, item, item["effort"]] for seq, item in enumerate(items)]
+    heapq.heapify(heap)
+
+    plan = []
+    unfinished = []
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    now_minutes = now.hour * 60 + now.minute + (1 if now.second or now.microsecond else 0)
+    for offset in range(horizon_days):
+        if not heap:
+            break
+        day = today + timedelta(days=offset)
+        intervals = free_by_day[day.weekday()]
+        if offset == 0:
+            intervals = subtract_intervals(intervals, [(0, now_minutes)])
+        fill_intervals(day, intervals, heap, plan, unfinished)
+
+    return plan, unfinished
+
+
+# --- Priority list ---
+
+def _pending_work(tasks, tests, now):
+    """
+    Yields (pressure, -minutes_left, -seq, work) for every pending task and
+    test, so that the natural tuple order puts the most pressing (then the
+    soonest due, then the first listed) item first.
+    """
+    seq = 0
+    for kind, entries, date_field, type_field, label in (
+            ("task", tasks, "deadline", "task_type", "Work on"),
+            ("test", tests, "date", "test_type", "Study for")):
+        for entry in entries or []:
+            due = parse_deadline(entry.get(date_field))
+            if due is None:
+                continue
+            if kind == "test":
+                due = due.replace(hour=0, minute=0)
+            minutes_left = (due - now).total_seconds() / 60
+            if minutes_left <= 0:
+                continue
+            effort = EFFORT_MINUTES.get(entry.get(type_field), DEFAULT_EFFORT_MINUTES)
+            seq += 1
+            # The share of the time left that the work needs; above 1 it is already at risk.
+            yield effort / minutes_left, -minutes_left, -seq, (entry, kind, label, effort, due)
+
+
+def priority_list(tasks, tests, budget_minutes, now=None):
+    """
+    Picks what to work on with `budget_minutes` of free time. Pending tasks and
+    tests are ranked by deadline pressure (estimated effort / time left until
+    due) and taken most pressing first while they fit; the first one that
+    doesn't fit gets the rest of the budget as a partial session.
+
+    Only the few candidates that could possibly be picked are kept (in a heap),
+    so this is O(n log k) for n pending items and k picks.
+
+    Returns a list of {"id", "name", "label", "kind", "due", "minutes", "partial"}.
+    """
+    now = now or datetime.now()
+    budget_minutes = int(budget_minutes)
+    if budget_minutes <= 0:
+        return []
+    # Each full pick uses at least the smallest effort, and we stop after a partial one.
+    most_picks = budget_minutes // min(EFFORT_MINUTES.values()) + 1
+    candidates = heapq.nlargest(most_picks, _pending_work(tasks, tests, now))
+
+    picks = []
+    remaining = budget_minutes
+    for _, _, _, (entry, kind, label, effort, due) in candidates:
+        minutes = min(effort, remaining)
+        if minutes < effort and minutes < min(MIN_BLOCK_MINUTES, budget_minutes):
+            break
+        name = entry.get("name", kind.title())
+        picks.append({"id": entry.get("id"), "name": name, "label": f"{label} {name}", "kind": kind,
+                      "due": due, "minutes": minutes, "partial": minutes < effort})
+        remaining -= minutes
+        if minutes < effort or remaining <= 0:
+            break
+    return picks
+
+
+# --- Same-day rescheduling ---
+
+DAY_PERIODS = {
+    "morning": ("08:00", "12:00"),
+    "lunch": ("12:00", "13:00"),
+    "noon": ("12:00", "13:00"),
+    "afternoon": ("13:00", "17:00"),
+    "evening": ("18:00", "22:00"),
+    "tonight": ("19:00", "23:00"),
+    "night": ("19:00", "23:00"),
+}
+_NUMBER_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6}
+_CLOCK = r"(\d{1,2})(?::(\d{2}))?\s*(am|pm)?"
+_RANGE = re.compile(r"(?:from |between )?" + _CLOCK + r"\s*(?:-|to|and|until|till)\s*" + _CLOCK)
+_AFTER = re.compile(r"\b(?:after|from) " + _CLOCK + r"|\b(?:after|from) (noon|lunch)")
+_BEFORE = re.compile(r"\b(?:before|until|till) " + _CLOCK + r"|\b(?:before|until|till) (noon|lunch)")
+_AT = re.compile(r"\bat " + _CLOCK + r"(?!\s*(?:-|to|and|until|till)\s*\d)")
+_DURATION = re.compile(r"(\d+(?:\.\d+)?|an?|one|two|three|four|five|six)( and a half)? "
+                       r"(hours?|hrs?|minutes?|mins?)")
+_PERIOD = re.compile(r"\b(" + "|".join(DAY_PERIODS) + r")\b")
+_BUSY = re.compile(r"\b(?:busy|not free|unavailable|can'?t|cannot|occupied|away)\b")
+_LOW_FOCUS = re.compile(r"low[- ]?focus|tired|exhausted|sleepy|distracted|light")
+_HIGH_FOCUS = re.compile(r"high[- ]?focus|focused|energi[sz]ed|deep work|fresh")
+
+
+def _clock_minutes(hours, minutes, meridiem, default_pm=False):
+    hours = int(hours)
+    minutes = int(minutes or 0)
+    if hours > 24 or minutes > 59:
+        return None
+    if meridiem == "pm" and hours < 12:
+        hours += 12
+    elif meridiem == "am" and hours == 12:
+        hours = 0
+    elif meridiem is None and default_pm and 1 <= hours < 7:
+        # "3 to 5" during a study day means the afternoon.
+        hours += 12
+    return min(hours * 60 + minutes, 24 * 60)
+
+
+def _duration_minutes(text):
+    match = _DURATION.search(text)
+    if not match:
+        return None
+    value = float(_NUMBER_WORDS.get(match.group(1), match.group(1)))
+    if match.group(2):
+        value += 0.5
+    if not match.group(3).startswith("h"):
+        return int(value)
+    return int(value * 60)
+
+
+def parse_day_constraints(text):
+    """
+    Turns a constraint like "only 1 hour at lunch, low-focus", "free from 3pm
+    to 5pm" or "busy after 6" into {"intervals": [(start, end)], "busy",
+    "minutes", "focus"}: the times mentioned (minutes after midnight), whether
+    they are times the user is *not* available, how much time they said they
+    have (or None), and the focus level (or None if not mentioned).
+    """
+    text = (text or "").lower()
+    intervals = []
+    for match in _RANGE.finditer(text):
+        end_meridiem = match.group(6)
+        start = _clock_minutes(match.group(1), match.group(2), match.group(3) or
+                               (end_meridiem if int(match.group(1)) <= int(match.group(4)) else None),
+                               default_pm=True)
+        end = _clock_minutes(match.group(4), match.group(5), end_meridiem, default_pm=True)
+        if start is not None and end is not None and start < end:
+            intervals.append((start, end))
+    if not intervals:
+        for pattern, side in ((_AFTER, "after"), (_BEFORE, "before")):
+            match = pattern.search(text)
+            if not match:
+                continue
+            if match.group(4):
+                minutes = parse_hhmm(DAY_PERIODS[match.group(4)][1 if side == "after" else 0])
+            else:
+                minutes = _clock_minutes(match.group(1), match.group(2), match.group(3), default_pm=True)
+            if minutes is not None:
+                intervals.append((minutes, 24 * 60) if side == "after" else (0, minutes))
+    if not intervals:
+        match = _AT.search(text)
+        if match:
+            start = _clock_minutes(match.group(1), match.group(2), match.group(3), default_pm=True)
+            if start is not None:
+                intervals.append((start, min(start + (_duration_minutes(text) or 60), 24 * 60)))
+    if not intervals:
+        for period in _PERIOD.findall(text):
+            start, end = DAY_PERIODS[period]
+            intervals.append((parse_hhmm(start), parse_hhmm(end)))
+
+    focus = None
+    if _LOW_FOCUS.search(text):
+        focus = "low"
+    elif _HIGH_FOCUS.search(text):
+        focus = "high"
+    return {"intervals": merge_intervals(intervals), "busy": bool(_BUSY.search(text)),
+            "minutes": _duration_minutes(text), "focus": focus}
+
+
+def free_today(constraints, schedule, preferences, study_windows, now):
+    """
+    Today's remaining free (start, end, focus) intervals under the parsed
+    `constraints`: the times the user named (or their usual study windows,
+    minus the times they're busy), clipped to when they're awake, minus
+    today's classes and the part of the day that has passed, and capped at
+    the number of minutes they said they have.
+    """
+    weekday = now.weekday()
+    usual = weekly_free_intervals(study_windows, schedule, preferences)[weekday]
+    classes = merge_intervals(
+        (parse_hhmm(item.get("start_time")), parse_hhmm(item.get("end_time")))
+        for item in schedule or []
+        if weekday_index(item.get("day")) == weekday
+        and parse_hhmm(item.get("start_time")) is not None and parse_hhmm(item.get("end_time")) is not None
+    )
+    now_minutes = now.hour * 60 + now.minute + (1 if now.second or now.microsecond else 0)
+    blocked = merge_intervals(classes + [(0, now_minutes)] +
+                              subtract_intervals([(0, 24 * 60)], awake_intervals(preferences)))
+
+    if constraints["intervals"] and not constraints["busy"]:
+        focus = constraints["focus"] or "medium"
+        free = [(start, end, focus) for start, end in constraints["intervals"]]
+    else:
+        free = usual
+        if constraints["busy"] and constraints["intervals"]:
+            free = subtract_intervals(free, constraints["intervals"])
+        if constraints["focus"]:
+            free = [(start, end, constraints["focus"]) for start, end, _ in free]
+    free = subtract_intervals(sorted(free), blocked)
+
+    if constraints["minutes"]:
+        capped, left = [], constraints["minutes"]
+        for start, end, focus in free:
+            if left <= 0:
+                break
+            capped.append((start, min(end, start + left), focus))
+            left -= capped[-1][1] - start
+        free = capped
+    return free
+
+
+def reschedule_today(today_blocks, tasks, tests, intervals, now):
+    """
+    Re-fills today's remaining free `intervals` (start, end, focus) with the
+    work that was planned for the rest of today, earliest deadline first.
+    Blocks that already happened are kept. Only today is touched, and no work
+    is pulled in from other days (it is already planned there).
+
+    Returns (blocks, unplaced): today's new blocks and the work items that
+    no longer fit today.
+    """
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    now_minutes = now.hour * 60 + now.minute
+    items_by_id = {item["id"]: item for item in build_work_items(tasks, tests, now) if item["id"]}
+
+    kept = [block for block in today_blocks if (parse_hhmm(block.get("end_time")) or 0) <= now_minutes]
+    planned = {}
+    for block in today_blocks:
+        start, end = parse_hhmm(block.get("start_time")), parse_hhmm(block.get("end_time"))
+        if block in kept or start is None or end is None:
+            continue
+        key = block.get("item_id") or block.get("task")
+        if key not in planned:
+            item = items_by_id.get(block.get("item_id"))
+            planned[key] = {
+                "id": block.get("item_id"),
+                "name": item["name"] if item else block.get("task"),
+                "label": block.get("task"),
+                "due": item["due"] if item else day + timedelta(days=1),
+                "effort": 0,
+            }
+        planned[key]["effort"] += end - max(start, now_minutes)
+
+    heap = [[item["due"], seq, item, item["effort"]]
+            for seq, item in enumerate(planned.values()) if item["effort"] > 0]
+    heapq.heapify(heap)
+    blocks, unplaced = [], []
+    fill_intervals(day, intervals, heap, blocks, unplaced)
+    unplaced += [entry[2] for entry in heap]
+    return kept + blocks, unplaced
+
+
+# --- Incremental re-planning ---
+
+def block_key(block):
+    return (block.get("date"), block.get("start_time"), block.get("end_time"),
+            block.get("task"), block.get("item_id"))
+
+
+def diff_plan(old_plan, new_plan):
+    """
+    Compares two plans block by block. Returns (removed, added): the blocks of
+    `old_plan` that are not in `new_plan`, and the blocks of `new_plan` that
+    are not in `old_plan`. Blocks present in both are left alone.
+    """
+    old_keys = {block_key(block) for block in old_plan}
+    new_keys = {block_key(block) for block in new_plan}
+    removed = [block for block in old_plan if block_key(block) not in new_keys]
+    added = [block for block in new_plan if block_key(block) not in old_keys]
+    return removed, added
+
+
+def first_affected_date(plan, tasks, tests, item_ids, now=None):
+    """
+    The first date on which re-planning after changes to the tasks/tests in
+    `item_ids` can move a block of the stored `plan`, or None if it can't move
+    any. Every day before it comes out of the engine exactly as before:
+
+    - a changed item's own blocks move, from its first one on;
+    - a new or changed item only takes time from work due no sooner than
+      itself (the engine is earliest-deadline-first), so nothing before the
+      first such block moves. With no such block it only takes time after the
+      last block.
+    """
+    now = now or datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    items = {item["id"]: item for item in build_work_items(tasks, tests, now) if item["id"]}
+    blocks = sorted((block for block in plan if block["date"] >= today),
+                    key=lambda block: (block["date"], block["start_time"]))
+    if not blocks:
+        return today if any(item_id in items for item_id in item_ids) else None
+
+    dates = []
+    for item_id in item_ids:
+        own = next((block["date"] for block in blocks if block.get("item_id") == item_id), None)
+        if own:
+            dates.append(own)
+        item = items.get(item_id)
+        if item is None:
+            # Deleted or no longer pending: only its own blocks free up.
+            continue
+        dates.append(next((block["date"] for block in blocks
+                           if block.get("item_id") != item_id
+                           and (block.get("item_id") not in items or items[block["item_id"]]["due"] >= item["due"])),
+                          blocks[-1]["date"]))
+    return min(dates) if dates else None
+
+
+def replan_from(schedule, tasks, tests, preferences, study_windows, plan, start_date, now=None,
+                horizon_days=DEFAULT_HORIZON_DAYS):
+    """
+    Same result as build_plan(), when every day of `plan` before `start_date`
+    would come out unchanged (see first_affected_date()): those blocks are
+    kept as they are, the work they cover is credited, and the engine only
+    runs from `start_date` on.
+
+    Returns (plan, unfinished) like build_plan().
+    """
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    if start <= today:
+        return build_plan(schedule, tasks, tests, preferences, study_windows, now, horizon_days)
+
+    free_by_day = weekly_free_intervals(study_windows, schedule, preferences)
+    items = build_work_items(tasks, tests, now)
+    heap = [[item["due"], seq, item, item["effort"]] for seq, item in enumerate(items)]
+    entries_by_id = {entry[2]["id"]: entry for entry in heap if entry[2]["id"]}
+
+    kept = sorted((block for block in plan if today.strftime("%Y-%m-%d") <= block["date"] < start_date),
+                  key=lambda block: (block["date"], block["start_time"]))
+    for block in kept:
+        entry = entries_by_id.get(block.get("item_id"))
+        if entry is None:
+            continue
+        begin, end = parse_hhmm(block["start_time"]), parse_hhmm(block["end_time"])
+        weekday = datetime.strptime(block["date"], "%Y-%m-%d").weekday()
+        focus = next((focus for low, high, focus in free_by_day[weekday] if low <= begin and end <= high), None)
+        if focus is None:
+            # The free time changed since this plan was made; it can't be reused.
+            return build_plan(schedule, tasks, tests, preferences, study_windows, now, horizon_days)
+        entry[3] -= (end - begin) * FOCUS_WEIGHTS[focus]
+
+    heap = [entry for entry in heap if entry[3] > 0]
+    heapq.heapify(heap)
+    new_plan = [dict(block) for block in kept]
+    unfinished = []
+    for offset in range((start - today).days, horizon_days):
+        if not heap:
+            break
+        day = today + timedelta(days=offset)
+        fill_intervals(day, free_by_day[day.weekday()], heap, new_plan, unfinished)
+    return new_plan, unfinished
+
+
+def changes_need_replan(changes):
+    """
+    Renames keep every block in place (only the label changes, and that is
+    cascaded by the rename itself), so only other kinds of change need the
+    engine to run again.
+    """
+    return any(change.get("op") != "rename" for change in changes)
@@ -23,7 +23,7 @@ document.addEventListener('DOMContentLoaded', () => {
   yearSelect.addEventListener('change', handleDateSelectorChange);
 
   currentWeekStart = getWeekStart(new Date());
-  renderWeek(); // Start the async render process
+  renderWeek().then(startLiveUpdates); // Start the async render process, then listen for changes
 
   // Event listener to close popup when clicking outside
    document.addEventListener('click', function(event) {
@@ -140,8 +140,8 @@ document.addEventListener('DOMContentLoaded', () => {
     // We can re-use the /get_schedule endpoint since it has all user data
     // (Assuming app.py is updated to send preferences and windows)
     try {
-        const res = await fetch('/get_schedule');
-        const data = await res.json();
+        // While live updates are on, scheduleData is already current.
+        const data = liveUpdates ? scheduleData : await (await fetch('/get_schedule')).json();
 
         // This is a future-proof change; app.py needs to be updated to send this
         if (data.preferences) {
@@ -212,8 +212,7 @@ document.addEventListener('DOMContentLoaded', () => {
       closeModal();
 
       // Refresh the schedule display as the plan might have changed
-      await loadScheduleData();
-      displayDayDetails();
+      await refreshAfterChange(result.planner);
 
     } catch (e) {
       console.error('Error saving personalization:', e);
@@ -348,13 +347,59 @@ function handleDayClick(element, dateString) {
 }
 
 // === loadScheduleData ===
+// After the first load we only ask for what changed since the version we
+// have; the server answers 304 if nothing did.
+let scheduleVersion = null;
+
+function mergeItems(current, changed, ids) {
+    const byId = new Map(current.filter(item => item.id).map(item => [item.id, item]));
+    changed.forEach(item => byId.set(item.id, item));
+    return ids.filter(id => byId.has(id)).map(id => byId.get(id));
+}
+
+function mergePlan(current, changed, dates) {
+    const changedDates = new Set(changed.map(block => block.date));
+    const keptDates = new Set(dates);
+    return current
+        .filter(block => keptDates.has(block.date) && !changedDates.has(block.date))
+        .concat(changed)
+        .sort((a, b) => (a.date + a.start_time).localeCompare(b.date + b.start_time));
+}
+
 async function loadScheduleData() {
     try {
-        const res = await fetch('/get_schedule');
+        const url = scheduleVersion === null ? '/get_schedule' : `/get_schedule?since=${scheduleVersion}`;
+        const res = await fetch(url);
+        if (res.status === 304) {
+            return;
+        }
         if (!res.ok) {
              throw new Error(`HTTP error! status: ${res.status}`);
         }
-        const data = await res.json();
+        applyScheduleData(await res.json());
+    } catch (e) {
+        console.error("Fetch error:", e);
+        scheduleVersion = null;
+        scheduleData = { schedule: [], tasks: [], tests: [], generated_plan: [], preferences: {}, study_windows: [] }; // Reset on error
+        const detailsBox = document.getElementById('schedule-details');
+        if (detailsBox) {
+            detailsBox.innerHTML = `<h4 style="margin-top:0;">Error Loading Schedule</h4><p>Could not fetch schedule data. Please try again later.</p>`;
+        }
+    }
+}
+
+// Takes a full /get_schedule body, or the changes since our version.
+function applyScheduleData(data) {
+    if (data.since !== undefined && scheduleVersion !== null) {
+        scheduleData = {
+            schedule: mergeItems(scheduleData.schedule, data.schedule || [], data.ids.schedule),
+            tasks: mergeItems(scheduleData.tasks, data.tasks || [], data.ids.tasks),
+            tests: mergeItems(scheduleData.tests, data.tests || [], data.ids.tests),
+            generated_plan: mergePlan(scheduleData.generated_plan, data.generated_plan || [], data.plan_dates),
+            preferences: data.preferences || { awake_time: '07:00', sleep_time: '23:00'},
+            study_windows: data.study_windows || []
+        };
+    } else {
         scheduleData = {
             schedule: data.schedule || [],
             tasks: data.tasks || [],
@@ -365,12 +410,69 @@ async function loadScheduleData() {
             study_windows: data.study_windows || []
             // === END OF CHANGE ===
         };
-    } catch (e) {
-        console.error("Fetch error:", e);
-        scheduleData = { schedule: [], tasks: [], tests: [], generated_plan: [], preferences: {}, study_windows: [] }; // Reset on error
-        const detailsBox = document.getElementById('schedule-details');
-        if (detailsBox) {
-            detailsBox.innerHTML = `<h4 style="margin-top:0;">Error Loading Schedule</h4><p>Could not fetch schedule data. Please try again later.</p>`;
+    }
+    scheduleVersion = data.version;
+}
+
+// === Live updates ===
+// The server pushes every change to this user's data (from chat, the planner,
+// another tab or device) over /events, so while that stream is open we never
+// need to re-fetch the schedule ourselves.
+let liveUpdates = false;
+
+function startLiveUpdates() {
+    if (!window.EventSource || scheduleVersion === null) return;
+    if (document.body.dataset.liveUpdates === 'off') return; // nothing serves /events
+    const source = new EventSource(`/events?since=${scheduleVersion}`);
+    source.onopen = () => { liveUpdates = true; };
+    source.addEventListener('schedule', async (event) => {
+        const data = JSON.parse(event.data);
+        if (scheduleVersion !== null && data.version <= scheduleVersion) {
+            return; // already have it
+        }
+        if (scheduleVersion !== null && data.since <= scheduleVersion) {
+            applyScheduleData(data);
+        } else {
+            await loadScheduleData(); // we missed something; catch up
+        }
+        displayDayDetails();
+    });
+    source.onerror = () => {
+        liveUpdates = false;
+        if (source.readyState === EventSource.CLOSED) {
+            // Refused (e.g. the server's streams are all taken); try again later.
+            setTimeout(startLiveUpdates, 60000);
+        }
+    };
+}
+
+// === Brings the calendar up to date after a change we just made ===
+async function refreshAfterChange(plannerStarted) {
+    if (liveUpdates) return; // the change (and the planner's result) will be pushed
+    await loadScheduleData();
+    displayDayDetails();
+    if (plannerStarted) {
+        await refreshWhenPlanReady();
+    }
+}
+
+// === Waits for the background planner, then reloads the schedule ===
+async function refreshWhenPlanReady(maxWaitMs = 15000) {
+    const startedAt = Date.now();
+    while (Date.now() - startedAt < maxWaitMs) {
+        await new Promise(resolve => setTimeout(resolve, 500));
+        try {
+            const res = await fetch('/planner_status');
+            if (!res.ok) return;
+            const status = await res.json();
+            if (status.status === 'ready' || status.status === 'error') {
+                await loadScheduleData();
+                displayDayDetails();
+                return;
+            }
+        } catch (e) {
+            console.error("Could not check planner status:", e);
+            return;
         }
     }
 }
@@ -437,7 +539,9 @@ async function renderWeek(dateToSelect = null) {
         currentDateIterator.setDate(currentDateIterator.getDate() + 1);
     }
     updateSelectors();
-    await loadScheduleData();
+    if (!liveUpdates) {
+        await loadScheduleData();
+    }
     displayDayDetails();
 }
 
@@ -464,33 +568,62 @@ async function sendMessage() {
 
   const selectedYear = yearSelect ? yearSelect.value : new Date().getFullYear().toString();
 
+  // The reply is streamed into this bubble as it arrives
+  const botMessage = document.createElement('div');
+  botMessage.className = 'message bot-message';
+  botMessage.innerHTML = '...';
+  chatBox.appendChild(botMessage);
+
   try {
+      // The turn runs on the server's chat workers; we poll for its result.
       const res = await fetch("/chat", {
         method: "POST",
-        headers: { "Content-Type": "application/json" },
+        headers: { "Content-Type": "application/json", "Prefer": "respond-async" },
         body: JSON.stringify({
           message: userMessage,
           year: selectedYear
         })
       });
-
-      if (!res.ok) {
-          throw new Error(`HTTP error! status: ${res.status}`);
+      const data = res.status === 202 ? await waitForChatResult((await res.json()).turn_id) : await res.json();
+
+      if (res.status === 429 || res.status === 503 || data.status === 429 || data.status === 503) {
+          // Too busy right now; the server says when to try again.
+          botMessage.style.color = 'red';
+          botMessage.innerHTML = data.reply;
+          setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
+          return;
+      }
+      if (!res.ok || data.status >= 400) {
+          throw new Error(`HTTP error! status: ${data.status || res.status}`);
       }
 
-      const data = await res.json();
-      chatBox.innerHTML += `<div class="message bot-message">${data.reply || 'No reply received.'}</div>`;
-       setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
+      botMessage.innerHTML = data.reply || 'No reply received.';
+      setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
 
-      await loadScheduleData();
-      displayDayDetails();
+      await refreshAfterChange(data.planner);
   } catch (error) {
        console.error("Error sending message or processing reply:", error);
-       chatBox.innerHTML += `<div class="message bot-message" style="color: red;">Error: Could not get reply from server.</div>`;
+       botMessage.style.color = 'red';
+       botMessage.innerHTML = 'Error: Could not get reply from server.';
        setTimeout(() => { chatBox.scrollTop = chatBox.scrollHeight; }, 0);
   }
 }
 
+// === Polls an offloaded chat turn until it is done; resolves to its payload (with `status` when not 200) ===
+async function waitForChatResult(turnId, maxWaitMs = 180000) {
+    const startedAt = Date.now();
+    let delay = 300;
+    while (Date.now() - startedAt < maxWaitMs) {
+        await new Promise(resolve => setTimeout(resolve, delay));
+        delay = Math.min(delay * 1.5, 1500);
+        const res = await fetch(`/chat_result/${turnId}`);
+        if (res.status === 202) continue;
+        const payload = await res.json();
+        return res.ok ? payload : { ...payload, status: res.status };
+    }
+    throw new Error("Timed out waiting for the reply");
+}
+
 // === Notification Popup Functions ===
 function toggleNotificationPopup() {
     const popup = document.getElementById('notificationPopup');
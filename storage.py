@@ -0,0 +1,684 @@
+"""
+MongoDB storage layer.
+
+The `users` collection keeps the account and the small, frequently edited
+scheduling data (schedule, tasks, tests, preferences, study windows). The two
+big, fast-growing pieces live in their own collections so that reading a
+user's schedule never drags the chat log along with it:
+
+* `chat_histories`: one document per user holding the conversation.
+* `plans`: one document per (user, date) holding that day's study blocks.
+
+Callers should always read with one of the projections below so they only get
+the fields they actually use.
+
+Every user has a `data_version` that goes up whenever their classes, tasks,
+tests, settings or plan change. Classes, tasks, tests and plan days written
+since carry the version that made them visible in `v`, so a client that
+has seen version N can ask for just what changed after N.
+
+The scheduling data (CONTEXT_FIELDS) is also kept in a small per-process
+cache, read through get_user_data(). Every write in here drops the user's
+entry; code writing to `users_collection` directly must call
+invalidate_user(). The TTL bounds how stale another process's cache can be;
+code about to act on the data (a chat turn, the planner) reads it with
+get_fresh_user_data(), which checks the version first.
+Both also wake the user's open /events streams (see changefeed.py).
+
+The MongoClient is created on first use in each process (and again in a
+forked worker), never at import, so importing this module doesn't touch the
+network and a pre-forking server never shares a client across processes.
+`users_collection` and friends stand in for that process's collections.
+"""
+import copy
+import os
+import secrets
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import bson
+from pymongo import MongoClient, ASCENDING, ReplaceOne, DeleteOne, UpdateOne, UpdateMany
+
+from cache import TTLCache
+from changefeed import change_feed
+from metrics import MongoCommandListener, histogram, SIZE_BUCKETS
+
+MONGO_URI = os.getenv("MONGO_URI")
+
+DATABASE_NAME = "SmartSchedule"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _forget_client():
+    # Runs in a forked child: the parent's client (and its sockets and threads) must not be used there.
+    global _client, _client_lock
+    _client, _client_lock = None, threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_client)
+
+
+def get_client():
+    """This process's MongoClient, created (without connecting) on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(
+                    MONGO_URI,
+                    connect=False,
+                    maxPoolSize=MONGO_MAX_POOL_SIZE,
+                    minPoolSize=MONGO_MIN_POOL_SIZE,
+                    maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    event_listeners=[MongoCommandListener()],
+                )
+    return _client
+
+
+class _Collection:
+    """A collection of this process's client, resolved on every use."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client()[DATABASE_NAME][self.name], attribute)
+
+
+users_collection = _Collection("users")
+chat_collection = _Collection("chat_histories")
+plans_collection = _Collection("plans")
+chat_results_collection = _Collection("chat_results")
+
+# How long the result of an offloaded chat turn can be picked up.
+CHAT_RESULT_TTL_SECONDS = int(os.getenv("CHAT_RESULT_TTL_SECONDS", "3600"))
+
+user_cache = TTLCache(
+    max_entries=int(os.getenv("USER_CACHE_SIZE", "1024")),
+    ttl_seconds=float(os.getenv("USER_CACHE_TTL_SECONDS", "30")),
+    name="users",
+)
+
+document_bytes = histogram("smartscheduler_document_bytes", "BSON size of user and chat documents read from MongoDB.",
+                           SIZE_BUCKETS)
+
+# --- Projections ---
+AUTH_FIELDS = {"username": 1, "password": 1, "_id": 0}
+CONTEXT_FIELDS = {"schedule": 1, "tasks": 1, "tests": 1, "preferences": 1, "study_windows": 1,
+                  "data_version": 1, "_id": 0}
+VERSION_FIELDS = {"data_version": 1, "cleaned_through": 1, "_id": 0}
+
+# Arrays of the user document whose items carry a version stamp.
+VERSIONED_ARRAYS = ("schedule", "tasks", "tests")
+
+
+def ensure_indexes():
+    users_collection.create_index([("username", ASCENDING)], unique=True)
+    users_collection.create_index([("cleaned_through", ASCENDING)])
+    # The cleanup sweeper looks for users with tasks/tests that have just become past.
+    users_collection.create_index([("tasks.deadline", ASCENDING)])
+    users_collection.create_index([("tests.date", ASCENDING)])
+    chat_collection.create_index([("username", ASCENDING)], unique=True)
+    plans_collection.create_index([("username", ASCENDING), ("date", ASCENDING)], unique=True)
+    # Renames and deletes cascade into the plan by the id of the item a block works on.
+    plans_collection.create_index([("username", ASCENDING), ("blocks.item_id", ASCENDING)])
+    users_collection.create_index([("feed_token", ASCENDING)], unique=True, sparse=True)
+    chat_results_collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=CHAT_RESULT_TTL_SECONDS)
+
+
+def new_item_id():
+    """A stable id for a class, task or test."""
+    return uuid.uuid4().hex[:16]
+
+
+def get_feed_owner(token):
+    """The {username, data_version} of the user a calendar feed token belongs to, or None."""
+    if not token:
+        return None
+    return users_collection.find_one({"feed_token": token}, {"username": 1, "data_version": 1, "_id": 0})
+
+
+def get_feed_token(username, rotate=False):
+    """
+    The user's calendar feed token, created on first use. With `rotate`, a new
+    token replaces the old one (so old subscription URLs stop working).
+    Returns None if there is no such user.
+    """
+    if not rotate:
+        doc = users_collection.find_one({"username": username}, {"feed_token": 1, "_id": 0})
+        if doc is None or doc.get("feed_token"):
+            return doc and doc["feed_token"]
+    token = secrets.token_urlsafe(24)
+    query = {"username": username}
+    if not rotate:
+        query["feed_token"] = {"$exists": False}  # two first requests at once agree on one token
+    users_collection.update_one(query, {"$set": {"feed_token": token}})
+    doc = users_collection.find_one({"username": username}, {"feed_token": 1, "_id": 0})
+    return doc and doc.get("feed_token")
+
+
+def get_user(username, projection):
+    return users_collection.find_one({"username": username}, projection)
+
+
+def get_user_data(username, min_version=None):
+    """
+    The user's scheduling data (CONTEXT_FIELDS), from the cache when possible.
+    Pass `min_version` when the caller knows the current data version, to
+    skip cache entries older than it. Returns a copy the caller may modify,
+    or None if there is no such user.
+    """
+    cached = user_cache.get(username)
+    if cached is None or (min_version is not None and cached.get("data_version", 0) < min_version):
+        token = user_cache.token(username)
+        cached = get_user(username, CONTEXT_FIELDS)
+        if cached is None:
+            return None
+        document_bytes.observe(len(bson.encode(cached)), collection="users")
+        # Not cached if this user was invalidated meanwhile, or if a newer copy already is.
+        user_cache.set(username, cached, token=token, version=cached.get("data_version", 0))
+    return copy.deepcopy(cached)
+
+
+def get_fresh_user_data(username):
+    """
+    get_user_data() checked against the user's current data version (one
+    small read), for code that acts on the data: another process may have
+    written since this process cached it.
+    """
+    return get_user_data(username, min_version=get_data_version(username))
+
+
+def invalidate_user(username):
+    user_cache.invalidate(username)
+    change_feed.notify(username)
+
+
+# --- Data versions ---
+
+def get_data_version(username):
+    """The user's current data version (0 if never written), or None if there is no such user."""
+    doc = users_collection.find_one({"username": username}, {"data_version": 1, "_id": 0})
+    return None if doc is None else doc.get("data_version", 0)
+
+
+def get_data_versions(usernames):
+    """{username: data version} for the given users, in one query. Users that don't exist are left out."""
+    return {doc["username"]: doc.get("data_version", 0) for doc in
+            users_collection.find({"username": {"$in": list(usernames)}}, {"username": 1, "data_version": 1, "_id": 0})}
+
+
+def _version_guard(version):
+    return {"data_version": version} if version else {"data_version": {"$in": [0, None]}}
+
+
+def _stamp_update(update, stamp):
+    """Adds the version stamp to every item an update document pushes to or edits in place."""
+    for field, value in update.get("$push", {}).items():
+        if field in VERSIONED_ARRAYS:
+            items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            for item in items:
+                item["v"] = stamp
+    sets = update.get("$set", {})
+    for path in list(sets):
+        parts = path.split(".")
+        if len(parts) == 3 and parts[0] in VERSIONED_ARRAYS and parts[1].startswith("$["):
+            sets[f"{parts[0]}.{parts[1]}.v"] = stamp
+
+
+def _restamp(username, old_stamp, new_stamp):
+    """Moves everything stamped `old_stamp` to `new_stamp` (after losing a race for the version)."""
+    plans_collection.update_many({"username": username, "v": old_stamp}, {"$set": {"v": new_stamp}})
+    stamped = users_collection.find_one({"username": username},
+                                        {f"{field}.v": 1 for field in VERSIONED_ARRAYS}) or {}
+    fields = [field for field in VERSIONED_ARRAYS
+              if any(item.get("v") == old_stamp for item in stamped.get(field, []))]
+    if fields:
+        users_collection.update_one(
+            {"username": username},
+            {"$set": {f"{field}.$[{field}].v": new_stamp for field in fields}},
+            array_filters=[{f"{field}.v": old_stamp} for field in fields]
+        )
+
+
+def advance_version(username, base, stamp):
+    """
+    Publishes data written with version `stamp` by moving the user's
+    data_version from `base` to `stamp`. Data is always written before the
+    version that announces it, so a client that has seen a version has seen
+    everything stamped with it. If another write moved the version first,
+    our data is re-stamped above it and we try again.
+    """
+    restamped = False
+    while True:
+        result = users_collection.update_one({"username": username, **_version_guard(base)},
+                                             {"$set": {"data_version": stamp}})
+        if result.matched_count:
+            cached = user_cache.peek(username)
+            if cached is not None and not restamped and cached.get("data_version", 0) == base:
+                # Only the version moved (e.g. a plan write); keep the entry current.
+                user_cache.set(username, {**cached, "data_version": stamp}, version=stamp)
+                change_feed.notify(username)
+            else:
+                invalidate_user(username)
+            return stamp
+        base = get_data_version(username)
+        if base is None:
+            return None
+        _restamp(username, stamp, base + 1)
+        stamp = base + 1
+        restamped = True
+
+
+def get_user_changes(username, since):
+    """
+    The user's settings in full, plus only the classes, tasks and tests
+    written after version `since` and the ids of all of them (so the client
+    can drop the ones that are gone). The filtering happens in the database.
+    """
+    projection = {"_id": 0, "data_version": 1, "cleaned_through": 1, "preferences": 1, "study_windows": 1}
+    for field in VERSIONED_ARRAYS:
+        projection[field] = {"$filter": {
+            "input": {"$ifNull": [f"${field}", []]},
+            "cond": {"$gt": [{"$ifNull": ["$$this.v", 0]}, since]},
+        }}
+        projection[f"{field}_ids"] = {"$ifNull": [f"${field}.id", []]}
+    result = list(users_collection.aggregate([{"$match": {"username": username}}, {"$project": projection}]))
+    return result[0] if result else None
+
+
+# --- Batched writes ---
+
+def _touched_fields(update):
+    """Top-level fields of the user document an update document writes to."""
+    return {path.split(".")[0] for paths in update.values() for path in paths}
+
+
+def _merge_update(group, update):
+    """Merges `update` into `group` (same user document, no overlapping fields)."""
+    for operator, paths in update.items():
+        group.setdefault(operator, {}).update(paths)
+
+
+def _merge_pushes(previous, update):
+    """
+    Two plain $push updates to the same array (e.g. two new tasks in one turn)
+    become a single $push with $each. Returns False if they can't be combined.
+    """
+    if set(previous) != {"$push"} or set(update) != {"$push"}:
+        return False
+    for field, value in update["$push"].items():
+        existing = previous["$push"].get(field)
+        if existing is None:
+            return False
+        for item in (existing, value):
+            if isinstance(item, dict) and any(key.startswith("$") for key in item) and set(item) != {"$each"}:
+                return False
+    for field, value in update["$push"].items():
+        existing = previous["$push"][field]
+        items = existing["$each"] if isinstance(existing, dict) and "$each" in existing else [existing]
+        items += value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        previous["$push"][field] = {"$each": items}
+    return True
+
+
+class UnitOfWork:
+    """
+    Collects every write one request (e.g. a chat turn with several tool calls)
+    makes to a user's data and sends them together on commit().
+
+    Updates to the user document are merged into as few update documents as
+    possible: writes to different fields share one update, and repeated $push
+    to the same array become one $each. In the common case the whole turn is a
+    single, atomic update_one; otherwise it is one ordered bulk_write.
+
+    `user` is an in-memory copy of the user's scheduling data. Helpers check it
+    (instead of a write result) to decide what to tell the user, and keep it in
+    step with the writes they queue, so later tool calls in the same turn see
+    earlier ones.
+
+    A commit is one new data version: everything it writes is stamped with it.
+    `writes` counts the writes queued so far, so callers can tell whether a
+    step changed anything.
+    """
+
+    def __init__(self, username, user=None):
+        self.username = username
+        self._user = user
+        self._groups = []         # [(update, array_filters)], applied in order
+        self._plan_operations = []
+        self._filter_count = 0
+        self.writes = 0
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = get_fresh_user_data(self.username) or {}
+        return self._user
+
+    @property
+    def loaded_user(self):
+        """The in-memory user data if it has been loaded, without loading it."""
+        return self._user
+
+    def array_filter_name(self):
+        """A fresh arrayFilters identifier, unique within this unit of work."""
+        self._filter_count += 1
+        return f"f{self._filter_count}"
+
+    def update_user(self, update, array_filters=None):
+        self.writes += 1
+        array_filters = list(array_filters or [])
+        if self._groups:
+            last_update, last_filters = self._groups[-1]
+            if _merge_pushes(last_update, update):
+                return
+            if not (_touched_fields(last_update) & _touched_fields(update)):
+                _merge_update(last_update, update)
+                last_filters.extend(array_filters)
+                return
+        self._groups.append(({key: dict(value) for key, value in update.items()}, array_filters))
+
+    def update_plans(self, query, update, array_filters=None):
+        """Queues an update_many on the user's plan days."""
+        self.writes += 1
+        self._plan_operations.append(lambda stamp: UpdateMany(
+            query, {**update, "$set": {**update.get("$set", {}), "v": stamp}}, array_filters=array_filters))
+
+    def write_plan_day(self, date, blocks):
+        """Queues replacing one day of the user's plan with `blocks` (removing the day if there are none)."""
+        self.writes += 1
+        blocks = _blocks_by_date(blocks).get(date, [])
+        query = {"username": self.username, "date": date}
+        self._plan_operations.append(lambda stamp: ReplaceOne(
+            query, {**query, "blocks": blocks, "v": stamp}, upsert=True) if blocks else DeleteOne(query))
+
+    @property
+    def pending(self):
+        return bool(self._groups or self._plan_operations)
+
+    def commit(self):
+        if not self.pending:
+            return
+        base = (self._user or {}).get("data_version")
+        if base is None:
+            base = get_data_version(self.username) or 0
+        stamp = base + 1
+
+        if self._plan_operations:
+            plans_collection.bulk_write([operation(stamp) for operation in self._plan_operations], ordered=True)
+
+        if len(self._groups) == 1:
+            # The data and the new version go out in the same atomic update.
+            update, array_filters = self._groups[0]
+            while True:
+                _stamp_update(update, stamp)
+                update.setdefault("$set", {})["data_version"] = stamp
+                result = users_collection.update_one({"username": self.username, **_version_guard(base)},
+                                                     update, array_filters=array_filters or None)
+                if result.matched_count:
+                    break
+                base = get_data_version(self.username)
+                if base is None:
+                    break
+                plans_collection.update_many({"username": self.username, "v": stamp},
+                                             {"$set": {"v": base + 1}})
+                stamp = base + 1
+        else:
+            for update, _ in self._groups:
+                _stamp_update(update, stamp)
+            if self._groups:
+                users_collection.bulk_write([
+                    UpdateOne({"username": self.username}, update, array_filters=array_filters or None)
+                    for update, array_filters in self._groups
+                ], ordered=True)
+            stamp = advance_version(self.username, base, stamp)
+
+        invalidate_user(self.username)
+        if self._user is not None and stamp is not None:
+            self._user["data_version"] = stamp
+        self._groups = []
+        self._plan_operations = []
+
+
+@contextmanager
+def unit_of_work(username, uow=None):
+    """
+    Yields `uow` if the caller already has one (it will commit it), otherwise a
+    new UnitOfWork that is committed when the block finishes without an error.
+    """
+    if uow is not None:
+        yield uow
+        return
+    uow = UnitOfWork(username)
+    yield uow
+    uow.commit()
+
+
+# --- Generated plan ---
+
+def get_plan(username, date=None):
+    """Returns the user's plan as a flat list of blocks (each with its 'date'), sorted by date."""
+    query = {"username": username}
+    if date:
+        query["date"] = date
+    plan = []
+    for day in plans_collection.find(query, {"date": 1, "blocks": 1, "_id": 0}).sort("date", ASCENDING):
+        for block in day.get("blocks", []):
+            plan.append({"date": day["date"], **block})
+    return plan
+
+
+def first_plan_date(username, item_ids, since=None):
+    """The earliest plan date (from `since` on) with a block for any of the given tasks/tests, or None."""
+    query = {"username": username, "blocks.item_id": {"$in": list(item_ids)}}
+    if since:
+        query["date"] = {"$gte": since}
+    day = plans_collection.find_one(query, {"date": 1, "_id": 0}, sort=[("date", ASCENDING)])
+    return day["date"] if day else None
+
+
+def _blocks_by_date(plan):
+    by_date = {}
+    for block in plan:
+        by_date.setdefault(block["date"], []).append(
+            {key: value for key, value in block.items() if key != "date"})
+    return by_date
+
+
+def get_plan_changes(username, since):
+    """
+    Returns (dates, plan): every date the user's plan has, and the blocks
+    (flat, with their 'date') of only the days written after version `since`.
+    """
+    dates = []
+    plan = []
+    pipeline = [
+        {"$match": {"username": username}},
+        {"$sort": {"date": ASCENDING}},
+        {"$project": {"_id": 0, "date": 1, "blocks": {
+            "$cond": [{"$gt": [{"$ifNull": ["$v", 0]}, since]}, "$blocks", "$$REMOVE"]}}},
+    ]
+    for day in plans_collection.aggregate(pipeline):
+        dates.append(day["date"])
+        for block in day.get("blocks", []):
+            plan.append({"date": day["date"], **block})
+    return dates, plan
+
+
+def write_plan_dates(username, plan, dates):
+    """
+    Rewrites only the given dates of the user's plan from `plan` (a flat list
+    of blocks). Dates with no blocks left are removed. One round trip, plus
+    the version bump.
+    """
+    by_date = _blocks_by_date(plan)
+    dates = sorted(set(dates))
+    if not dates:
+        return
+    base = get_data_version(username) or 0
+    stamp = base + 1
+    operations = []
+    for date in dates:
+        if by_date.get(date):
+            operations.append(ReplaceOne(
+                {"username": username, "date": date},
+                {"username": username, "date": date, "blocks": by_date[date], "v": stamp},
+                upsert=True
+            ))
+        else:
+            operations.append(DeleteOne({"username": username, "date": date}))
+    plans_collection.bulk_write(operations, ordered=False)
+    advance_version(username, base, stamp)
+
+
+def replace_plan(username, plan):
+    """Replaces the user's whole plan."""
+    stored_dates = plans_collection.distinct("date", {"username": username})
+    write_plan_dates(username, plan, set(stored_dates) | set(_blocks_by_date(plan)))
+
+
+# --- Chat history ---
+
+def get_chat_state(username):
+    """
+    The stored conversation plus the snapshot of the context the model last
+    saw, the rolling summary of older turns and the conversation's revision.
+    """
+    doc = chat_collection.find_one({"username": username},
+                                   {"messages": 1, "context": 1, "summary": 1, "revision": 1, "_id": 0})
+    if doc:
+        document_bytes.observe(len(bson.encode(doc)), collection="chat_histories")
+    return doc or {}
+
+
+def save_chat_history(username, messages):
+    chat_collection.update_one(
+        {"username": username},
+        {"$set": {"messages": messages}},
+        upsert=True
+    )
+
+
+def append_chat_messages(username, new_messages, max_messages, reset=False, context=None):
+    """
+    Appends this turn's messages to the stored conversation, keeping only the
+    newest `max_messages`. The write size depends on the new messages only.
+    With `reset`, the conversation (and its summary) is started over with just
+    these messages. `context`, if given, replaces the stored context snapshot
+    in the same write.
+    """
+    if reset:
+        update = {"$set": {"messages": new_messages[-max_messages:], "summary": None}}
+    else:
+        update = {"$push": {"messages": {"$each": new_messages, "$slice": -max_messages}}}
+    if context is not None:
+        update.setdefault("$set", {})["context"] = context
+    update["$inc"] = {"revision": 1}
+    chat_collection.update_one({"username": username}, update, upsert=True)
+
+
+def save_chat_summary(username, revision, summary, remaining_messages):
+    """
+    Replaces the summarized older messages with `summary`, keeping
+    `remaining_messages`, if the conversation is still at `revision` (nothing
+    was appended since it was read). Returns True if it was saved.
+    """
+    result = chat_collection.update_one(
+        {"username": username, "revision": revision},
+        {"$set": {"summary": summary, "messages": remaining_messages}, "$inc": {"revision": 1}}
+    )
+    return result.modified_count == 1
+
+
+def clear_chat_history(username):
+    chat_collection.update_one(
+        {"username": username},
+        {"$set": {"messages": [], "context": None, "summary": None}, "$inc": {"revision": 1}},
+        upsert=True
+    )
+
+
+# --- Migration from the old single-document layout ---
+
+# --- Offloaded chat turns ---
+
+def create_chat_result(turn_id, username):
+    """Records a chat turn handed to the chat workers, so any process can report on it."""
+    chat_results_collection.insert_one({"_id": turn_id, "username": username, "state": "queued",
+                                        "created_at": datetime.now(timezone.utc)})
+
+
+def finish_chat_result(turn_id, payload, status, headers):
+    """Stores the turn's (payload, status, headers), the same response /chat would have sent."""
+    chat_results_collection.update_one({"_id": turn_id}, {"$set": {
+        "state": "done", "payload": payload, "status": status, "headers": headers}})
+
+
+def get_chat_result(turn_id, username):
+    """The user's offloaded turn (state, and once done payload/status/headers), or None."""
+    return chat_results_collection.find_one({"_id": turn_id, "username": username},
+                                            {"_id": 0, "state": 1, "payload": 1, "status": 1, "headers": 1})
+
+
+def migrate_legacy_user(username):
+    """
+    Moves `chat_history` and `generated_plan` out of an old-style user document
+    into their own collections, and gives classes, tasks and tests created
+    before items had ids an id. Cheap no-op for users that are already migrated.
+    Returns True if anything was migrated (the plan should then be regenerated
+    so its blocks reference the item ids).
+    """
+    assigned_ids = _backfill_item_ids(username)
+    legacy = users_collection.find_one(
+        {"username": username, "$or": [{"chat_history": {"$exists": True}},
+                                       {"generated_plan": {"$exists": True}}]},
+        {"chat_history": 1, "generated_plan": 1, "_id": 0}
+    )
+    if not legacy:
+        return assigned_ids
+    if legacy.get("generated_plan"):
+        replace_plan(username, [block for block in legacy["generated_plan"] if block.get("date")])
+    if legacy.get("chat_history"):
+        # Old histories also stored the system prompt and context header every turn.
+        save_chat_history(username, [
+            message for message in legacy["chat_history"]
+            if message.get("role") in ["assistant", "tool"] or
+            (message.get("role") == "user" and
+             not (message.get("content") or "").startswith("Here is my current data."))
+        ])
+    users_collection.update_one(
+        {"username": username},
+        {"$unset": {"chat_history": "", "generated_plan": ""}}
+    )
+    return True
+
+
+def _backfill_item_ids(username):
+    missing = {"$elemMatch": {"id": {"$exists": False}}}
+    user = users_collection.find_one(
+        {"username": username, "$or": [{"schedule": missing}, {"tasks": missing}, {"tests": missing}]},
+        {"schedule": 1, "tasks": 1, "tests": 1, "_id": 0}
+    )
+    if not user:
+        return False
+    updates = {}
+    for field in ("schedule", "tasks", "tests"):
+        items = user.get(field, [])
+        for item in items:
+            item.setdefault("id", new_item_id())
+        updates[field] = items
+    users_collection.update_one({"username": username}, {"$set": updates, "$inc": {"data_version": 1}})
+    invalidate_user(username)
+    return True
@@ -0,0 +1,173 @@
+"""
+Invariants of the planning engine (planner.py). Everything here is pure
+Python, so these run without MongoDB or OpenAI: `python -m pytest tests`.
+"""
+import copy
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from planner import (
+    DAY_NAMES, EFFORT_MINUTES, build_plan, first_affected_date, format_hhmm, parse_deadline, parse_hhmm,
+    replan_from, weekday_index,
+)
+
+NOW = datetime(2026, 10, 17, 9, 30)  # a Saturday morning
+
+SCHEDULE = [
+    {"day": "Monday", "start_time": "09:00", "end_time": "12:00"},
+    {"day": "Wednesday", "start_time": "17:00", "end_time": "18:30"},
+    {"day": "fri", "start_time": "16:30", "end_time": "17:15"},
+]
+WINDOWS = [
+    {"day": day, "start_time": "16:00", "end_time": "20:00", "focus_level": focus}
+    for day, focus in zip(DAY_NAMES, ["high", "medium", "low", "high", "medium", "low", "high"])
+]
+
+
+def _task(rng, item_id):
+    due = NOW + timedelta(days=rng.randint(0, 20), hours=rng.randint(0, 23))
+    return {"id": item_id, "name": item_id.upper(),
+            "task_type": rng.choice(["assignment", "project", "seatwork", None]),
+            "deadline": due.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def _test(rng, item_id):
+    due = NOW + timedelta(days=rng.randint(1, 20))
+    return {"id": item_id, "name": item_id.upper(), "test_type": rng.choice(["quiz", "exam", None]),
+            "date": due.strftime("%Y-%m-%d")}
+
+
+def _random_items(rng):
+    return ([_task(rng, f"t{i}") for i in range(rng.randint(1, 10))],
+            [_test(rng, f"s{i}") for i in range(rng.randint(0, 4))])
+
+
+def _replan(stored, tasks, tests, item_ids, from_date=None):
+    """Re-plans the way the app does after a change to `item_ids`."""
+    dates = [date for date in (first_affected_date(stored, tasks, tests, item_ids, now=NOW), from_date) if date]
+    if not dates:
+        return stored
+    plan, _ = replan_from(SCHEDULE, tasks, tests, {}, WINDOWS, stored, min(dates), now=NOW)
+    return plan
+
+
+def _ordered(plan):
+    return sorted(plan, key=lambda block: (block["date"], block["start_time"]))
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_replan_from_matches_build_plan_after_add(seed):
+    rng = random.Random(seed)
+    tasks, tests = _random_items(rng)
+    stored, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+
+    tasks = tasks + [_task(rng, "new")]
+    expected, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+    assert _ordered(_replan(stored, tasks, tests, ["new"])) == _ordered(expected)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_replan_from_matches_build_plan_after_update(seed):
+    rng = random.Random(seed)
+    tasks, tests = _random_items(rng)
+    stored, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+
+    tasks = copy.deepcopy(tasks)
+    changed = rng.choice(tasks)
+    changed.update(_task(rng, changed["id"]))
+    expected, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+    assert _ordered(_replan(stored, tasks, tests, [changed["id"]])) == _ordered(expected)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_replan_from_matches_build_plan_after_delete(seed):
+    rng = random.Random(seed)
+    tasks, tests = _random_items(rng)
+    stored, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+
+    deleted = rng.choice(tasks)
+    tasks = [task for task in tasks if task is not deleted]
+    # Deleting cascades to the item's blocks; the app remembers where they started.
+    from_date = next((block["date"] for block in _ordered(stored) if block.get("item_id") == deleted["id"]), None)
+    stored = [block for block in stored if block.get("item_id") != deleted["id"]]
+    expected, _ = build_plan(SCHEDULE, tasks, tests, {}, WINDOWS, now=NOW)
+    assert _ordered(_replan(stored, tasks, tests, [deleted["id"]], from_date)) == _ordered(expected)
+
+
+def _minutes_planned(plan):
+    return sum(parse_hhmm(block["end_time"]) - parse_hhmm(block["start_time"]) for block in plan)
+
+
+@pytest.mark.parametrize("focus, weight", [("high", 1.0), ("medium", 0.8), ("low", 0.5)])
+def test_focus_level_sets_how_long_work_takes(focus, weight):
+    windows = [{"day": day, "start_time": "08:00", "end_time": "22:00", "focus_level": focus} for day in DAY_NAMES]
+    tasks = [{"id": "p", "name": "Project", "task_type": "project",
+              "deadline": (NOW + timedelta(days=14)).strftime("%Y-%m-%dT%H:%M:%S")}]
+    plan, unfinished = build_plan([], tasks, [], {"awake_time": "07:00", "sleep_time": "23:00"}, windows, now=NOW)
+
+    assert not unfinished
+    needed = EFFORT_MINUTES["project"] / weight
+    # Blocks are rounded up to the block granularity, at most 5 minutes each.
+    assert needed <= _minutes_planned(plan) < needed + 5 * len(plan)
+
+
+def test_high_focus_windows_need_less_time_than_low_focus_ones():
+    tasks = [{"id": "a", "name": "A", "task_type": "assignment",
+              "deadline": (NOW + timedelta(days=7)).strftime("%Y-%m-%dT%H:%M:%S")}]
+    plans = {}
+    for focus in ("high", "low"):
+        windows = [{"day": day, "start_time": "18:00", "end_time": "21:00", "focus_level": focus} for day in DAY_NAMES]
+        plans[focus], _ = build_plan([], tasks, [], {}, windows, now=NOW)
+    assert _minutes_planned(plans["high"]) < _minutes_planned(plans["low"])
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_study_blocks_never_overlap_classes(seed):
+    rng = random.Random(seed)
+    tasks, tests = _random_items(rng)
+    schedule = SCHEDULE + [
+        {"day": rng.choice(DAY_NAMES), "start_time": f"{hour:02d}:{rng.choice(['00', '30'])}",
+         "end_time": f"{hour + rng.randint(1, 3):02d}:00"}
+        for hour in (rng.randint(15, 19) for _ in range(rng.randint(0, 6)))
+    ]
+    plan, _ = build_plan(schedule, tasks, tests, {}, WINDOWS, now=NOW)
+
+    assert plan
+    for block in plan:
+        weekday = datetime.strptime(block["date"], "%Y-%m-%d").weekday()
+        start, end = parse_hhmm(block["start_time"]), parse_hhmm(block["end_time"])
+        for item in schedule:
+            if weekday_index(item["day"]) == weekday:
+                assert end <= parse_hhmm(item["start_time"]) or start >= parse_hhmm(item["end_time"]), (block, item)
+
+
+def test_date_only_deadline_means_end_of_day():
+    assert parse_deadline("2026-10-17") == datetime(2026, 10, 17, 23, 59)
+    assert parse_deadline("2026-10-17T10:00:00") == datetime(2026, 10, 17, 10, 0)
+
+
+def test_work_due_today_by_date_is_planned_for_this_evening():
+    tasks = [{"id": "h", "name": "Homework", "deadline": NOW.strftime("%Y-%m-%d")}]
+    plan, unfinished = build_plan([], tasks, [], {}, WINDOWS, now=NOW)
+    assert not unfinished
+    assert {block["date"] for block in plan} == {NOW.strftime("%Y-%m-%d")}
+
+
+def test_format_hhmm_never_emits_24_00():
+    assert format_hhmm(0) == "00:00"
+    assert format_hhmm(23 * 60 + 59) == "23:59"
+    assert format_hhmm(24 * 60) == "23:59"
+    assert all(format_hhmm(minutes) != "24:00" for minutes in range(24 * 60 + 1))
+
+
+def test_blocks_running_to_midnight_end_at_23_59():
+    windows = [{"day": day, "start_time": "22:35", "end_time": "24:00", "focus_level": "high"} for day in DAY_NAMES]
+    tasks = [{"id": "p", "name": "Project", "task_type": "project",
+              "deadline": (NOW + timedelta(days=10)).strftime("%Y-%m-%d")}]
+    plan, _ = build_plan([], tasks, [], {"awake_time": "08:00", "sleep_time": "01:00"}, windows, now=NOW)
+
+    assert plan
+    assert all(block["end_time"] != "24:00" for block in plan)
+    assert any(block["end_time"] == "23:59" for block in plan)
@@ -0,0 +1,9 @@
+"""
+Production entry point: `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+The app is created once in the gunicorn master and forked into the workers;
+each worker opens its own MongoDB and OpenAI connections on first use.
+"""
+from app import create_app
+
+app = create_app()